@@ -5,11 +5,15 @@ from typing import Any, Dict
 
 from fastapi import APIRouter, UploadFile, File, BackgroundTasks, Body, Depends, HTTPException
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 import uuid
 
 from schemas.models import InstallRequest, UninstallRequest, BatchInstallRequest, TemplateBindRequest, RegisterRequest
+from services.planner import BatchPlanner
 from utils.excel import parse_excel
-from core.dependencies import get_zabbix_service, get_tasks, get_upload_dir, get_log_store, get_batch_store
+from utils.export import EXPORT_FORMATS, export_response
+from core.batch_store import EXPORT_RESULT_COLUMNS
+from core.dependencies import get_zabbix_service, get_tasks, get_upload_dir, get_log_store, get_batch_store, get_batch_worker
 from core.settings import get_settings
 from utils.response import ok
 
@@ -139,7 +143,10 @@ async def batch_save(payload: dict = Body(...), batch_store=Depends(get_batch_st
         if "item_id" not in h:
             h["item_id"] = idx
 
-    saved = batch_store.save(hosts, name=name, batch_id=batch_id)
+    try:
+        saved = batch_store.save(hosts, name=name, batch_id=batch_id)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
     return ok({"batch_id": saved["batch_id"], "ts": saved["ts"], "name": name, "count": len(hosts), "hosts": hosts})
 
 
@@ -148,6 +155,13 @@ async def batch_list(limit: int = 20, batch_store=Depends(get_batch_store)):
     return ok(batch_store.list_recent(limit=limit))
 
 
+# 固定路径须在 /batch/{batch_id} 之前注册，否则会被当作 batch_id 匹配
+@router.get("/batch/stages")
+async def batch_stages(worker=Depends(get_batch_worker)):
+    """Pipeline stage backlog of the in-process batch worker (None when BATCH_WORKER_MODE=off)."""
+    return ok(worker.stage_stats() if worker else None)
+
+
 @router.get("/batch/{batch_id}")
 async def batch_get(batch_id: str, batch_store=Depends(get_batch_store)):
     data = batch_store.get(batch_id)
@@ -156,12 +170,71 @@ async def batch_get(batch_id: str, batch_store=Depends(get_batch_store)):
     return ok(data)
 
 
+@router.get("/batch/{batch_id}/export")
+async def batch_export(
+    batch_id: str,
+    format: str = "csv",
+    status: str | None = None,
+    since: int | None = None,
+    until: int | None = None,
+    history: bool = False,
+    batch_store=Depends(get_batch_store),
+):
+    """Stream batch results (latest per host, or full history) as ndjson/csv/xlsx."""
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if not batch_store.exists(batch_id):
+        raise HTTPException(status_code=404, detail="batch not found")
+    rows = batch_store.iter_results(batch_id, status=status, since=since, until=until, history=history)
+    return export_response(rows, EXPORT_RESULT_COLUMNS, format, f"batch_{batch_id}")
+
+
 @router.delete("/batch/{batch_id}")
 async def batch_delete(batch_id: str, batch_store=Depends(get_batch_store)):
     batch_store.delete_batch(batch_id)
     return ok({"deleted": True, "batch_id": batch_id})
 
 
+def _run_host_ids(batch: Dict[str, Any], host_ids, resume: bool):
+    """Host ids a /batch/run would enqueue; resume keeps only hosts whose latest result failed."""
+    if not resume:
+        return host_ids
+    # 断点续装：只重跑最新结果为 failed 的主机，按各自的 checkpoint 从第一个未完成步骤继续
+    wanted = {str(i) for i in host_ids}
+    host_ids = [
+        str(r.get("item_id"))
+        for r in batch.get("results", [])
+        if r.get("status") == "failed" and (not wanted or str(r.get("item_id")) in wanted)
+    ]
+    if not host_ids:
+        raise HTTPException(status_code=400, detail="no failed hosts to resume")
+    return host_ids
+
+
+@router.post("/batch/plan")
+async def batch_plan(
+    payload: Dict[str, Any] = Body(...),
+    svc=Depends(get_zabbix_service),
+    log_store=Depends(get_log_store),
+    batch_store=Depends(get_batch_store),
+):
+    """Dry run of /batch/run (same body): classify hosts and estimate API calls, bytes and duration."""
+    batch_id = payload.get("batch_id")
+    batch = batch_store.get(batch_id) if batch_id else None
+    if not batch:
+        raise HTTPException(status_code=404, detail="batch not found")
+    action = payload.get("action", "install")
+    host_ids = _run_host_ids(batch, payload.get("host_ids") or [], action == "resume")
+    hosts = batch.get("hosts", [])
+    if host_ids:
+        wanted = {str(i) for i in host_ids}
+        hosts = [h for h in hosts if str(h.get("item_id")) in wanted]
+    planner = BatchPlanner(svc, log_store)
+    # 含 Zabbix 查询与逐台 TCP 探测，放到线程池执行，不阻塞事件循环
+    data = await run_in_threadpool(planner.plan, hosts, "install" if action == "resume" else action, payload)
+    return ok({"batch_id": batch_id, **data})
+
+
 @router.post("/batch/run")
 async def batch_run(
     payload: Dict[str, Any] = Body(...),
@@ -178,16 +251,20 @@ async def batch_run(
     register_server = payload.get("register_server", True)
     register_only = payload.get("register_only", False)
     precheck = payload.get("precheck", False)
+    reinstall = payload.get("reinstall", False)
     web_monitor_url = payload.get("web_monitor_url")
     web_monitor_urls = payload.get("web_monitor_urls")
     jmx_port = payload.get("jmx_port")
+    priority = payload.get("priority") or 0
+    concurrency = payload.get("concurrency")
 
     batch = batch_store.get(batch_id) if batch_id else None
     if not batch:
         raise HTTPException(status_code=404, detail="batch not found")
-    hosts = batch.get("hosts", [])
-    if host_ids:
-        hosts = [h for h in hosts if h.get("item_id") in host_ids or str(h.get("item_id")) in host_ids]
+    resume = action == "resume"
+    host_ids = _run_host_ids(batch, host_ids, resume)
+    if resume:
+        action = "install"
     q_payload = {
         "template_ids": template_ids,
         "group_ids": group_ids,
@@ -195,12 +272,16 @@ async def batch_run(
         "register_server": register_server,
         "register_only": register_only,
         "precheck": precheck,
+        "reinstall": reinstall,
         "web_monitor_url": web_monitor_url,
         "web_monitor_urls": web_monitor_urls,
         "jmx_port": jmx_port,
+        "concurrency": concurrency,
+        "resume": resume,
+        "retry": payload.get("retry"),
     }
     try:
-        queue_id = batch_store.enqueue(batch_id, [str(i) for i in host_ids], action, q_payload)
+        queue_id = batch_store.enqueue(batch_id, [str(i) for i in host_ids], action, q_payload, priority=priority)
     except ValueError as exc:
         raise HTTPException(status_code=400, detail=str(exc))
     return ok({"queue_id": queue_id, "batch_id": batch_id, "status": "pending"})
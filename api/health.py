@@ -4,7 +4,7 @@ from fastapi import APIRouter, Header, HTTPException
 from fastapi.responses import FileResponse, JSONResponse
 
 from utils.response import ok
-from core.dependencies import BASE_DIR
+from core.dependencies import BASE_DIR, BATCH_WORKER, LOG_STORE
 from core.settings import get_settings
 
 router = APIRouter()
@@ -20,6 +20,10 @@ async def health():
 async def shutdown(x_token: str = Header(default="")):
     if x_token != settings.shutdown_token:
         raise HTTPException(status_code=401, detail="unauthorized")
+    # os._exit 不执行 atexit：先停止批量 worker（写出结果缓冲），再写出排队中的日志
+    if BATCH_WORKER:
+        BATCH_WORKER.stop()
+    LOG_STORE.close()
     # 立即退出进程
     os._exit(0)
 
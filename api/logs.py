@@ -1,5 +1,10 @@
+import sqlite3
+
 from fastapi import APIRouter, Depends, HTTPException
+from starlette.concurrency import run_in_threadpool
 from core.dependencies import get_log_store
+from core.log_store import LOG_COLUMNS
+from utils.export import EXPORT_FORMATS, export_response
 from utils.response import ok
 
 router = APIRouter(prefix="/api/zabbix", tags=["logs"])
@@ -10,9 +15,63 @@ async def list_logs(limit: int = 10, hostname: str | None = None, ip: str | None
     return ok(log_store.list_recent(limit=limit, hostname=hostname, ip=ip, host_id=host_id, zabbix_url=zabbix_url))
 
 
+@router.get("/logs/search")
+async def search_logs(
+    q: str,
+    since: int | None = None,
+    until: int | None = None,
+    status: str | None = None,
+    step: str | None = None,
+    limit: int = 50,
+    offset: int = 0,
+    raw: bool = False,
+    log_store=Depends(get_log_store),
+):
+    """Full-text search over step names and output (ranked, paged); since/until are epoch seconds."""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="q required")
+    try:
+        data = await run_in_threadpool(
+            log_store.search, q, since=since, until=until, status=status, step=step,
+            limit=max(1, min(limit, 500)), offset=max(0, offset), raw=raw,
+        )
+    except RuntimeError as exc:
+        raise HTTPException(status_code=501, detail=str(exc))
+    except sqlite3.OperationalError as exc:
+        raise HTTPException(status_code=400, detail=f"invalid search query: {exc}")
+    return ok(data)
+
+
+@router.get("/logs/export")
+async def export_logs(
+    format: str = "ndjson",
+    since: int | None = None,
+    until: int | None = None,
+    status: str | None = None,
+    task_id: str | None = None,
+    batch_id: str | None = None,
+    log_store=Depends(get_log_store),
+):
+    """Stream install logs as ndjson/csv/xlsx, filtered by time range (epoch seconds), status, task or batch."""
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    rows = log_store.iter_logs(since=since, until=until, status=status, task_id=task_id, batch_id=batch_id)
+    return export_response(rows, list(LOG_COLUMNS), format, f"install_logs_{batch_id}" if batch_id else "install_logs")
+
+
 @router.get("/logs/{task_id}")
 async def get_logs(task_id: str, log_store=Depends(get_log_store)):
     logs = log_store.get(task_id)
     if not logs:
         raise HTTPException(status_code=404, detail="logs not found")
     return ok(logs)
+
+
+@router.post("/logs/prune")
+async def prune_logs(vacuum: bool = False, log_store=Depends(get_log_store)):
+    """Run log retention now (LOG_RETENTION_DAYS / LOG_RETENTION_ROWS / LOG_ARCHIVE_DIR).
+
+    vacuum=true first converts an old database to auto_vacuum=INCREMENTAL (one-time full VACUUM
+    that blocks all writers while it runs).
+    """
+    return ok(await run_in_threadpool(log_store.prune, vacuum=vacuum))
@@ -1,81 +1,143 @@
 from __future__ import annotations
 
 import json
+import logging
 import sqlite3
+import threading
 import time
 import uuid
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Iterable
+from typing import Any, Dict, List, Optional, Iterable, Iterator
+
+from core.db import get_database
+
+LOG = logging.getLogger(__name__)
+
+_RESULT_COLS = "item_id, ip, host_id, task_id, status, error, zabbix_url, ts, last_step, artifact_hash"
+EXPORT_RESULT_COLUMNS = [
+    "item_id", "ip", "hostname", "host_id", "task_id", "status", "error", "zabbix_url", "ts", "last_step", "artifact_hash",
+]
+# get_results 按 item_id 点查的上限，超过时改为按批次顺序扫描
+_POINT_LOOKUP_MAX = 500
 
 
 class BatchStore:
-    """SQLite store for uploaded batch host data."""
+    """SQLite store for uploaded batch host data.
+
+    Hosts live in `batch_hosts`, one row per (batch_id, item_id) with the original host dict in
+    `data` and ip/hostname/host_id as indexed columns; `batches.host_count` keeps the count so
+    listing batches never touches the hosts. Old `batches.data` JSON blobs are migrated on start.
+
+    `batch_results` is the append-only history; `batch_results_latest` holds each host's newest row
+    (keyed by batch_id, item_id) and is upserted in the same transaction, ordered by the history
+    row id, so get_results() is a primary-key read.
+    """
 
     def __init__(self, db_path: Path):
         self.db_path = db_path
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        self._ensure_schema()
+        self.db = get_database(db_path)
+        # 入队时直接唤醒同进程内的 BatchWorker，避免轮询延迟
+        self._wakeup = threading.Event()
+        self.db.migrate()
 
-    def _ensure_schema(self) -> None:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS batches (
-                    id TEXT PRIMARY KEY,
-                    ts INTEGER,
-                    name TEXT,
-                    data TEXT
+    @classmethod
+    def split_legacy_batches(cls, conn: sqlite3.Connection) -> None:
+        """Move hosts still stored as JSON in batches.data into batch_hosts rows."""
+        legacy = conn.execute("SELECT id, data FROM batches WHERE data IS NOT NULL AND data != ''").fetchall()
+        for batch_id, raw in legacy:
+            try:
+                hosts = (json.loads(raw) or {}).get("hosts", [])
+            except Exception:
+                hosts = []
+            # 旧数据中重复的 item_id 只保留第一台，host_count 取实际行数
+            count = cls._insert_hosts(conn, batch_id, hosts)
+            if count != len(hosts):
+                LOG.warning("batch %s: dropped %d hosts with duplicate item_id", batch_id, len(hosts) - count)
+            conn.execute("UPDATE batches SET data=NULL, host_count=? WHERE id=?", (count, batch_id))
+
+    @staticmethod
+    def _duplicate_item_ids(hosts: List[Dict[str, Any]]) -> List[str]:
+        """item_ids that occur more than once in hosts (batch_hosts is keyed by batch_id, item_id)."""
+        seen, dups = set(), []
+        for h in hosts:
+            key = str(h.get("item_id"))
+            if key in seen and key not in dups:
+                dups.append(key)
+            seen.add(key)
+        return dups
+
+    @staticmethod
+    def _insert_hosts(conn: sqlite3.Connection, batch_id: str, hosts: List[Dict[str, Any]]) -> int:
+        """Replace the hosts of batch_id; returns the number of rows stored (first of duplicate item_ids wins)."""
+        conn.execute("DELETE FROM batch_hosts WHERE batch_id=?", (batch_id,))
+        conn.executemany(
+            "INSERT OR IGNORE INTO batch_hosts(batch_id, item_id, pos, ip, hostname, host_id, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    batch_id,
+                    str(h.get("item_id")),
+                    pos,
+                    str(h.get("ip")) if h.get("ip") is not None else None,
+                    h.get("hostname") or None,
+                    h.get("host_id") or None,
+                    json.dumps(h),
                 )
-                """
-            )
-            self._ensure_results_table(conn)
-            self._ensure_queue_table(conn)
-            conn.commit()
+                for pos, h in enumerate(hosts)
+            ],
+        )
+        return conn.execute("SELECT COUNT(*) FROM batch_hosts WHERE batch_id=?", (batch_id,)).fetchone()[0]
+
+    def _load_hosts(self, conn: sqlite3.Connection, batch_id: str) -> List[Dict[str, Any]]:
+        hosts = []
+        for raw, host_id in conn.execute(
+            "SELECT data, host_id FROM batch_hosts WHERE batch_id=? ORDER BY pos", (batch_id,)
+        ):
+            h = json.loads(raw) if raw else {}
+            # host_id 由 save_results 按行回填
+            if host_id and not h.get("host_id"):
+                h["host_id"] = host_id
+            hosts.append(h)
+        return hosts
 
-    def _ensure_results_table(self, conn: sqlite3.Connection) -> None:
-        """Ensure batch_results table exists (for old DBs as well)."""
+    @staticmethod
+    def backfill_latest(conn: sqlite3.Connection) -> None:
+        """Fill batch_results_latest with the newest batch_results row of every host."""
         conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS batch_results (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                batch_id TEXT,
-                item_id TEXT,
-                ip TEXT,
-                host_id TEXT,
-                task_id TEXT,
-                status TEXT,
-                error TEXT,
-                zabbix_url TEXT,
-                ts INTEGER
-            )
+            f"""
+            INSERT OR REPLACE INTO batch_results_latest(batch_id, result_id, {_RESULT_COLS})
+            SELECT br.batch_id, br.id, {", ".join("br." + c.strip() for c in _RESULT_COLS.split(","))}
+            FROM batch_results br
+            JOIN (SELECT MAX(id) AS id FROM batch_results GROUP BY batch_id, item_id) m ON m.id = br.id
             """
         )
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_results_batch ON batch_results(batch_id)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_results_item ON batch_results(batch_id, item_id)")
 
-    def _ensure_queue_table(self, conn: sqlite3.Connection) -> None:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS batch_queue (
-                id TEXT PRIMARY KEY,
-                batch_id TEXT,
-                host_ids TEXT,
-                action TEXT,
-                payload TEXT,
-                status TEXT,
-                error TEXT,
-                created INTEGER,
-                started INTEGER,
-                finished INTEGER
-            )
-            """
+    def rebuild_latest_results(self) -> None:
+        """Recompute batch_results_latest from batch_results (after rows were copied in directly)."""
+        with self.db.connect() as conn:
+            conn.execute("DELETE FROM batch_results_latest")
+            self.backfill_latest(conn)
+
+    @staticmethod
+    def _insert_results(conn: sqlite3.Connection, rows: List[tuple]) -> None:
+        """Append history rows (batch_id + _RESULT_COLS) and upsert the latest row of each host."""
+        insert = f"INSERT INTO batch_results(batch_id, {_RESULT_COLS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        # 逐行插入，以各行的 lastrowid 作为 result_id
+        ids = [conn.execute(insert, row).lastrowid for row in rows]
+        conn.executemany(
+            f"""
+            INSERT INTO batch_results_latest(batch_id, {_RESULT_COLS}, result_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(batch_id, item_id) DO UPDATE SET
+                result_id = excluded.result_id, ip = excluded.ip, host_id = excluded.host_id, task_id = excluded.task_id,
+                status = excluded.status, error = excluded.error, zabbix_url = excluded.zabbix_url, ts = excluded.ts,
+                last_step = excluded.last_step, artifact_hash = excluded.artifact_hash
+            WHERE excluded.result_id > batch_results_latest.result_id
+            """,
+            [row + (result_id,) for row, result_id in zip(rows, ids)],
         )
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_queue_status ON batch_queue(status)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_queue_batch ON batch_queue(batch_id)")
 
     def has_active_queue(self, batch_id: str) -> bool:
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_queue_table(conn)
+        with self.db.connect() as conn:
             row = conn.execute(
                 "SELECT 1 FROM batch_queue WHERE batch_id=? AND status IN ('pending','running') LIMIT 1",
                 (batch_id,),
@@ -84,43 +146,35 @@ class BatchStore:
 
 
     def save(self, hosts: List[Dict[str, Any]], name: str | None = None, batch_id: str | None = None) -> Dict[str, Any]:
+        """Store a batch; raises ValueError if two hosts share an item_id."""
+        dups = self._duplicate_item_ids(hosts)
+        if dups:
+            raise ValueError(f"duplicate item_id: {', '.join(dups[:10])}")
         batch_id = batch_id or uuid.uuid4().hex
         ts = int(time.time())
-        record = {"hosts": hosts}
-        with sqlite3.connect(self.db_path) as conn:
+        with self.db.connect() as conn:
             conn.execute(
-                "REPLACE INTO batches(id, ts, name, data) VALUES (?, ?, ?, ?)",
-                (batch_id, ts, name or "", json.dumps(record)),
+                "REPLACE INTO batches(id, ts, name, data, host_count) VALUES (?, ?, ?, NULL, ?)",
+                (batch_id, ts, name or "", len(hosts)),
             )
+            self._insert_hosts(conn, batch_id, hosts)
             conn.commit()
         return {"batch_id": batch_id, "ts": ts, "count": len(hosts)}
 
     def list_recent(self, limit: int = 20) -> List[Dict[str, Any]]:
-        with sqlite3.connect(self.db_path) as conn:
+        with self.db.connect() as conn:
             rows = conn.execute(
-                "SELECT id, ts, name, data FROM batches ORDER BY ts DESC LIMIT ?",
+                "SELECT id, ts, name, host_count FROM batches ORDER BY ts DESC LIMIT ?",
                 (limit,),
             ).fetchall()
-        result: List[Dict[str, Any]] = []
-        for row in rows:
-            try:
-                data = json.loads(row[3]) if row[3] else {}
-                count = len(data.get("hosts", []))
-            except Exception:
-                count = 0
-            result.append({"batch_id": row[0], "ts": row[1], "name": row[2], "count": count})
-        return result
+        return [{"batch_id": row[0], "ts": row[1], "name": row[2], "count": row[3] or 0} for row in rows]
 
     def get(self, batch_id: str) -> Dict[str, Any] | None:
-        with sqlite3.connect(self.db_path) as conn:
-            row = conn.execute("SELECT id, ts, name, data FROM batches WHERE id=?", (batch_id,)).fetchone()
-        if not row:
-            return None
-        try:
-            data = json.loads(row[3]) if row[3] else {}
-        except Exception:
-            data = {}
-        data.setdefault("hosts", [])
+        with self.db.connect() as conn:
+            row = conn.execute("SELECT id, ts, name FROM batches WHERE id=?", (batch_id,)).fetchone()
+            if not row:
+                return None
+            data: Dict[str, Any] = {"hosts": self._load_hosts(conn, row[0])}
         data["batch_id"] = row[0]
         data["ts"] = row[1]
         data["name"] = row[2]
@@ -128,22 +182,34 @@ class BatchStore:
         data["results"] = self.get_results(batch_id=row[0])
         return data
 
+    def exists(self, batch_id: str) -> bool:
+        with self.db.connect() as conn:
+            return bool(conn.execute("SELECT 1 FROM batches WHERE id=?", (batch_id,)).fetchone())
+
     def get_by_name(self, name: str) -> Dict[str, Any] | None:
-        with sqlite3.connect(self.db_path) as conn:
-            row = conn.execute("SELECT id, ts, name, data FROM batches WHERE name=?", (name,)).fetchone()
-        if not row:
-            return None
-        try:
-            data = json.loads(row[3]) if row[3] else {}
-        except Exception:
-            data = {}
-        data.setdefault("hosts", [])
+        with self.db.connect() as conn:
+            row = conn.execute("SELECT id, ts, name FROM batches WHERE name=?", (name,)).fetchone()
+            if not row:
+                return None
+            data: Dict[str, Any] = {"hosts": self._load_hosts(conn, row[0])}
         data["batch_id"] = row[0]
         data["ts"] = row[1]
         data["name"] = row[2]
         return data
 
-    def save_results(self, batch_id: str, results: List[Dict[str, Any]]) -> None:
+    def save_results(
+        self,
+        batch_id: str,
+        results: List[Dict[str, Any]],
+        queue_id: str | None = None,
+        completed: int = 0,
+        failed: int = 0,
+        done_items: Optional[Iterable[str]] = None,
+    ) -> None:
+        """Append result rows; with queue_id also bump the queue progress counters in the same transaction.
+
+        done_items marks those hosts' leases done together with their final rows (lease mode).
+        """
         ts = int(time.time())
         rows = []
         for r in results:
@@ -158,64 +224,43 @@ class BatchStore:
                     r.get("error"),
                     r.get("zabbix_url"),
                     ts,
+                    r.get("last_step"),
+                    r.get("artifact_hash"),
                 )
             )
         if not rows:
             return
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_results_table(conn)
-            conn.executemany(
-                "INSERT INTO batch_results(batch_id, item_id, ip, host_id, task_id, status, error, zabbix_url, ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                rows,
-            )
-            # 同步写回 batches.data 中的 hosts（仅补充 host_id，不覆盖其他字段）
-            try:
-                cur = conn.execute("SELECT data FROM batches WHERE id=?", (batch_id,))
-                row = cur.fetchone()
-                if row and row[0]:
-                    data = json.loads(row[0])
-                    hosts = data.get("hosts", [])
-                    host_map = {str(r[1]): r[3] for r in rows if r[3]}  # item_id -> host_id
-                    if host_map and hosts:
-                        for h in hosts:
-                            item_id = str(h.get("item_id"))
-                            if item_id in host_map and not h.get("host_id"):
-                                h["host_id"] = host_map[item_id]
-                        conn.execute(
-                            "UPDATE batches SET data=? WHERE id=?",
-                            (json.dumps({"hosts": hosts}), batch_id),
-                        )
-            except Exception:
-                # ignore sync errors to avoid blocking main flow
-                pass
+        with self.db.connect() as conn:
+            self._insert_results(conn, rows)
+            # 同步回填 batch_hosts.host_id（仅补充，不覆盖已有值）
+            host_map = {r[1]: r[3] for r in rows if r[3]}  # item_id -> host_id
+            if host_map:
+                conn.executemany(
+                    "UPDATE batch_hosts SET host_id=? WHERE batch_id=? AND item_id=? AND host_id IS NULL",
+                    [(host_id, batch_id, item_id) for item_id, host_id in host_map.items()],
+                )
+            if queue_id and (completed or failed):
+                conn.execute(
+                    "UPDATE batch_queue SET completed_hosts=completed_hosts+?, failed_hosts=failed_hosts+? WHERE id=?",
+                    (completed, failed, queue_id),
+                )
+            if queue_id and done_items:
+                conn.executemany(
+                    "UPDATE batch_leases SET status='done', lease_until=NULL WHERE queue_id=? AND item_id=?",
+                    [(queue_id, str(i)) for i in done_items],
+                )
             conn.commit()
 
     def get_results(self, batch_id: str, host_ids: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
         host_filter = set(str(h) for h in host_ids) if host_ids else None
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_results_table(conn)
-            rows = conn.execute(
-                """
-                SELECT br.item_id,
-                       br.ip,
-                       br.host_id,
-                       br.task_id,
-                       br.status,
-                       br.error,
-                       br.zabbix_url,
-                       br.ts
-                FROM batch_results br
-                INNER JOIN (
-                    SELECT item_id, MAX(ts) AS max_ts
-                    FROM batch_results
-                    WHERE batch_id=?
-                    GROUP BY item_id
-                ) latest
-                ON br.item_id = latest.item_id AND br.ts = latest.max_ts
-                WHERE br.batch_id=?
-                """,
-                (batch_id, batch_id),
-            ).fetchall()
+        sql = f"SELECT {_RESULT_COLS}, result_id FROM batch_results_latest WHERE batch_id=?"
+        with self.db.connect() as conn:
+            if host_filter and len(host_filter) <= _POINT_LOOKUP_MAX:
+                ids = sorted(host_filter)
+                rows = conn.execute(sql + f" AND item_id IN ({','.join('?' * len(ids))})", [batch_id, *ids]).fetchall()
+                rows.sort(key=lambda r: r[10])
+            else:
+                rows = conn.execute(sql + " ORDER BY result_id", (batch_id,)).fetchall()
         return [
             {
                 "item_id": r[0],
@@ -226,31 +271,94 @@ class BatchStore:
                 "error": r[5],
                 "zabbix_url": r[6],
                 "ts": r[7],
+                "last_step": r[8],
+                "artifact_hash": r[9],
             }
             for r in rows
             if (not host_filter or str(r[0]) in host_filter)
         ]
 
+    def iter_results(
+        self,
+        batch_id: str,
+        status: str | None = None,
+        since: int | None = None,
+        until: int | None = None,
+        history: bool = False,
+        chunk: int = 1000,
+    ) -> Iterator[Dict[str, Any]]:
+        """Yield result rows of a batch with the host's hostname, `chunk` rows per fetch (for streamed exports).
+
+        Default: every host in list order with its latest result (status NULL if it never ran);
+        history=True: every batch_results row in write order.
+        """
+        where: List[str] = []
+        params: List[Any] = [batch_id]
+        if status:
+            where.append("r.status = ?")
+            params.append(status)
+        if since is not None:
+            where.append("r.ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("r.ts <= ?")
+            params.append(until)
+        filters = "".join(" AND " + w for w in where)
+        cols = "r.host_id, r.task_id, r.status, r.error, r.zabbix_url, r.ts, r.last_step, r.artifact_hash"
+        if history:
+            sql = f"""
+                SELECT r.item_id, COALESCE(r.ip, h.ip), h.hostname, {cols}
+                FROM batch_results r
+                LEFT JOIN batch_hosts h ON h.batch_id = r.batch_id AND h.item_id = r.item_id
+                WHERE r.batch_id = ?{filters}
+                ORDER BY r.id
+            """
+        else:
+            sql = f"""
+                SELECT h.item_id, COALESCE(r.ip, h.ip), h.hostname, {cols}
+                FROM batch_hosts h
+                LEFT JOIN batch_results_latest r ON r.batch_id = h.batch_id AND r.item_id = h.item_id
+                WHERE h.batch_id = ?{filters}
+                ORDER BY h.pos
+            """
+        with self.db.reader() as conn:
+            cur = conn.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(chunk)
+                if not rows:
+                    break
+                for r in rows:
+                    yield dict(zip(EXPORT_RESULT_COLUMNS, r))
+
     # -------------------- Queue helpers -------------------- #
-    def enqueue(self, batch_id: str, host_ids: List[str], action: str, payload: Dict[str, Any]) -> str:
+    def enqueue(self, batch_id: str, host_ids: List[str], action: str, payload: Dict[str, Any], priority: int = 0) -> str:
         if self.has_active_queue(batch_id):
             raise ValueError("当前批次已有待执行/执行中的任务，请稍候再试")
         qid = uuid.uuid4().hex
         now = int(time.time())
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_queue_table(conn)
+        with self.db.connect() as conn:
             conn.execute(
-                "INSERT INTO batch_queue(id, batch_id, host_ids, action, payload, status, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (qid, batch_id, json.dumps(host_ids), action, json.dumps(payload), "pending", now),
+                "INSERT INTO batch_queue(id, batch_id, host_ids, action, payload, status, created, priority) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (qid, batch_id, json.dumps(host_ids), action, json.dumps(payload), "pending", now, int(priority or 0)),
             )
             conn.commit()
+        self.notify()
         return qid
 
+    def notify(self) -> None:
+        """Wake up workers waiting in wait_for_work()."""
+        self._wakeup.set()
+
+    def wait_for_work(self, timeout: float) -> bool:
+        """Block until notify() is called or timeout elapses (fallback poll for other processes)."""
+        woke = self._wakeup.wait(timeout)
+        self._wakeup.clear()
+        return woke
+
     def next_pending(self) -> Optional[Dict[str, Any]]:
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_queue_table(conn)
+        with self.db.connect() as conn:
             row = conn.execute(
-                "SELECT id, batch_id, host_ids, action, payload, status, created FROM batch_queue WHERE status='pending' ORDER BY created ASC LIMIT 1"
+                "SELECT id, batch_id, host_ids, action, payload, status, created, priority FROM batch_queue WHERE status='pending' ORDER BY priority DESC, created ASC LIMIT 1"
             ).fetchone()
         if not row:
             return None
@@ -262,17 +370,135 @@ class BatchStore:
             "payload": json.loads(row[4]) if row[4] else {},
             "status": row[5],
             "created": row[6],
+            "priority": row[7] or 0,
         }
 
-    def start_queue(self, queue_id: str) -> None:
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_queue_table(conn)
-            conn.execute("UPDATE batch_queue SET status='running', started=? WHERE id=?", (int(time.time()), queue_id))
+    def start_queue(self, queue_id: str) -> bool:
+        """pending -> running; False when another worker already took the queue."""
+        with self.db.connect() as conn:
+            cur = conn.execute(
+                "UPDATE batch_queue SET status='running', started=? WHERE id=? AND status='pending'",
+                (int(time.time()), queue_id),
+            )
+            conn.commit()
+        return cur.rowcount > 0
+
+    # -------------------- Lease helpers (multi-process workers) -------------------- #
+    def activate_queue(self, queue_id: str, item_ids: List[str]) -> bool:
+        """Atomically move a pending queue to running and publish its hosts as claimable leases."""
+        with self.db.immediate() as conn:
+            cur = conn.execute(
+                "UPDATE batch_queue SET status='running', started=?, total_hosts=?, completed_hosts=0, failed_hosts=0 WHERE id=? AND status='pending'",
+                (int(time.time()), len(item_ids), queue_id),
+            )
+            if cur.rowcount == 0:
+                return False
+            conn.executemany(
+                "INSERT OR IGNORE INTO batch_leases(queue_id, item_id, status) VALUES (?, ?, 'pending')",
+                [(queue_id, str(i)) for i in item_ids],
+            )
+            return True
+
+    def claim_hosts(self, queue_id: str, worker_id: str, limit: int, lease_seconds: float) -> List[str]:
+        """Lease up to `limit` pending (or expired) hosts of a running queue to worker_id."""
+        if limit <= 0:
+            return []
+        now = time.time()
+        with self.db.immediate() as conn:
+            rows = conn.execute(
+                """
+                SELECT l.item_id FROM batch_leases l
+                JOIN batch_queue q ON q.id = l.queue_id AND q.status = 'running'
+                WHERE l.queue_id=? AND (l.status='pending' OR (l.status='leased' AND l.lease_until < ?))
+                ORDER BY l.rowid
+                LIMIT ?
+                """,
+                (queue_id, now, limit),
+            ).fetchall()
+            ids = [r[0] for r in rows]
+            conn.executemany(
+                "UPDATE batch_leases SET status='leased', worker_id=?, lease_until=?, claims=claims+1 WHERE queue_id=? AND item_id=?",
+                [(worker_id, now + lease_seconds, queue_id, i) for i in ids],
+            )
+        return ids
+
+    def renew_leases(self, worker_id: str, lease_seconds: float) -> int:
+        """Heartbeat: extend every lease held by worker_id."""
+        with self.db.connect() as conn:
+            cur = conn.execute(
+                "UPDATE batch_leases SET lease_until=? WHERE worker_id=? AND status='leased'",
+                (time.time() + lease_seconds, worker_id),
+            )
+            conn.commit()
+        return cur.rowcount
+
+    def release_hosts(self, queue_id: str, worker_id: str, item_ids: Iterable[str]) -> None:
+        """Give claimed-but-unstarted hosts back to the pool (worker shutdown)."""
+        with self.db.connect() as conn:
+            conn.executemany(
+                "UPDATE batch_leases SET status='pending', worker_id=NULL, lease_until=NULL WHERE queue_id=? AND item_id=? AND worker_id=? AND status='leased'",
+                [(queue_id, str(i), worker_id) for i in item_ids],
+            )
+            conn.commit()
+
+    def claimable_queues(self) -> List[Dict[str, Any]]:
+        """Running queues that still have pending or expired host leases."""
+        with self.db.connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT q.id, q.batch_id, q.host_ids, q.action, q.payload, q.status, q.created, q.priority
+                FROM batch_queue q
+                WHERE q.status='running' AND EXISTS (
+                    SELECT 1 FROM batch_leases l
+                    WHERE l.queue_id=q.id AND (l.status='pending' OR (l.status='leased' AND l.lease_until < ?))
+                )
+                ORDER BY q.priority DESC, q.created ASC
+                """,
+                (time.time(),),
+            ).fetchall()
+        return [
+            {
+                "id": r[0],
+                "batch_id": r[1],
+                "host_ids": json.loads(r[2]) if r[2] else [],
+                "action": r[3],
+                "payload": json.loads(r[4]) if r[4] else {},
+                "status": r[5],
+                "created": r[6],
+                "priority": r[7] or 0,
+            }
+            for r in rows
+        ]
+
+    def finish_queue_if_complete(self, queue_id: str) -> bool:
+        """Mark a running queue done once no host lease is outstanding (called by whichever worker drains last)."""
+        with self.db.connect() as conn:
+            cur = conn.execute(
+                """
+                UPDATE batch_queue SET status='done', finished=?
+                WHERE id=? AND status='running'
+                  AND NOT EXISTS (SELECT 1 FROM batch_leases WHERE queue_id=? AND status!='done')
+                """,
+                (int(time.time()), queue_id, queue_id),
+            )
+            conn.commit()
+        return cur.rowcount > 0
+
+    def set_queue_total(self, queue_id: str, total: int) -> None:
+        with self.db.connect() as conn:
+            conn.execute(
+                "UPDATE batch_queue SET total_hosts=?, completed_hosts=0, failed_hosts=0 WHERE id=?",
+                (total, queue_id),
+            )
+            conn.commit()
+
+    def set_queue_concurrency(self, queue_id: str, level: int) -> None:
+        with self.db.connect() as conn:
+            conn.execute("UPDATE batch_queue SET concurrency=? WHERE id=?", (level, queue_id))
             conn.commit()
 
     def finish_queue(self, queue_id: str, status: str = "done", error: str | None = None) -> None:
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_queue_table(conn)
+        with self.db.connect() as conn:
             conn.execute(
                 "UPDATE batch_queue SET status=?, error=?, finished=? WHERE id=?",
                 (status, error or None, int(time.time()), queue_id),
@@ -280,10 +506,9 @@ class BatchStore:
             conn.commit()
 
     def get_queue(self, queue_id: str) -> Optional[Dict[str, Any]]:
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_queue_table(conn)
+        with self.db.connect() as conn:
             row = conn.execute(
-                "SELECT id, batch_id, host_ids, action, payload, status, error, created, started, finished FROM batch_queue WHERE id=?",
+                "SELECT id, batch_id, host_ids, action, payload, status, error, created, started, finished, priority, total_hosts, completed_hosts, failed_hosts, concurrency FROM batch_queue WHERE id=?",
                 (queue_id,),
             ).fetchone()
         if not row:
@@ -300,30 +525,87 @@ class BatchStore:
             "created": row[7],
             "started": row[8],
             "finished": row[9],
+            "priority": row[10] or 0,
+            "total": row[11] or 0,
+            "completed": row[12] or 0,
+            "failed": row[13] or 0,
+            "concurrency": row[14] or 0,
             "results": self.get_results(row[1], host_ids=host_ids) if row[1] else [],
         }
 
     def cancel_queue(self, queue_id: str) -> bool:
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_queue_table(conn)
+        with self.db.connect() as conn:
+            now = int(time.time())
             cur = conn.execute(
                 "UPDATE batch_queue SET status='cancelled', finished=? WHERE id=? AND status IN ('pending','running')",
-                (int(time.time()), queue_id),
+                (now, queue_id),
             )
+            if cur.rowcount > 0:
+                # lease 模式下尚未被任何 worker 领取的主机直接记为 failed: cancelled
+                unclaimed = [
+                    r[0]
+                    for r in conn.execute(
+                        "SELECT item_id FROM batch_leases WHERE queue_id=? AND status='pending'", (queue_id,)
+                    ).fetchall()
+                ]
+                if unclaimed:
+                    batch_id = conn.execute("SELECT batch_id FROM batch_queue WHERE id=?", (queue_id,)).fetchone()[0]
+                    self._insert_results(
+                        conn, [(batch_id, i, None, None, None, "failed", "cancelled", None, now, None, None) for i in unclaimed]
+                    )
+                    conn.execute(
+                        "UPDATE batch_leases SET status='done' WHERE queue_id=? AND status='pending'", (queue_id,)
+                    )
+                    conn.execute(
+                        "UPDATE batch_queue SET failed_hosts=failed_hosts+? WHERE id=?", (len(unclaimed), queue_id)
+                    )
             conn.commit()
-            return cur.rowcount > 0
+        if cur.rowcount > 0:
+            self.notify()
+        return cur.rowcount > 0
 
     def is_cancelled(self, queue_id: str) -> bool:
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_queue_table(conn)
+        with self.db.connect() as conn:
             row = conn.execute("SELECT status FROM batch_queue WHERE id=?", (queue_id,)).fetchone()
         return bool(row and row[0] == "cancelled")
 
+    def list_orphaned(self) -> List[Dict[str, Any]]:
+        """Running queues without host leases, i.e. owned by an embedded worker (used for crash recovery)."""
+        with self.db.connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT id, batch_id, host_ids, action, payload, started, priority FROM batch_queue q
+                WHERE status='running' AND NOT EXISTS (SELECT 1 FROM batch_leases l WHERE l.queue_id=q.id)
+                ORDER BY created ASC
+                """
+            ).fetchall()
+        return [
+            {
+                "id": r[0],
+                "batch_id": r[1],
+                "host_ids": json.loads(r[2]) if r[2] else [],
+                "action": r[3],
+                "payload": json.loads(r[4]) if r[4] else {},
+                "started": r[5] or 0,
+                "priority": r[6] or 0,
+            }
+            for r in rows
+        ]
+
+    def interrupt_queue(self, queue_id: str, error: str) -> bool:
+        """running -> failed for a queue whose worker died; False if someone else already handled it."""
+        with self.db.connect() as conn:
+            cur = conn.execute(
+                "UPDATE batch_queue SET status='failed', error=?, finished=? WHERE id=? AND status='running'",
+                (error, int(time.time()), queue_id),
+            )
+            conn.commit()
+        return cur.rowcount > 0
+
     def list_active(self) -> List[Dict[str, Any]]:
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_queue_table(conn)
+        with self.db.connect() as conn:
             rows = conn.execute(
-                "SELECT id, batch_id, host_ids, action, status, created FROM batch_queue WHERE status IN ('pending','running') ORDER BY created DESC"
+                "SELECT id, batch_id, host_ids, action, status, created, priority, total_hosts, completed_hosts, failed_hosts, concurrency FROM batch_queue WHERE status IN ('pending','running') ORDER BY created DESC"
             ).fetchall()
         res = []
         for r in rows:
@@ -335,15 +617,21 @@ class BatchStore:
                     "action": r[3],
                     "status": r[4],
                     "created": r[5],
+                    "priority": r[6] or 0,
+                    "total": r[7] or 0,
+                    "completed": r[8] or 0,
+                    "failed": r[9] or 0,
+                    "concurrency": r[10] or 0,
                 }
             )
         return res
 
     def delete_batch(self, batch_id: str) -> None:
-        with sqlite3.connect(self.db_path) as conn:
-            self._ensure_results_table(conn)
-            self._ensure_queue_table(conn)
+        with self.db.connect() as conn:
+            conn.execute("DELETE FROM batch_leases WHERE queue_id IN (SELECT id FROM batch_queue WHERE batch_id=?)", (batch_id,))
             conn.execute("DELETE FROM batches WHERE id=?", (batch_id,))
+            conn.execute("DELETE FROM batch_hosts WHERE batch_id=?", (batch_id,))
             conn.execute("DELETE FROM batch_results WHERE batch_id=?", (batch_id,))
+            conn.execute("DELETE FROM batch_results_latest WHERE batch_id=?", (batch_id,))
             conn.execute("DELETE FROM batch_queue WHERE batch_id=?", (batch_id,))
             conn.commit()
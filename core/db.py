@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator
+
+from core.settings import get_settings
+
+
+class Database:
+    """Per-thread SQLite connections to one database file.
+
+    Every thread keeps one connection for its lifetime, so the per-connection statement cache
+    (`cached_statements`) re-uses prepared statements across calls. New connections are opened
+    in WAL mode with `synchronous`, `busy_timeout` and cache size taken from SQLITE_* settings.
+
+    Use `with db.connect() as conn:` as with sqlite3.connect() (commit on success, rollback on
+    error), but never close the returned connection. `immediate()` wraps a BEGIN IMMEDIATE
+    transaction for read-modify-write sequences shared with other processes.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        s = get_settings()
+        self.busy_timeout_ms = max(0, getattr(s, "sqlite_busy_timeout_ms", 30000))
+        self.journal_mode = (getattr(s, "sqlite_journal_mode", "WAL") or "WAL").upper()
+        self.synchronous = (getattr(s, "sqlite_synchronous", "NORMAL") or "NORMAL").upper()
+        self.cache_kb = max(0, getattr(s, "sqlite_cache_kb", 20000))
+        self._local = threading.local()
+        self._migrate_lock = threading.Lock()
+        self._schema_version: int | None = None
+
+    def _open(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, timeout=self.busy_timeout_ms / 1000.0, cached_statements=256, check_same_thread=check_same_thread
+        )
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        # 仅对尚未建表的新库生效；旧库需显式调用 POST /logs/prune?vacuum=true 执行一次 VACUUM 转换
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # journal_mode=WAL 写入数据库文件头，对所有连接持久生效；读写互不阻塞
+        conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_kb)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def connect(self) -> sqlite3.Connection:
+        """This thread's connection (re-opened after fork)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._open()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def immediate(self) -> Iterator[sqlite3.Connection]:
+        """BEGIN IMMEDIATE transaction on this thread's connection; commits or rolls back on exit."""
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Dedicated connection for a long read whose iteration may move between threads (streamed exports)."""
+        conn = self._open(check_same_thread=False)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def migrate(self) -> int:
+        """Apply pending schema migrations (core.migrations) once per process."""
+        with self._migrate_lock:
+            if self._schema_version is None:
+                from core import migrations
+
+                self._schema_version = migrations.run(self.connect())
+        return self._schema_version
+
+    def close(self) -> None:
+        """Close this thread's connection (other threads keep theirs)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
+
+_DATABASES: Dict[str, Database] = {}
+_DATABASES_LOCK = threading.Lock()
+
+
+def get_database(path: Path) -> Database:
+    """Shared Database for a file, so all stores on data.db use the same per-thread connections."""
+    key = str(Path(path).resolve())
+    with _DATABASES_LOCK:
+        db = _DATABASES.get(key)
+        if db is None:
+            db = _DATABASES[key] = Database(Path(path))
+        return db
@@ -5,6 +5,7 @@ import sqlite3
 from pathlib import Path
 from typing import Dict, Any
 
+from core.db import get_database
 from core.settings import Settings, get_settings
 
 
@@ -14,15 +15,9 @@ class ConfigStore:
     def __init__(self, db_path: Path, defaults: Settings | None = None):
         self.db_path = db_path
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = get_database(db_path)
         self.defaults = defaults or get_settings()
-        self._ensure_schema()
-
-    def _ensure_schema(self) -> None:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                "CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)"
-            )
-            conn.commit()
+        self.db.migrate()
 
     def get(self) -> Dict[str, Any]:
         cfg: Dict[str, Any] = {
@@ -39,7 +34,7 @@ class ConfigStore:
             "project_name": getattr(self.defaults, "project_name", ""),
             "local_agent_path": None,
         }
-        with sqlite3.connect(self.db_path) as conn:
+        with self.db.connect() as conn:
             rows = conn.execute("SELECT key, value FROM config").fetchall()
         for k, v in rows:
             try:
@@ -49,7 +44,7 @@ class ConfigStore:
         return cfg
 
     def set(self, data: Dict[str, Any]) -> Dict[str, Any]:
-        with sqlite3.connect(self.db_path) as conn:
+        with self.db.connect() as conn:
             for k, v in data.items():
                 conn.execute(
                     "REPLACE INTO config(key, value) VALUES (?, ?)", (k, json.dumps(v))
@@ -56,7 +56,11 @@ def _migrate_legacy_dbs():
         try:
             with sqlite3.connect(DB_PATH) as dest:
                 dest.execute(f"ATTACH DATABASE '{src}' AS legacy")
-                dest.execute(f"INSERT OR REPLACE INTO {table} SELECT * FROM legacy.{table}")
+                # 按同名列复制，新库新增的列（如 install_logs.codec）保持默认值
+                ours = [r[1] for r in dest.execute(f"PRAGMA main.table_info({table})")]
+                theirs = {r[1] for r in dest.execute(f"PRAGMA legacy.table_info({table})")}
+                cols = ", ".join(c for c in ours if c in theirs)
+                dest.execute(f"INSERT OR REPLACE INTO {table}({cols}) SELECT {cols} FROM legacy.{table}")
                 dest.execute("DETACH DATABASE legacy")
                 dest.commit()
         except Exception:
@@ -65,8 +69,16 @@ def _migrate_legacy_dbs():
 
     copy_table(LEGACY_DBS["config"], "config")
     copy_table(LEGACY_DBS["logs"], "install_logs")
+    log_store = LogStore(DB_PATH)
+    log_store.rebuild_summaries()
+    log_store.rebuild_search_index()
     for tbl in ["batches", "batch_results", "batch_queue"]:
         copy_table(LEGACY_DBS["batches"], tbl)
+    batch_store = BatchStore(DB_PATH)
+    # 迁移已在建库时执行过，复制进来的旧数据需要单独拆分/回填
+    with batch_store.db.connect() as conn:
+        BatchStore.split_legacy_batches(conn)
+    batch_store.rebuild_latest_results()
 
 
 _migrate_legacy_dbs()
@@ -75,8 +87,10 @@ CONFIG_STORE = ConfigStore(DB_PATH, defaults=SETTINGS)
 ZABBIX_SERVICE = ZabbixService(config_store=CONFIG_STORE)
 TASKS = TaskStore()
 LOG_STORE = LogStore(DB_PATH)
+LOG_STORE.start_retention()
 BATCH_STORE = BatchStore(DB_PATH)
-BATCH_WORKER = BatchWorker(ZABBIX_SERVICE, LOG_STORE, BATCH_STORE)
+# BATCH_WORKER_MODE=off：API 进程只负责入队，由独立 worker 进程（python -m tasks.worker）执行
+BATCH_WORKER = BatchWorker(ZABBIX_SERVICE, LOG_STORE, BATCH_STORE) if SETTINGS.batch_worker_mode != "off" else None
 
 
 def get_settings_dep():
@@ -1,48 +1,210 @@
 from __future__ import annotations
 
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import re
 import sqlite3
+import threading
 import time
+import zlib
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional
+
+from core.db import get_database
+from core.settings import get_settings
+
+LOG = logging.getLogger(__name__)
+
+LOG_COLUMNS = ("task_id", "step", "status", "message", "ip", "hostname", "host_id", "zabbix_url", "ts")
+# add() 入队的行格式（与 _INSERT_SQL 去掉 codec 后一致），用于写入死信文件
+_ROW_KEYS = ("task_id", "name", "step", "status", "message", "ip", "hostname", "host_id", "zabbix_url", "ts")
+
+_INSERT_SQL = """
+    INSERT INTO install_logs(task_id, name, step, status, message, ip, hostname, host_id, zabbix_url, ts, codec)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# message 编码：NULL 为原文；zlib 为压缩后的 BLOB；blob 时 message 存 sha1，正文在 log_blobs
+_CODEC_ZLIB = "zlib"
+_CODEC_BLOB = "blob"
+
+_SELECT_LOGS = """
+    SELECT l.task_id, l.step, l.status, l.message, l.ip, l.hostname, l.host_id, l.zabbix_url, l.ts, l.codec, b.data
+    FROM install_logs l
+    LEFT JOIN log_blobs b ON l.codec = 'blob' AND b.hash = l.message
+"""
+
+
+def _decode_message(message: Any, codec: str | None, blob: bytes | None) -> Any:
+    if codec == _CODEC_ZLIB:
+        return zlib.decompress(message).decode("utf-8")
+    if codec == _CODEC_BLOB:
+        return zlib.decompress(blob).decode("utf-8") if blob is not None else None
+    return message
+
+
+# 全文检索返回的摘要窗口（字符）
+_SNIPPET_CHARS = 160
+
+
+def _fts_query(query: str) -> str:
+    """Turn user input into an FTS5 query: "quoted text" is a phrase, other words are ANDed terms."""
+    parts = [m.group(1) or m.group(2) for m in re.finditer(r'"([^"]+)"|(\S+)', query)]
+    return " ".join('"' + p.replace('"', '""') + '"' for p in parts if p)
+
+
+def _snippet(text: str | None, query: str) -> str | None:
+    if not text:
+        return text
+    lower = text.lower()
+    terms = [m.group(1) or m.group(2) for m in re.finditer(r'"([^"]+)"|(\S+)', query)]
+    hits = [pos for pos in (lower.find(t.lower()) for t in terms if t) if pos >= 0]
+    start = max(0, min(hits) - _SNIPPET_CHARS // 4) if hits else 0
+    end = start + _SNIPPET_CHARS
+    return ("…" if start else "") + text[start:end] + ("…" if end < len(text) else "")
+
+
+def _row_to_log(r: tuple) -> Dict[str, Any]:
+    """Map a _SELECT_LOGS row to the API dict, decoding the message."""
+    log = dict(zip(LOG_COLUMNS, r[:9]))
+    log["message"] = _decode_message(r[3], r[9], r[10])
+    return log
+
+
+# 汇总行按写入顺序合并：时间取最早/最晚，最后步骤与状态取最新，ip/hostname 等取最新的非空值
+_SUMMARY_SQL = """
+    INSERT INTO task_summaries(task_id, first_ts, last_ts, last_step, last_status, ip, hostname, host_id, zabbix_url, steps, failed_steps)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(task_id) DO UPDATE SET
+        first_ts = MIN(first_ts, excluded.first_ts),
+        last_ts = MAX(last_ts, excluded.last_ts),
+        last_step = excluded.last_step,
+        last_status = excluded.last_status,
+        ip = COALESCE(excluded.ip, ip),
+        hostname = COALESCE(excluded.hostname, hostname),
+        host_id = COALESCE(excluded.host_id, host_id),
+        zabbix_url = COALESCE(excluded.zabbix_url, zabbix_url),
+        steps = steps + excluded.steps,
+        failed_steps = failed_steps + excluded.failed_steps
+"""
 
 
 class LogStore:
-    """SQLite-based install/uninstall log storage."""
+    """SQLite-based install/uninstall log storage.
+
+    With LOG_ASYNC (default) add() only queues the row; a writer thread inserts queued rows in one
+    transaction per LOG_FLUSH_SIZE rows or LOG_FLUSH_MS. At most LOG_BUFFER_MAX rows are held in
+    memory; when the buffer is full, add() blocks until the writer catches up. Every read flushes
+    the queue first, so readers always see their own writes. close() (also run at exit) writes
+    out whatever is still queued. A failed flush is retried LOG_FLUSH_RETRIES times; then the rows
+    are written one by one and those that still fail are appended to LOG_DEAD_LETTER, so a
+    persistent error never blocks add() or makes reads fail.
+
+    prune() applies LOG_RETENTION_DAYS / LOG_RETENTION_ROWS per task, a few tasks per transaction,
+    and returns freed pages with incremental_vacuum. With LOG_ARCHIVE_DIR the expired tasks are
+    first appended to install_logs-YYYY-MM.jsonl.gz, one gzip member per chunk; their summary row
+    is kept, marked "file#offset" of that member, and get() decompresses only that member.
+
+    Messages of LOG_COMPRESS_MIN_BYTES or more are stored zlib-compressed (`codec` column); with
+    LOG_DEDUP identical ones are kept once in `log_blobs` (keyed by sha1) and shared by all rows.
+    Decoding is transparent to get(); older plain rows are read unchanged.
+
+    When SQLite has FTS5, step and decoded message of every row are also indexed in the
+    contentless `install_logs_fts` table (rowid = install_logs.id) for search().
+    """
 
-    def __init__(self, db_path: Path):
+    def __init__(self, db_path: Path, buffered: bool | None = None):
         self.db_path = db_path
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        self._ensure_schema()
+        self.db = get_database(db_path)
+        self.db.migrate()
+        with self.db.connect() as conn:
+            self._fts = bool(
+                conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='install_logs_fts'").fetchone()
+            )
+        s = get_settings()
+        self._buffered = bool(getattr(s, "log_async", False)) if buffered is None else buffered
+        self._flush_size = max(1, getattr(s, "log_flush_size", 200))
+        self._flush_interval = max(1, getattr(s, "log_flush_ms", 50)) / 1000.0
+        self._max_pending = max(self._flush_size, getattr(s, "log_buffer_max", 10000))
+        self._compress_min = max(0, getattr(s, "log_compress_min_bytes", 0))
+        self._dedup = bool(getattr(s, "log_dedup", False))
+        self._flush_retries = max(1, getattr(s, "log_flush_retries", 3))
+        self._dead_letter = getattr(s, "log_dead_letter", "") or ""
+        self._flush_failures = 0
+        self._pending: List[tuple] = []
+        # 同一把锁上的两个条件：写线程等待数据，生产者在缓冲满时等待空位
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._writer = None
+        self._archive_lock = threading.Lock()
+        self._retention_stop = threading.Event()
+        self._retention_thread = None
+        self._vacuum_hinted = False
+        if self._buffered:
+            self._writer = threading.Thread(target=self._writer_loop, name="log-writer", daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
 
-    def _ensure_schema(self) -> None:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS install_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    task_id TEXT,
-                    name TEXT,
-                    step TEXT,
-                    status TEXT,
-                    message TEXT,
-                    ip TEXT,
-                    hostname TEXT,
-                    host_id TEXT,
-                    zabbix_url TEXT,
-                    ts INTEGER
-                )
-                """
+    @staticmethod
+    def backfill_summaries(conn: sqlite3.Connection) -> None:
+        """Insert one task_summaries row per task_id found in install_logs."""
+        conn.execute(
+            """
+            INSERT INTO task_summaries(task_id, first_ts, last_ts, last_step, last_status, ip, hostname, host_id, zabbix_url, steps, failed_steps)
+            SELECT g.task_id, g.first_ts, g.last_ts, last.step, last.status, g.ip, g.hostname, g.host_id, g.zabbix_url, g.steps, g.failed_steps
+            FROM (
+                SELECT task_id, MIN(ts) AS first_ts, MAX(ts) AS last_ts, MAX(id) AS last_id,
+                       MAX(ip) AS ip, MAX(hostname) AS hostname, MAX(host_id) AS host_id, MAX(zabbix_url) AS zabbix_url,
+                       COUNT(*) AS steps, SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END) AS failed_steps
+                FROM install_logs
+                WHERE task_id IS NOT NULL
+                GROUP BY task_id
+            ) g
+            JOIN install_logs last ON last.id = g.last_id
+            """
+        )
+
+    def rebuild_summaries(self) -> None:
+        """Recompute task_summaries from install_logs (after rows were copied in directly)."""
+        self.flush()
+        with self.db.connect() as conn:
+            conn.execute("DELETE FROM task_summaries")
+            self.backfill_summaries(conn)
+
+    @staticmethod
+    def backfill_search_index(conn: sqlite3.Connection) -> None:
+        """Index every install_logs row in install_logs_fts (messages decoded in Python)."""
+        cur = conn.execute(
+            """
+            SELECT l.id, l.step, l.message, l.codec, b.data
+            FROM install_logs l LEFT JOIN log_blobs b ON l.codec = 'blob' AND b.hash = l.message
+            ORDER BY l.id
+            """
+        )
+        while True:
+            chunk = cur.fetchmany(1000)
+            if not chunk:
+                break
+            conn.executemany(
+                "INSERT INTO install_logs_fts(rowid, step, message) VALUES (?, ?, ?)",
+                [(r[0], r[1], _decode_message(r[2], r[3], r[4])) for r in chunk],
             )
-            # 兼容旧库，补齐 host_id / zabbix_url 列
-            cols = [row[1] for row in conn.execute("PRAGMA table_info(install_logs)").fetchall()]
-            if "host_id" not in cols:
-                conn.execute("ALTER TABLE install_logs ADD COLUMN host_id TEXT")
-            if "zabbix_url" not in cols:
-                conn.execute("ALTER TABLE install_logs ADD COLUMN zabbix_url TEXT")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_task ON install_logs(task_id)")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_host ON install_logs(host_id)")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_url ON install_logs(zabbix_url)")
-            conn.commit()
+
+    def rebuild_search_index(self) -> None:
+        """Re-index all of install_logs (after rows were copied in directly)."""
+        if not self._fts:
+            return
+        self.flush()
+        with self.db.connect() as conn:
+            conn.execute("INSERT INTO install_logs_fts(install_logs_fts) VALUES ('delete-all')")
+            self.backfill_search_index(conn)
 
     def add(
         self,
@@ -56,41 +218,170 @@ class LogStore:
         host_id: str | None = None,
         zabbix_url: str | None = None,
     ) -> None:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                """
-                INSERT INTO install_logs(task_id, name, step, status, message, ip, hostname, host_id, zabbix_url, ts)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (task_id, name, step, status, message, ip, hostname, host_id, zabbix_url, int(time.time())),
-            )
-            conn.commit()
+        # ts 在入队时取值，批量落库不影响步骤耗时统计
+        row = (task_id, name, step, status, message, ip, hostname, host_id, zabbix_url, int(time.time()))
+        if not self._buffered:
+            self._write([row])
+            return
+        with self._lock:
+            while len(self._pending) >= self._max_pending and not self._closed:
+                # 背压：缓冲已满，等待写线程落库
+                self._not_empty.notify()
+                self._not_full.wait(0.5)
+            self._pending.append(row)
+            closed = self._closed
+            if not closed and (len(self._pending) == 1 or len(self._pending) >= self._flush_size):
+                self._not_empty.notify()
+        if closed:
+            # 写线程已停止（进程退出中）：同步写入
+            self.flush()
+
+    def _write(self, rows: List[tuple]) -> None:
+        # 日志行与对应的 task_summaries 在同一事务内更新
+        summaries: Dict[str, list] = {}
+        for task_id, _, step, status, _, ip, hostname, host_id, zabbix_url, ts in rows:
+            if task_id is None:
+                continue
+            cur = summaries.get(task_id)
+            if cur is None:
+                summaries[task_id] = [task_id, ts, ts, step, status, ip, hostname, host_id, zabbix_url, 1, int(status == "failed")]
+                continue
+            cur[1], cur[2], cur[3], cur[4] = min(cur[1], ts), max(cur[2], ts), step, status
+            cur[5], cur[6], cur[7], cur[8] = ip or cur[5], hostname or cur[6], host_id or cur[7], zabbix_url or cur[8]
+            cur[9] += 1
+            cur[10] += int(status == "failed")
+        encoded, blobs = self._encode_rows(rows)
+        with self.db.connect() as conn:
+            if blobs:
+                conn.executemany("INSERT OR IGNORE INTO log_blobs(hash, data, size) VALUES (?, ?, ?)", blobs)
+            if self._fts:
+                # 逐行插入取 lastrowid 作为索引 rowid；索引写入压缩前的原文
+                ids = [conn.execute(_INSERT_SQL, row).lastrowid for row in encoded]
+                conn.executemany(
+                    "INSERT INTO install_logs_fts(rowid, step, message) VALUES (?, ?, ?)",
+                    [(rowid, row[2], row[4]) for rowid, row in zip(ids, rows)],
+                )
+            else:
+                conn.executemany(_INSERT_SQL, encoded)
+            conn.executemany(_SUMMARY_SQL, list(summaries.values()))
+
+    def _encode_rows(self, rows: List[tuple]) -> tuple:
+        """Append the codec to every row, compressing large messages; returns (rows, log_blobs rows)."""
+        encoded: List[tuple] = []
+        blobs: Dict[str, tuple] = {}
+        for row in rows:
+            message = row[4]
+            if not self._compress_min or not isinstance(message, str) or len(message) < self._compress_min:
+                encoded.append(row + (None,))
+                continue
+            raw = message.encode("utf-8")
+            packed = zlib.compress(raw, 6)
+            if self._dedup:
+                digest = hashlib.sha1(raw).hexdigest()
+                blobs[digest] = (digest, sqlite3.Binary(packed), len(raw))
+                encoded.append(row[:4] + (digest,) + row[5:] + (_CODEC_BLOB,))
+            elif len(packed) < len(raw):
+                encoded.append(row[:4] + (sqlite3.Binary(packed),) + row[5:] + (_CODEC_ZLIB,))
+            else:
+                encoded.append(row + (None,))
+        return encoded, list(blobs.values())
+
+    def _writer_loop(self) -> None:
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._not_empty.wait()
+                if self._closed:
+                    return
+                if len(self._pending) < self._flush_size:
+                    # 攒批：等待凑满一批或超时
+                    self._not_empty.wait(self._flush_interval)
+            if not self.flush():
+                time.sleep(self._flush_interval)
+
+    def flush(self) -> bool:
+        """Write all queued rows now (one transaction); returns False if the write failed.
+
+        Never raises: failed rows are re-queued until LOG_FLUSH_RETRIES is reached, then
+        written row by row and the remaining ones dead-lettered.
+        """
+        if not self._buffered:
+            return True
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+                self._not_full.notify_all()
+            if not rows:
+                return True
+            try:
+                self._write(rows)
+                self._flush_failures = 0
+                return True
+            except Exception as exc:
+                self._flush_failures += 1
+                if self._flush_failures < self._flush_retries:
+                    LOG.warning("flush install logs failed (%d/%d): %s", self._flush_failures, self._flush_retries, exc)
+                    with self._lock:
+                        self._pending[:0] = rows
+                    return False
+                LOG.error("flush install logs failed %d times: %s", self._flush_failures, exc)
+                self._flush_failures = 0
+                self._write_each(rows)
+                return False
+
+    def _write_each(self, rows: List[tuple]) -> None:
+        """Last resort after repeated flush failures: write rows singly, dead-letter the failures."""
+        failed: List[tuple] = []
+        for row in rows:
+            try:
+                self._write([row])
+            except Exception:
+                failed.append(row)
+        if not failed:
+            return
+        if self._dead_letter:
+            path = self._resolve(self._dead_letter)
+            try:
+                with path.open("a", encoding="utf-8") as fh:
+                    for row in failed:
+                        fh.write(json.dumps(dict(zip(_ROW_KEYS, row)), ensure_ascii=False, default=str) + "\n")
+                LOG.error("wrote %d install log rows to dead-letter file %s", len(failed), path)
+                return
+            except OSError as exc:
+                LOG.error("dead-letter file %s not writable: %s", path, exc)
+        LOG.error("dropped %d install log rows that could not be written", len(failed))
+
+    def close(self) -> None:
+        """Stop the writer thread and write out everything still queued."""
+        self._retention_stop.set()
+        if not self._buffered or self._closed:
+            return
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        if self._writer and self._writer is not threading.current_thread():
+            self._writer.join(timeout=5)
+        # 写线程已停止：重试到上限后失败的行进入死信文件，队列一定会清空
+        for _ in range(self._flush_retries):
+            if self.flush():
+                break
 
     def get(self, task_id: str) -> List[Dict[str, Any]]:
-        with sqlite3.connect(self.db_path) as conn:
-            rows = conn.execute(
-                "SELECT task_id, step, status, message, ip, hostname, host_id, zabbix_url, ts FROM install_logs WHERE task_id=? ORDER BY id",
-                (task_id,),
-            ).fetchall()
-        return [
-            {
-                "task_id": r[0],
-                "step": r[1],
-                "status": r[2],
-                "message": r[3],
-                "ip": r[4],
-                "hostname": r[5],
-                "host_id": r[6],
-                "zabbix_url": r[7],
-                "ts": r[8],
-            }
-            for r in rows
-        ]
+        self.flush()
+        with self.db.connect() as conn:
+            rows = conn.execute(_SELECT_LOGS + " WHERE l.task_id=? ORDER BY l.id", (task_id,)).fetchall()
+            archived = conn.execute("SELECT archive FROM task_summaries WHERE task_id=?", (task_id,)).fetchone()
+        logs = [_row_to_log(r) for r in rows]
+        if archived and archived[0]:
+            # 已归档任务：按需从月份归档文件读取
+            logs = self._read_archive(task_id, archived[0]) + logs
+        return logs
 
     def list_recent(self, limit: int = 50, hostname: str | None = None, ip: str | None = None, host_id: str | None = None, zabbix_url: str | None = None) -> List[Dict[str, Any]]:
         """Return recent task summaries (one row per task_id), optionally filtered by hostname/ip/host_id/zabbix_url."""
         where = []
-        params = []
+        params: List[Any] = []
         if hostname:
             where.append("hostname = ?")
             params.append(hostname)
@@ -105,24 +396,395 @@ class LogStore:
             params.append(zabbix_url)
         where_sql = ("WHERE " + " AND ".join(where)) if where else ""
         params.append(limit)
-        with sqlite3.connect(self.db_path) as conn:
+        self.flush()
+        with self.db.connect() as conn:
             rows = conn.execute(
                 f"""
-                SELECT task_id,
-                       MAX(ts) as ts,
-                       MAX(ip) as ip,
-                       MAX(hostname) as hostname,
-                       MAX(host_id) as host_id,
-                       MAX(zabbix_url) as zabbix_url
-                FROM install_logs
+                SELECT task_id, last_ts, ip, hostname, host_id, zabbix_url, first_ts, last_step, last_status, steps, failed_steps, archive
+                FROM task_summaries
                 {where_sql}
-                GROUP BY task_id
-                ORDER BY ts DESC
+                ORDER BY last_ts DESC
                 LIMIT ?
                 """,
                 tuple(params),
             ).fetchall()
         return [
-            {"task_id": r[0], "ts": r[1], "ip": r[2], "hostname": r[3], "host_id": r[4], "zabbix_url": r[5]}
+            {
+                "task_id": r[0],
+                "ts": r[1],
+                "ip": r[2],
+                "hostname": r[3],
+                "host_id": r[4],
+                "zabbix_url": r[5],
+                "first_ts": r[6],
+                "last_step": r[7],
+                "status": r[8],
+                "steps": r[9],
+                "failed_steps": r[10],
+                "archived": bool(r[11]),
+            }
             for r in rows
         ]
+
+    def step_timings(self, final_step: str, limit: int = 500) -> Dict[str, Any]:
+        """Durations (seconds) of the last `limit` tasks that reached final_step ok.
+
+        Returns {"tasks": [per-task duration], "steps": {step: [durations]}}; a step's duration is
+        the gap to the previous log row of the same task (rows are written when a step ends).
+        """
+        self.flush()
+        with self.db.connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT task_id, step, ts FROM install_logs
+                WHERE task_id IN (
+                    SELECT task_id FROM install_logs WHERE step = ? AND status = 'ok' ORDER BY id DESC LIMIT ?
+                )
+                ORDER BY task_id, id
+                """,
+                (final_step, limit),
+            ).fetchall()
+        tasks: List[int] = []
+        steps: Dict[str, List[int]] = {}
+        current, lo, hi, prev = None, 0, 0, 0
+        for task_id, step, ts in rows:
+            ts = ts or 0
+            if task_id != current:
+                if current is not None:
+                    tasks.append(hi - lo)
+                current, lo, hi, prev = task_id, ts, ts, ts
+                continue
+            steps.setdefault(step, []).append(max(0, ts - prev))
+            lo, hi, prev = min(lo, ts), max(hi, ts), ts
+        if current is not None:
+            tasks.append(hi - lo)
+        return {"tasks": tasks, "steps": steps}
+
+    # -------------------- retention -------------------- #
+    def _resolve(self, path: str | Path) -> Path:
+        path = Path(path)
+        return path if path.is_absolute() else self.db_path.parent / path
+
+    def _append_archive(self, archive_dir: str, conn: sqlite3.Connection, tasks: List[tuple]) -> Dict[str, str]:
+        """Append the rows of `tasks` [(task_id, first_ts)] to their month files; returns task_id -> "file#offset"."""
+        ids = [t[0] for t in tasks]
+        marks = ",".join("?" * len(ids))
+        rows = conn.execute(_SELECT_LOGS + f" WHERE l.task_id IN ({marks}) ORDER BY l.id", ids).fetchall()
+        by_task: Dict[str, List[Dict[str, Any]]] = {}
+        for r in rows:
+            by_task.setdefault(r[0], []).append(_row_to_log(r))
+        files: Dict[str, str] = {}
+        lines: Dict[str, List[str]] = {}
+        for task_id, first_ts in tasks:
+            # 记录写入时的文件路径（相对 data.db 所在目录），修改 LOG_ARCHIVE_DIR 后旧归档仍可读取
+            name = str(Path(archive_dir) / f"install_logs-{time.strftime('%Y-%m', time.localtime(first_ts or 0))}.jsonl.gz")
+            files[task_id] = name
+            # 每个任务一行，task_id 放在行首，读取时无需逐行解析 JSON
+            lines.setdefault(name, []).append(json.dumps({"task_id": task_id, "rows": by_task.get(task_id, [])}, ensure_ascii=False))
+        offsets: Dict[str, int] = {}
+        with self._archive_lock:
+            for name, chunk in lines.items():
+                path = self._resolve(name)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # 每个 chunk 追加为一个独立的 gzip member，记录其起始偏移，读取时直接 seek
+                with path.open("ab") as fh:
+                    offsets[name] = fh.tell()
+                    fh.write(gzip.compress(("\n".join(chunk) + "\n").encode("utf-8")))
+        return {task_id: f"{name}#{offsets[name]}" for task_id, name in files.items()}
+
+    @staticmethod
+    def _read_member(path: Path, offset: int) -> List[str]:
+        """Decompress the single gzip member starting at `offset`."""
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        parts: List[bytes] = []
+        with path.open("rb") as fh:
+            fh.seek(offset)
+            while not inflater.eof:
+                data = fh.read(64 * 1024)
+                if not data:
+                    break
+                parts.append(inflater.decompress(data))
+        return b"".join(parts).decode("utf-8").splitlines()
+
+    def _read_archive(self, task_id: str, ref: str) -> List[Dict[str, Any]]:
+        name, sep, offset = ref.rpartition("#")
+        if not sep or not offset.isdigit():
+            name, offset = ref, ""
+        path = self._resolve(name)
+        if not path.exists():
+            LOG.warning("log archive %s for task %s is missing", path, task_id)
+            return []
+        prefix = '{"task_id": ' + json.dumps(task_id, ensure_ascii=False) + ","
+        found: List[Dict[str, Any]] = []
+        if offset:
+            # member 写完后才记录偏移，读取无需加锁
+            lines = self._read_member(path, int(offset))
+        else:
+            # 旧格式（仅记录文件名）：整文件解压扫描；加锁避免读到正在追加的 member
+            with self._archive_lock, gzip.open(path, "rt", encoding="utf-8") as fh:
+                lines = [line for line in fh if line.startswith(prefix)]
+        for line in lines:
+            if line.startswith(prefix):
+                found.extend(json.loads(line)["rows"])
+        return [{k: r.get(k) for k in LOG_COLUMNS} for r in found]
+
+    def convert_incremental_vacuum(self) -> bool:
+        """Switch an old database to auto_vacuum=INCREMENTAL with one full VACUUM; False if already converted.
+
+        VACUUM rewrites the whole file under an exclusive lock, blocking log writes and batch
+        workers until it finishes, so this only runs when asked for (POST /logs/prune?vacuum=true).
+        """
+        self.flush()
+        conn = self.db.connect()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        LOG.warning("converting %s to auto_vacuum=INCREMENTAL (one-time VACUUM)", self.db_path)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+
+    def _expired_tasks(self, conn: sqlite3.Connection, retention_days: int, max_rows: int) -> List[tuple]:
+        """Tasks still in install_logs that fall outside the retention limits, oldest first."""
+        expired: Dict[str, tuple] = {}
+        if retention_days > 0:
+            cutoff = int(time.time()) - retention_days * 86400
+            for task_id, first_ts, steps in conn.execute(
+                "SELECT task_id, first_ts, steps FROM task_summaries WHERE archive IS NULL AND last_ts < ? ORDER BY last_ts",
+                (cutoff,),
+            ):
+                expired[task_id] = (task_id, first_ts, steps)
+        if max_rows > 0:
+            total = conn.execute("SELECT COALESCE(SUM(steps), 0) FROM task_summaries WHERE archive IS NULL").fetchone()[0]
+            remaining = total - sum(t[2] for t in expired.values())
+            if remaining > max_rows:
+                for task_id, first_ts, steps in conn.execute(
+                    "SELECT task_id, first_ts, steps FROM task_summaries WHERE archive IS NULL ORDER BY last_ts"
+                ):
+                    if remaining <= max_rows:
+                        break
+                    if task_id not in expired:
+                        expired[task_id] = (task_id, first_ts, steps)
+                        remaining -= steps or 0
+        return [(t[0], t[1]) for t in expired.values()]
+
+    def prune(
+        self,
+        retention_days: Optional[int] = None,
+        max_rows: Optional[int] = None,
+        archive_dir: Optional[str] = None,
+        chunk: Optional[int] = None,
+        vacuum: bool = False,
+    ) -> Dict[str, Any]:
+        """Apply log retention (defaults from LOG_RETENTION_* / LOG_ARCHIVE_DIR settings).
+
+        Whole tasks are removed, `chunk` tasks per transaction, so writers are never blocked for
+        long; freed pages are returned to the filesystem after every chunk. A database created
+        before auto_vacuum=INCREMENTAL only reuses freed pages internally until it is converted
+        with vacuum=True (convert_incremental_vacuum()).
+        """
+        s = get_settings()
+        retention_days = s.log_retention_days if retention_days is None else retention_days
+        max_rows = s.log_retention_rows if max_rows is None else max_rows
+        archive_dir = s.log_archive_dir if archive_dir is None else archive_dir
+        chunk = max(1, s.log_prune_chunk if chunk is None else chunk)
+        report: Dict[str, Any] = {"tasks": 0, "rows": 0, "archived": 0}
+        if vacuum:
+            report["vacuumed"] = self.convert_incremental_vacuum()
+        if retention_days <= 0 and max_rows <= 0:
+            return report
+        started = time.monotonic()
+        self.flush()
+        conn = self.db.connect()
+        with conn:
+            expired = self._expired_tasks(conn, retention_days, max_rows)
+        if not expired:
+            return report
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2 and not self._vacuum_hinted:
+            self._vacuum_hinted = True
+            LOG.warning(
+                "%s is not auto_vacuum=INCREMENTAL: pruned pages are reused but the file does not shrink; "
+                "run POST /logs/prune?vacuum=true once to convert it",
+                self.db_path,
+            )
+        for i in range(0, len(expired), chunk):
+            if self._retention_stop.is_set() and self._retention_thread is threading.current_thread():
+                break
+            tasks = expired[i:i + chunk]
+            ids = [t[0] for t in tasks]
+            marks = ",".join("?" * len(ids))
+            # 先写归档再删库：中途失败最多产生重复归档，不会丢日志
+            files = self._append_archive(archive_dir, conn, tasks) if archive_dir else {}
+            with conn:
+                if self._fts:
+                    self._unindex(conn, ids)
+                deleted = conn.execute(f"DELETE FROM install_logs WHERE task_id IN ({marks})", ids).rowcount
+                if files:
+                    conn.executemany("UPDATE task_summaries SET archive=? WHERE task_id=?", [(files[t], t) for t in ids])
+                else:
+                    conn.execute(f"DELETE FROM task_summaries WHERE task_id IN ({marks})", ids)
+            conn.execute("PRAGMA incremental_vacuum").fetchall()
+            report["tasks"] += len(ids)
+            report["rows"] += max(0, deleted)
+            report["archived"] += len(files)
+        if report["rows"]:
+            with conn:
+                # 删除不再被任何日志行引用的共享正文
+                report["blobs"] = conn.execute(
+                    "DELETE FROM log_blobs WHERE NOT EXISTS "
+                    "(SELECT 1 FROM install_logs l WHERE l.codec = 'blob' AND l.message = log_blobs.hash)"
+                ).rowcount
+            conn.execute("PRAGMA incremental_vacuum").fetchall()
+        report["ms"] = int((time.monotonic() - started) * 1000)
+        LOG.info("install_logs retention: %s", report)
+        return report
+
+    @staticmethod
+    def _unindex(conn: sqlite3.Connection, task_ids: List[str]) -> None:
+        """Remove the rows of task_ids from the contentless FTS index (needs the indexed values)."""
+        marks = ",".join("?" * len(task_ids))
+        rows = conn.execute(
+            f"""
+            SELECT l.id, l.step, l.message, l.codec, b.data
+            FROM install_logs l LEFT JOIN log_blobs b ON l.codec = 'blob' AND b.hash = l.message
+            WHERE l.task_id IN ({marks})
+            """,
+            task_ids,
+        ).fetchall()
+        conn.executemany(
+            "INSERT INTO install_logs_fts(install_logs_fts, rowid, step, message) VALUES ('delete', ?, ?, ?)",
+            [(r[0], r[1], _decode_message(r[2], r[3], r[4])) for r in rows],
+        )
+
+    def start_retention(self) -> None:
+        """Run prune() every LOG_PRUNE_INTERVAL_S in a background thread (no-op without retention limits)."""
+        s = get_settings()
+        if (s.log_retention_days <= 0 and s.log_retention_rows <= 0) or self._retention_thread:
+            return
+        interval = max(60, s.log_prune_interval_s)
+
+        def _loop():
+            while not self._retention_stop.is_set():
+                try:
+                    self.prune()
+                except Exception as exc:
+                    LOG.exception("install_logs retention failed: %s", exc)
+                self._retention_stop.wait(interval)
+
+        self._retention_thread = threading.Thread(target=_loop, name="log-retention", daemon=True)
+        self._retention_thread.start()
+
+    # -------------------- export -------------------- #
+    def iter_logs(
+        self,
+        since: int | None = None,
+        until: int | None = None,
+        status: str | None = None,
+        task_id: str | None = None,
+        batch_id: str | None = None,
+        chunk: int = 1000,
+    ) -> Iterator[Dict[str, Any]]:
+        """Yield install_logs rows in id order, fetching `chunk` rows at a time (for streamed exports)."""
+        where: List[str] = []
+        params: List[Any] = []
+        if since is not None:
+            where.append("l.ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("l.ts <= ?")
+            params.append(until)
+        if status:
+            where.append("l.status = ?")
+            params.append(status)
+        if task_id:
+            where.append("l.task_id = ?")
+            params.append(task_id)
+        if batch_id:
+            where.append("l.task_id IN (SELECT task_id FROM batch_results WHERE batch_id = ? AND task_id IS NOT NULL)")
+            params.append(batch_id)
+        where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+        self.flush()
+        with self.db.reader() as conn:
+            cur = conn.execute(_SELECT_LOGS + f" {where_sql} ORDER BY l.id", params)
+            while True:
+                rows = cur.fetchmany(chunk)
+                if not rows:
+                    break
+                for r in rows:
+                    yield _row_to_log(r)
+
+    # -------------------- search -------------------- #
+    def search(
+        self,
+        query: str,
+        since: int | None = None,
+        until: int | None = None,
+        status: str | None = None,
+        step: str | None = None,
+        limit: int = 50,
+        offset: int = 0,
+        raw: bool = False,
+    ) -> Dict[str, Any]:
+        """Ranked (bm25) full-text search over step/message of install_logs still in the database.
+
+        `query` is split into ANDed terms ("quoted text" = phrase); with raw=True it is passed to
+        FTS5 MATCH unchanged. Raises RuntimeError without FTS5 and sqlite3.OperationalError for an
+        invalid raw query.
+        """
+        if not self._fts:
+            raise RuntimeError("SQLite FTS5 is not available")
+        match = query if raw else _fts_query(query)
+        where = ["install_logs_fts MATCH ?"]
+        params: List[Any] = [match]
+        if since is not None:
+            where.append("l.ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("l.ts <= ?")
+            params.append(until)
+        if status:
+            where.append("l.status = ?")
+            params.append(status)
+        if step:
+            where.append("l.step = ?")
+            params.append(step)
+        where_sql = " AND ".join(where)
+        self.flush()
+        with self.db.connect() as conn:
+            total = conn.execute(
+                f"SELECT COUNT(*) FROM install_logs_fts JOIN install_logs l ON l.id = install_logs_fts.rowid WHERE {where_sql}",
+                params,
+            ).fetchone()[0]
+            rows = conn.execute(
+                f"""
+                SELECT l.id, l.task_id, l.step, l.status, l.ip, l.hostname, l.host_id, l.zabbix_url, l.ts,
+                       l.message, l.codec, b.data, bm25(install_logs_fts) AS rank
+                FROM install_logs_fts
+                JOIN install_logs l ON l.id = install_logs_fts.rowid
+                LEFT JOIN log_blobs b ON l.codec = 'blob' AND b.hash = l.message
+                WHERE {where_sql}
+                ORDER BY rank
+                LIMIT ? OFFSET ?
+                """,
+                [*params, limit, offset],
+            ).fetchall()
+        return {
+            "total": total,
+            "limit": limit,
+            "offset": offset,
+            "items": [
+                {
+                    "id": r[0],
+                    "task_id": r[1],
+                    "step": r[2],
+                    "status": r[3],
+                    "ip": r[4],
+                    "hostname": r[5],
+                    "host_id": r[6],
+                    "zabbix_url": r[7],
+                    "ts": r[8],
+                    "snippet": _snippet(_decode_message(r[9], r[10], r[11]), query),
+                    "rank": r[12],
+                }
+                for r in rows
+            ],
+        }
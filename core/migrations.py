@@ -0,0 +1,283 @@
+"""Versioned schema migrations for data.db.
+
+The schema version is kept in `PRAGMA user_version`. run() applies every migration newer than
+the stored version inside one BEGIN IMMEDIATE transaction, so with several processes only the
+first one migrates and the others see the new version. Stores call it once at construction
+(Database.migrate()); their regular methods never run DDL.
+
+Versions 1-3 are the baseline: they bring a database of any older layout (created by
+CREATE TABLE IF NOT EXISTS and ad-hoc ALTERs before versioning) up to the current tables.
+Later schema changes must be appended as new versions, never edited into old ones.
+"""
+
+from __future__ import annotations
+
+import logging
+import sqlite3
+from typing import Callable, List, Tuple
+
+LOG = logging.getLogger(__name__)
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    return bool(conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone())
+
+
+def _v1_config(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)")
+
+
+def _v2_install_logs(conn: sqlite3.Connection) -> None:
+    from core.log_store import LogStore
+
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS install_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT,
+            name TEXT,
+            step TEXT,
+            status TEXT,
+            message TEXT,
+            ip TEXT,
+            hostname TEXT,
+            host_id TEXT,
+            zabbix_url TEXT,
+            ts INTEGER,
+            codec TEXT
+        )
+        """
+    )
+    # 兼容旧库，补齐 host_id / zabbix_url / codec 列
+    cols = _columns(conn, "install_logs")
+    for col in ("host_id", "zabbix_url", "codec"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE install_logs ADD COLUMN {col} TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_task ON install_logs(task_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_host ON install_logs(host_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_url ON install_logs(zabbix_url)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS log_blobs (
+            hash TEXT PRIMARY KEY,
+            data BLOB,
+            size INTEGER
+        )
+        """
+    )
+    # 清理无引用的 log_blobs 时按 hash 反查引用行
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_blob ON install_logs(message) WHERE codec = 'blob'")
+
+    summaries_exist = _table_exists(conn, "task_summaries")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS task_summaries (
+            task_id TEXT PRIMARY KEY,
+            first_ts INTEGER,
+            last_ts INTEGER,
+            last_step TEXT,
+            last_status TEXT,
+            ip TEXT,
+            hostname TEXT,
+            host_id TEXT,
+            zabbix_url TEXT,
+            steps INTEGER DEFAULT 0,
+            failed_steps INTEGER DEFAULT 0,
+            archive TEXT
+        )
+        """
+    )
+    if "archive" not in _columns(conn, "task_summaries"):
+        conn.execute("ALTER TABLE task_summaries ADD COLUMN archive TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_summ_ts ON task_summaries(last_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_summ_hostname ON task_summaries(hostname, last_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_summ_ip ON task_summaries(ip, last_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_summ_host ON task_summaries(host_id, last_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_summ_url ON task_summaries(zabbix_url, last_ts)")
+    if not summaries_exist:
+        # 旧库首次升级：按 task_id 汇总已有日志（一次性全表扫描）
+        LogStore.backfill_summaries(conn)
+
+
+def _v3_batches(conn: sqlite3.Connection) -> None:
+    from core.batch_store import BatchStore
+
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS batches (
+            id TEXT PRIMARY KEY,
+            ts INTEGER,
+            name TEXT,
+            data TEXT,
+            host_count INTEGER DEFAULT 0
+        )
+        """
+    )
+    if "host_count" not in _columns(conn, "batches"):
+        conn.execute("ALTER TABLE batches ADD COLUMN host_count INTEGER DEFAULT 0")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS batch_hosts (
+            batch_id TEXT,
+            item_id TEXT,
+            pos INTEGER,
+            ip TEXT,
+            hostname TEXT,
+            host_id TEXT,
+            data TEXT,
+            PRIMARY KEY (batch_id, item_id)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_hosts_pos ON batch_hosts(batch_id, pos)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_hosts_ip ON batch_hosts(ip)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_hosts_host ON batch_hosts(host_id)")
+    # 旧库迁移：把 batches.data 中的 JSON hosts 拆成 batch_hosts 行
+    BatchStore.split_legacy_batches(conn)
+
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS batch_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id TEXT,
+            item_id TEXT,
+            ip TEXT,
+            host_id TEXT,
+            task_id TEXT,
+            status TEXT,
+            error TEXT,
+            zabbix_url TEXT,
+            ts INTEGER,
+            last_step TEXT,
+            artifact_hash TEXT
+        )
+        """
+    )
+    # 兼容旧库，补齐断点续装 checkpoint 列
+    cols = _columns(conn, "batch_results")
+    for col in ("last_step", "artifact_hash"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE batch_results ADD COLUMN {col} TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_results_batch ON batch_results(batch_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_results_item ON batch_results(batch_id, item_id)")
+    latest_exists = _table_exists(conn, "batch_results_latest")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS batch_results_latest (
+            batch_id TEXT,
+            item_id TEXT,
+            result_id INTEGER,
+            ip TEXT,
+            host_id TEXT,
+            task_id TEXT,
+            status TEXT,
+            error TEXT,
+            zabbix_url TEXT,
+            ts INTEGER,
+            last_step TEXT,
+            artifact_hash TEXT,
+            PRIMARY KEY (batch_id, item_id)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_latest_order ON batch_results_latest(batch_id, result_id)")
+    if not latest_exists:
+        # 旧库首次升级：从历史结果取每台主机最新一行
+        BatchStore.backfill_latest(conn)
+
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS batch_queue (
+            id TEXT PRIMARY KEY,
+            batch_id TEXT,
+            host_ids TEXT,
+            action TEXT,
+            payload TEXT,
+            status TEXT,
+            error TEXT,
+            created INTEGER,
+            started INTEGER,
+            finished INTEGER,
+            priority INTEGER DEFAULT 0,
+            total_hosts INTEGER DEFAULT 0,
+            completed_hosts INTEGER DEFAULT 0,
+            failed_hosts INTEGER DEFAULT 0,
+            concurrency INTEGER DEFAULT 0
+        )
+        """
+    )
+    # 兼容旧库，补齐 priority / 进度计数 / 当前并发列
+    cols = _columns(conn, "batch_queue")
+    for col in ("priority", "total_hosts", "completed_hosts", "failed_hosts", "concurrency"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE batch_queue ADD COLUMN {col} INTEGER DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_queue_status ON batch_queue(status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_queue_batch ON batch_queue(batch_id)")
+
+    # 多进程 worker（BATCH_WORKER_MODE=lease）的主机级领取记录
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS batch_leases (
+            queue_id TEXT,
+            item_id TEXT,
+            status TEXT,
+            worker_id TEXT,
+            lease_until REAL,
+            claims INTEGER DEFAULT 0,
+            PRIMARY KEY (queue_id, item_id)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_leases_claim ON batch_leases(queue_id, status, lease_until)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_leases_worker ON batch_leases(worker_id, status)")
+
+
+def _v4_log_search(conn: sqlite3.Connection) -> None:
+    from core.log_store import LogStore
+
+    try:
+        # contentless：正文可能已压缩/去重，由 LogStore 写入解码后的文本，不在索引中再存一份
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS install_logs_fts USING fts5(step, message, content='', tokenize='unicode61')"
+        )
+    except sqlite3.OperationalError as exc:
+        LOG.warning("SQLite without FTS5 (%s); install log search is disabled", exc)
+        return
+    LogStore.backfill_search_index(conn)
+
+
+# (version, name, migration)；只能在末尾追加
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "config", _v1_config),
+    (2, "install_logs", _v2_install_logs),
+    (3, "batches", _v3_batches),
+    (4, "log_search", _v4_log_search),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def run(conn: sqlite3.Connection) -> int:
+    """Apply pending migrations on conn; returns the resulting schema version."""
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return SCHEMA_VERSION
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 拿到写锁后重新读取：其他进程可能刚完成迁移
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, name, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            LOG.info("applying schema migration %d (%s)", version, name)
+            migration(conn)
+            conn.execute(f"PRAGMA user_version={version}")
+            current = version
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return current
@@ -20,7 +20,55 @@ class Settings(BaseModel):
     agent_install_dir: str = Field(default="/opt/zabbix-agent2", alias="ZABBIX_AGENT_INSTALL_DIR")
     project_name: str = Field(default="", alias="PROJECT_NAME")
     agent_upload_dir: str = Field(default="uploads", alias="ZABBIX_AGENT_UPLOAD_DIR")
-    batch_concurrency: int = Field(default=5, alias="BATCH_CONCURRENCY")
+    batch_concurrency: int = Field(default=5, alias="BATCH_CONCURRENCY", description="Global host-level worker pool size")
+    batch_queue_concurrency: int = Field(default=0, alias="BATCH_QUEUE_CONCURRENCY", description="Per-queue host cap (0 = pool size)")
+    batch_adaptive: bool = Field(default=False, alias="BATCH_ADAPTIVE", description="Tune per-queue concurrency from measured throughput")
+    batch_concurrency_min: int = Field(default=1, alias="BATCH_CONCURRENCY_MIN", description="Adaptive per-queue lower bound")
+    batch_concurrency_max: int = Field(default=32, alias="BATCH_CONCURRENCY_MAX", description="Adaptive per-queue upper bound (also sizes the pool)")
+    batch_adaptive_window_ms: int = Field(default=5000, alias="BATCH_ADAPTIVE_WINDOW_MS", description="Max measurement window per adjustment")
+    batch_result_flush_size: int = Field(default=50, alias="BATCH_RESULT_FLUSH_SIZE", description="Results per grouped write")
+    batch_result_flush_ms: int = Field(default=200, alias="BATCH_RESULT_FLUSH_MS", description="Max delay before results are written")
+    batch_poll_interval: int = Field(default=30, alias="BATCH_POLL_INTERVAL", description="Fallback queue poll seconds")
+    batch_worker_mode: str = Field(default="embedded", alias="BATCH_WORKER_MODE", description="embedded | lease | off (standalone workers only)")
+    batch_lease_seconds: int = Field(default=60, alias="BATCH_LEASE_SECONDS", description="Host lease length; renewed every third of it")
+    batch_lease_poll_ms: int = Field(default=1000, alias="BATCH_LEASE_POLL_MS", description="Queue poll interval in lease mode")
+    batch_recovery: str = Field(default="requeue", alias="BATCH_RECOVERY", description="Interrupted queues on startup: requeue | fail")
+    batch_recovery_max: int = Field(default=3, alias="BATCH_RECOVERY_MAX", description="Max automatic requeues per interrupted queue chain")
+    batch_pipeline: bool = Field(default=False, alias="BATCH_PIPELINE", description="Run batch installs as SSH -> Zabbix registration -> web monitor stages")
+    batch_stage_queue_size: int = Field(default=200, alias="BATCH_STAGE_QUEUE_SIZE", description="Max hosts waiting for each downstream stage; upstream pauses when full")
+    batch_register_workers: int = Field(default=2, alias="BATCH_REGISTER_WORKERS", description="Threads running batched Zabbix registration calls")
+    batch_register_batch_size: int = Field(default=50, alias="BATCH_REGISTER_BATCH_SIZE", description="Max hosts per batched host.create/host.update call")
+    batch_register_linger_ms: int = Field(default=300, alias="BATCH_REGISTER_LINGER_MS", description="Max wait to fill a registration batch")
+    batch_web_workers: int = Field(default=4, alias="BATCH_WEB_WORKERS", description="Threads creating web monitors")
+    sqlite_journal_mode: str = Field(default="WAL", alias="SQLITE_JOURNAL_MODE", description="journal_mode pragma for data.db")
+    sqlite_synchronous: str = Field(default="NORMAL", alias="SQLITE_SYNCHRONOUS", description="synchronous pragma (NORMAL is durable with WAL except on power loss)")
+    sqlite_busy_timeout_ms: int = Field(default=30000, alias="SQLITE_BUSY_TIMEOUT_MS", description="Wait for locks before 'database is locked'")
+    sqlite_cache_kb: int = Field(default=20000, alias="SQLITE_CACHE_KB", description="Page cache per connection (KiB)")
+    log_async: bool = Field(default=True, alias="LOG_ASYNC", description="Queue install logs and write them from a background thread")
+    log_flush_size: int = Field(default=200, alias="LOG_FLUSH_SIZE", description="Rows per grouped install_logs transaction")
+    log_flush_ms: int = Field(default=50, alias="LOG_FLUSH_MS", description="Max delay before queued log rows are written")
+    log_buffer_max: int = Field(default=10000, alias="LOG_BUFFER_MAX", description="Max queued log rows; add() blocks when full")
+    log_flush_retries: int = Field(default=3, alias="LOG_FLUSH_RETRIES", description="Failed flush attempts before queued log rows go to the dead-letter file")
+    log_dead_letter: str = Field(default="install_logs.deadletter.jsonl", alias="LOG_DEAD_LETTER", description="JSONL file for log rows that could not be written (relative to data.db; empty = drop them)")
+    log_retention_days: int = Field(default=0, alias="LOG_RETENTION_DAYS", description="Delete install logs of tasks older than N days (0 keeps all)")
+    log_retention_rows: int = Field(default=0, alias="LOG_RETENTION_ROWS", description="Keep at most N install_logs rows, oldest tasks first (0 = no limit)")
+    log_archive_dir: str = Field(default="", alias="LOG_ARCHIVE_DIR", description="Archive expired tasks to per-month .jsonl.gz files here before deleting (empty = no archive; relative to data.db)")
+    log_prune_chunk: int = Field(default=200, alias="LOG_PRUNE_CHUNK", description="Tasks deleted per retention transaction")
+    log_prune_interval_s: int = Field(default=3600, alias="LOG_PRUNE_INTERVAL_S", description="Seconds between retention runs")
+    log_compress_min_bytes: int = Field(default=1024, alias="LOG_COMPRESS_MIN_BYTES", description="zlib-compress step messages of at least this many bytes (0 = off)")
+    log_dedup: bool = Field(default=True, alias="LOG_DEDUP", description="Store identical compressed messages once in log_blobs")
+    batch_proxy_concurrency: int = Field(default=0, alias="BATCH_PROXY_CONCURRENCY", description="Max hosts in flight per proxy_id across queues (0 = unlimited)")
+    batch_subnet_groups: str = Field(
+        default="",
+        alias="BATCH_SUBNET_GROUPS",
+        description="Per-CIDR host caps across queues, e.g. 10.1.0.0/16=8,10.2.0.0/16=4",
+    )
+    batch_retry_connect: int = Field(default=2, alias="BATCH_RETRY_CONNECT", description="Retries for SSH connect/reset failures")
+    batch_retry_auth: int = Field(default=0, alias="BATCH_RETRY_AUTH", description="Retries for SSH/Zabbix auth failures")
+    batch_retry_step: int = Field(default=0, alias="BATCH_RETRY_STEP", description="Retries for failed install steps (resumes from checkpoint)")
+    batch_retry_api: int = Field(default=2, alias="BATCH_RETRY_API", description="Retries for Zabbix API transport/gateway errors")
+    batch_retry_backoff_ms: int = Field(default=2000, alias="BATCH_RETRY_BACKOFF_MS", description="First retry delay; doubles per attempt")
+    batch_retry_backoff_max_ms: int = Field(default=60000, alias="BATCH_RETRY_BACKOFF_MAX_MS", description="Retry delay ceiling")
     ssh_user: str = Field(default="root", alias="SSH_USER")
     ssh_password: Optional[str] = Field(default=None, alias="SSH_PASSWORD")
     ssh_key_path: Optional[str] = Field(default=None, alias="SSH_KEY_PATH")
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import threading
+from typing import Callable, Dict
+
+
+class TaskCancelled(RuntimeError):
+    """Raised inside install/uninstall flows when the owning batch was cancelled."""
+
+    def __init__(self, msg: str = "cancelled"):
+        super().__init__(msg)
+
+
+class StepFailed(RuntimeError):
+    """Raised when a remote install/uninstall step exits non-zero (retried as a `step` failure)."""
+
+
+class CancelToken:
+    """Cooperative cancellation flag shared between the batch worker and one host's install flow.
+
+    Long blocking resources (SSH clients, SFTP sessions) register a closer so that cancel()
+    interrupts them immediately instead of waiting for the current step to finish.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._closers: Dict[int, Callable[[], None]] = {}
+        self._seq = 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self) -> None:
+        if self._event.is_set():
+            raise TaskCancelled()
+
+    def cancel(self) -> None:
+        self._event.set()
+        with self._lock:
+            closers = list(self._closers.values())
+            self._closers.clear()
+        for close in closers:
+            try:
+                close()
+            except Exception:
+                pass
+
+    def register(self, closer: Callable[[], None]) -> int:
+        """Register a closer; runs immediately if already cancelled. Returns a handle for unregister()."""
+        with self._lock:
+            if not self._event.is_set():
+                self._seq += 1
+                self._closers[self._seq] = closer
+                return self._seq
+        closer()
+        return 0
+
+    def unregister(self, handle: int) -> None:
+        with self._lock:
+            self._closers.pop(handle, None)
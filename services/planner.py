@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import logging
+import math
+import os
+import socket
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+from core.settings import get_settings
+from schemas.models import RegisterRequest
+from services.scripts import INSTALL_STEPS
+
+LOG = logging.getLogger(__name__)
+settings = get_settings()
+
+PLAN_CLASSES = ("create", "update", "no-op", "install", "uninstall", "skip")
+# 无历史记录时的单台安装耗时估计（秒）
+_DEFAULT_HOST_SECONDS = 30.0
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return float(ordered[min(len(ordered) - 1, int(round(pct * (len(ordered) - 1))))])
+
+
+class BatchPlanner:
+    """Dry-run of /batch/run: classify hosts and project API calls, bytes and wall-clock time.
+
+    Only cheap checks are made: a few array-params Zabbix reads for the whole batch and a TCP
+    connect to each SSH port. Nothing is installed or written.
+    """
+
+    def __init__(self, svc, log_store):
+        self.svc = svc
+        self.log_store = log_store
+
+    def plan(self, hosts: List[Dict[str, Any]], action: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        started = time.monotonic()
+        cfg = self.svc.config_store.get()
+        register_only = bool(payload.get("register_only"))
+        register = register_only or payload.get("register_server", True)
+        ssh = action == "uninstall" or not register_only
+
+        entries, invalid = self._build_requests(hosts, payload)
+        existing, api_latency = self._prefetch(entries, cfg) if register or action == "uninstall" else ({}, None)
+        reachable = self._reachability(hosts, payload) if ssh and payload.get("reachability", True) else {}
+
+        planned = []
+        for h in hosts:
+            key = str(h.get("item_id"))
+            row: Dict[str, Any] = {"item_id": h.get("item_id"), "ip": str(h.get("ip")), "hostname": h.get("hostname") or None}
+            if key in invalid:
+                planned.append({**row, "plan": "skip", "reason": invalid[key]})
+                continue
+            req, spec = entries[key]
+            host = existing.get(key)
+            zbx = self._zabbix_class(host, spec)
+            row.update({
+                "proxy_id": req.proxy_id,
+                "web_monitors": len(self.svc._iter_web_urls(req)) if register else 0,
+                "zabbix": zbx if register else None,
+                "zabbix_host_id": host.get("hostid") if host else None,
+                "templates_add": sorted(set(spec["tmpl_ids"]) - self._linked(host)) if register else [],
+                "templates_remove": sorted(self._linked(host) - set(spec["tmpl_ids"])) if register and host else [],
+            })
+            if ssh and key in reachable and not reachable[key]["ok"]:
+                row.update({"plan": "skip", "reason": f"ssh unreachable: {reachable[key]['error']}"})
+            elif action == "uninstall":
+                row["plan"] = "uninstall"
+            elif register_only:
+                row["plan"] = zbx
+            else:
+                row["plan"] = "install"
+            if key in reachable:
+                row["ssh_ms"] = reachable[key]["ms"]
+            planned.append(row)
+
+        summary = {name: 0 for name in PLAN_CLASSES}
+        for row in planned:
+            summary[row["plan"]] = summary.get(row["plan"], 0) + 1
+        projection = self._project(planned, action, payload, cfg, api_latency)
+        return {
+            "action": action,
+            "hosts_total": len(hosts),
+            "summary": summary,
+            "projection": projection,
+            "hosts": planned,
+            "plan_ms": int((time.monotonic() - started) * 1000),
+        }
+
+    # -------------------- prefetch -------------------- #
+    def _build_requests(self, hosts: List[Dict[str, Any]], payload: Dict[str, Any]) -> Tuple[Dict[str, tuple], Dict[str, str]]:
+        """Registration-side view of every host, built the same way the batch worker does."""
+        cfg = self.svc.config_store.get()
+        entries: Dict[str, tuple] = {}
+        invalid: Dict[str, str] = {}
+        template_ids = payload.get("template_ids") or []
+        group_ids = payload.get("group_ids") or []
+        for h in hosts:
+            key = str(h.get("item_id"))
+            try:
+                req = RegisterRequest(
+                    hostname=h.get("hostname") or None,
+                    visible_name=h.get("visible_name"),
+                    ip=h.get("ip"),
+                    env=h.get("env"),
+                    port=h.get("port") or 10050,
+                    template_ids=template_ids or h.get("template_ids") or ([h.get("template_id")] if h.get("template_id") else None),
+                    group_ids=group_ids or h.get("group_ids") or ([h.get("group_id")] if h.get("group_id") else None),
+                    proxy_id=payload.get("proxy_id") or h.get("proxy_id"),
+                    web_monitor_urls=h.get("web_monitor_urls") or payload.get("web_monitor_urls"),
+                    web_monitor_url=h.get("web_monitor_url") or payload.get("web_monitor_url"),
+                    jmx_port=payload.get("jmx_port") or h.get("jmx_port"),
+                )
+            except ValidationError as exc:
+                invalid[key] = f"invalid host row: {exc.errors()[0].get('msg')}"
+                continue
+            entries[key] = (req, self.svc._host_params(req, cfg))
+        return entries, invalid
+
+    def _prefetch(self, entries: Dict[str, tuple], cfg: Dict[str, Any]) -> Tuple[Dict[str, Dict[str, Any]], Optional[float]]:
+        """Look up existing Zabbix hosts: by host name, or by interface IP when the name is only known after SSH."""
+        found: Dict[str, Dict[str, Any]] = {}
+        by_proxy: Dict[Optional[str], Dict[str, List[str]]] = {}
+        by_ip: Dict[str, List[str]] = {}
+        for key, (req, spec) in entries.items():
+            if req.hostname:
+                by_proxy.setdefault(req.proxy_id, {}).setdefault(spec["host"], []).append(key)
+            else:
+                by_ip.setdefault(str(req.ip), []).append(key)
+        timings = []
+        output = {"output": ["hostid", "host", "name"], "selectParentTemplates": ["templateid", "name"]}
+        for proxy_id, names in by_proxy.items():
+            t0 = time.monotonic()
+            res = self.svc._zbx(
+                "host.get",
+                {**output, "filter": {"host": list(names)}, **({"proxyids": [proxy_id]} if proxy_id else {})},
+            )
+            timings.append(time.monotonic() - t0)
+            for host in res or []:
+                for key in names.get(host["host"], []):
+                    found[key] = host
+        if by_ip:
+            t0 = time.monotonic()
+            ifaces = self.svc._zbx("hostinterface.get", {"output": ["hostid", "ip"], "filter": {"ip": list(by_ip)}})
+            timings.append(time.monotonic() - t0)
+            host_by_id = {}
+            hostids = sorted({i["hostid"] for i in ifaces or []})
+            if hostids:
+                t0 = time.monotonic()
+                host_by_id = {h["hostid"]: h for h in self.svc._zbx("host.get", {**output, "hostids": hostids}) or []}
+                timings.append(time.monotonic() - t0)
+            for iface in ifaces or []:
+                host = host_by_id.get(iface["hostid"])
+                for key in by_ip.get(iface.get("ip"), []):
+                    if host and key not in found:
+                        found[key] = host
+        return found, (statistics.median(timings) if timings else None)
+
+    def _reachability(self, hosts: List[Dict[str, Any]], payload: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """TCP connect to every SSH port in parallel; no login is attempted."""
+        timeout = float(payload.get("probe_timeout") or 2.0)
+
+        def _probe(h):
+            port = int(h.get("ssh_port") or settings.ssh_port or 22)
+            t0 = time.monotonic()
+            try:
+                with socket.create_connection((str(h.get("ip")), port), timeout=timeout):
+                    pass
+                return {"ok": True, "ms": int((time.monotonic() - t0) * 1000), "error": None}
+            except OSError as exc:
+                return {"ok": False, "ms": int((time.monotonic() - t0) * 1000), "error": str(exc) or type(exc).__name__}
+
+        if not hosts:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(64, len(hosts)), thread_name_prefix="batch-plan") as pool:
+            results = list(pool.map(_probe, hosts))
+        return {str(h.get("item_id")): r for h, r in zip(hosts, results)}
+
+    @staticmethod
+    def _linked(host: Optional[Dict[str, Any]]) -> set:
+        return {t["templateid"] for t in (host or {}).get("parentTemplates", [])}
+
+    def _zabbix_class(self, host: Optional[Dict[str, Any]], spec: Dict[str, Any]) -> str:
+        if not host:
+            return "create"
+        if self._linked(host) == set(spec["tmpl_ids"]) and host.get("name") == spec["base"]["name"]:
+            return "no-op"
+        return "update"
+
+    # -------------------- projection -------------------- #
+    def _project(
+        self, planned: List[Dict[str, Any]], action: str, payload: Dict[str, Any], cfg: Dict[str, Any], api_latency: Optional[float]
+    ) -> Dict[str, Any]:
+        installs = [r for r in planned if r["plan"] == "install"]
+        registers = [r for r in planned if r["plan"] != "skip" and r.get("zabbix")]
+        web_urls = sum(r.get("web_monitors", 0) for r in registers)
+
+        final_step = INSTALL_STEPS[-1][0]
+        history = self.log_store.step_timings(final_step) if self.log_store else {"tasks": [], "steps": {}}
+        host_secs = statistics.median(history["tasks"]) if history["tasks"] else _DEFAULT_HOST_SECONDS
+        p90 = _percentile(history["tasks"], 0.9) or host_secs
+
+        concurrency = int(
+            payload.get("concurrency")
+            or getattr(settings, "batch_queue_concurrency", 0)
+            or getattr(settings, "batch_concurrency", 5)
+        )
+        if not payload.get("concurrency") and getattr(settings, "batch_adaptive", False):
+            concurrency = max(concurrency, getattr(settings, "batch_concurrency_max", concurrency))
+        workers = max(1, min(concurrency, len(installs) or 1))
+        ssh_secs = math.ceil(len(installs) / workers) * host_secs if installs else 0.0
+
+        # API 调用数：流水线按批注册，否则逐台（_ensure_host + bind_template）
+        pipeline = getattr(settings, "batch_pipeline", False) and action != "uninstall"
+        batch_size = max(1, getattr(settings, "batch_register_batch_size", 50))
+        creates = sum(1 for r in registers if r["zabbix"] == "create")
+        updates = len(registers) - creates
+        if pipeline:
+            batches = math.ceil(len(registers) / batch_size) if registers else 0
+            proxies = max(1, len({r.get("proxy_id") for r in registers}))
+            register_calls = batches * (1 + proxies) + (math.ceil(creates / batch_size) if creates else 0) + (
+                math.ceil(updates / batch_size) if updates else 0
+            )
+        else:
+            register_calls = len(registers) * 6
+        web_calls = web_urls * 2
+        api_calls = register_calls + web_calls + (len(registers) if action == "uninstall" else 0)
+        api_secs = api_calls * (api_latency or 0.2)
+
+        package_bytes = None
+        local_path = cfg.get("local_agent_path")
+        if local_path and os.path.exists(local_path):
+            package_bytes = os.path.getsize(local_path)
+        per_host_bytes = (package_bytes or 0) + self._script_bytes(cfg)
+        wall = ssh_secs + (api_secs / max(1, getattr(settings, "batch_register_workers", 1)) if pipeline else api_secs)
+        return {
+            "concurrency": workers,
+            "api_calls": api_calls,
+            "api_latency_ms": int(api_latency * 1000) if api_latency is not None else None,
+            "bytes_per_host": per_host_bytes,
+            "bytes_total": per_host_bytes * len(installs),
+            "package_bytes": package_bytes,
+            "host_seconds_median": host_secs,
+            "host_seconds_p90": p90,
+            "wall_seconds": round(wall, 1),
+            "wall_seconds_p90": round(math.ceil(len(installs) / workers) * p90 + api_secs, 1) if installs else round(api_secs, 1),
+            "history_tasks": len(history["tasks"]),
+            "step_seconds_median": {
+                step: statistics.median(vals) for step, vals in history["steps"].items() if vals
+            },
+        }
+
+    def _script_bytes(self, cfg: Dict[str, Any]) -> int:
+        """Size of the rendered install scripts sent over SSH for one host."""
+        try:
+            scripts = self.svc._script_set(cfg, install=False)
+            return len(scripts.fingerprint.encode()) + sum(
+                len(step["script"].encode()) for step in scripts.install_steps("", precheck=True)
+            )
+        except Exception as exc:
+            LOG.debug("script size estimate failed: %s", exc)
+            return 0
@@ -1,11 +1,12 @@
 ﻿from __future__ import annotations
 
+import hashlib
 import logging
 import os
 from pathlib import Path
 from urllib.parse import urlparse
 import uuid
-from typing import List, Any, Dict, Optional
+from typing import Callable, List, Any, Dict, Optional, Tuple
 
 import httpx
 import paramiko
@@ -22,6 +23,8 @@ from schemas.models import (
 )
 from core.settings import get_settings
 from core.db_config import ConfigStore
+from services.cancel import CancelToken, StepFailed, TaskCancelled
+from services.scripts import DOWNLOAD_STEP, REMOTE_TMP, ScriptSet, agent_config_text, host_prelude, parse_artifact_hash, render_scripts
 
 LOG = logging.getLogger(__name__)
 settings = get_settings()
@@ -68,15 +71,57 @@ class ZabbixService:
         return deduped
 
     # --------------------------- Public APIs --------------------------- #
-    def install_agent(self, req: InstallRequest, task_id: str | None = None, log_store=None) -> dict:
+    def install_agent(
+        self,
+        req: InstallRequest,
+        task_id: str | None = None,
+        log_store=None,
+        cancel_token: CancelToken | None = None,
+        resume_from: str | None = None,
+        artifact_hash: str | None = None,
+        checkpoint: Optional[Callable[[Optional[str], Optional[str]], None]] = None,
+        register: bool = True,
+    ) -> dict:
+        """Install and register one agent.
+
+        resume_from/artifact_hash come from a previous failed attempt's checkpoint: the steps up to
+        resume_from are re-verified on the host and only the first incomplete one onwards is re-run.
+        checkpoint(last_step, artifact_hash) is called after every completed step.
+        register=False runs only the SSH part; the batch pipeline registers the returned hostname
+        later through register_hosts()/ensure_web_monitors().
+        """
         cfg = self.config_store.get()
         zabbix_url = cfg.get("zabbix_api_base") or settings.zabbix_api_base
         if req.os_type.lower() != "linux":
             raise HTTPException(status_code=400, detail="Only linux install supported in this version")
+        # 首次 SSH 往返：采集 agent 指纹（含 hostname），reinstall=True 时跳过
+        probe: Optional[Dict[str, str]] = None
+        if not req.reinstall:
+            try:
+                probe = self._probe_agent_state(req, cfg, cancel_token=cancel_token)
+            except TaskCancelled:
+                raise
+            except Exception as exc:
+                LOG.warning("agent fingerprint probe failed for %s: %s", req.ip, exc)
         resolved_host = req.hostname
+        if not resolved_host and probe and probe.get("hostname"):
+            resolved_host = probe["hostname"]
+            if log_store and task_id:
+                log_store.add(
+                    task_id,
+                    "从服务器获取hostname",
+                    "ok",
+                    f"hostname detected: {resolved_host}",
+                    ip=str(req.ip),
+                    hostname=req.hostname,
+                    host_id=None,
+                    zabbix_url=zabbix_url,
+                )
         if not resolved_host:
             try:
-                resolved_host = self._probe_hostname(req)
+                if cancel_token:
+                    cancel_token.check()
+                resolved_host = self._probe_hostname(req, cancel_token=cancel_token)
                 if log_store and task_id:
                     log_store.add(
                         task_id,
@@ -88,6 +133,8 @@ class ZabbixService:
                         host_id=None,
                         zabbix_url=zabbix_url,
                     )
+            except TaskCancelled:
+                raise
             except Exception as exc:
                 LOG.warning("auto hostname probe failed for %s: %s", req.ip, exc)
                 if log_store and task_id:
@@ -108,7 +155,9 @@ class ZabbixService:
         req = req.copy(update={"hostname": resolved_host, "visible_name": visible})
 
         host_id = None
-        if getattr(req, "register_server", True):
+        if cancel_token:
+            cancel_token.check()
+        if register and getattr(req, "register_server", True):
             try:
                 host_id = self._ensure_host(req, task_id=task_id, log_store=log_store, zabbix_url=zabbix_url)
             except Exception as exc:
@@ -125,22 +174,49 @@ class ZabbixService:
                     )
                 raise
 
-        steps, rollback, preupload, remote_tmp = self._linux_install_steps(req)
-        log = self._run_steps(
-            req.ip,
-            steps,
-            rollback_script=rollback,
-            ssh_opts=req,
-            preupload_local_path=preupload,
-            remote_tmp=remote_tmp,
-            task_id=task_id,
-            log_store=log_store,
-            hostname=req.hostname,
-            host_id=host_id,
-            zabbix_url=zabbix_url,
-        )
+        status = "installed"
+        desired = self._desired_fingerprint(req, cfg)
+        if probe is not None and self._agent_is_current(probe, desired):
+            status = "current"
+            log = f"[检查agent指纹] agent already current ({probe.get('version') or 'unknown version'}); install skipped"
+            if log_store and task_id:
+                log_store.add(
+                    task_id,
+                    "检查agent指纹",
+                    "ok",
+                    log,
+                    ip=str(req.ip),
+                    hostname=req.hostname,
+                    host_id=host_id,
+                    zabbix_url=zabbix_url,
+                )
+        else:
+            steps, rollback, preupload, remote_tmp, script_id, verify = self._linux_install_steps(req, cfg, artifact_hash=artifact_hash)
+            log = self._run_steps(
+                req.ip,
+                steps,
+                rollback_script=rollback,
+                ssh_opts=req,
+                preupload_local_path=preupload,
+                remote_tmp=remote_tmp,
+                script_id=script_id,
+                resume_from=resume_from,
+                verify_script=verify if resume_from else None,
+                checkpoint=checkpoint,
+                task_id=task_id,
+                log_store=log_store,
+                hostname=req.hostname,
+                host_id=host_id,
+                zabbix_url=zabbix_url,
+                cancel_token=cancel_token,
+            )
 
-        if getattr(req, "register_server", True):
+        if cancel_token:
+            cancel_token.check()
+        if not register:
+            # 注册/模板/web 监控由批量流水线的后续阶段完成
+            pass
+        elif getattr(req, "register_server", True):
             #
             if req.template_ids or req.template_id or settings.default_template_id:
                 bind_req = TemplateBindRequest(
@@ -178,25 +254,7 @@ class ZabbixService:
                             zabbix_url=zabbix_url,
                         )
                     raise
-            web_urls = self._iter_web_urls(req)
-            for url in web_urls:
-                try:
-                    wid = self._ensure_web_monitor(host_id, url)
-                    if log_store and task_id:
-                        log_store.add(
-                            task_id,
-                            "添加web监控",
-                            "ok",
-                            f"web scenario ensured id={wid} url={url}",
-                            ip=str(req.ip),
-                            hostname=req.hostname,
-                            host_id=host_id,
-                            zabbix_url=zabbix_url,
-                        )
-                except Exception as exc:
-                    if log_store and task_id:
-                        log_store.add(task_id, "添加web监控", "failed", str(exc), ip=str(req.ip), hostname=req.hostname, host_id=host_id, zabbix_url=zabbix_url)
-                    raise
+            self.ensure_web_monitors(req, host_id, task_id=task_id, log_store=log_store, cancel_token=cancel_token)
         else:
             if log_store and task_id:
                 log_store.add(
@@ -209,37 +267,77 @@ class ZabbixService:
                     host_id=host_id,
                     zabbix_url=zabbix_url,
                 )
-        return {"host_id": host_id, "ip": str(req.ip), "status": "installed", "log": log, "hostname": req.hostname, "zabbix_url": zabbix_url}
+        return {
+            "host_id": host_id,
+            "ip": str(req.ip),
+            "status": status,
+            "log": log,
+            "hostname": req.hostname,
+            "visible_name": req.visible_name,
+            "zabbix_url": zabbix_url,
+        }
 
-    def uninstall_agent(self, req: UninstallRequest, task_id: str | None = None, log_store=None) -> dict:
+    def ensure_web_monitors(self, req, host_id: str, task_id: str | None = None, log_store=None, cancel_token: CancelToken | None = None) -> List[str]:
+        """Create/update one web scenario per monitor URL of req; returns the httptest ids."""
+        zabbix_url = self.config_store.get().get("zabbix_api_base") or settings.zabbix_api_base
+        ids = []
+        for url in self._iter_web_urls(req):
+            if cancel_token:
+                cancel_token.check()
+            try:
+                wid = self._ensure_web_monitor(host_id, url)
+                ids.append(wid)
+                if log_store and task_id:
+                    log_store.add(
+                        task_id,
+                        "添加web监控",
+                        "ok",
+                        f"web scenario ensured id={wid} url={url}",
+                        ip=str(req.ip),
+                        hostname=req.hostname,
+                        host_id=host_id,
+                        zabbix_url=zabbix_url,
+                    )
+            except Exception as exc:
+                if log_store and task_id:
+                    log_store.add(task_id, "添加web监控", "failed", str(exc), ip=str(req.ip), hostname=req.hostname, host_id=host_id, zabbix_url=zabbix_url)
+                raise
+        return ids
+
+    def uninstall_agent(self, req: UninstallRequest, task_id: str | None = None, log_store=None, cancel_token: CancelToken | None = None) -> dict:
         cfg = self.config_store.get()
         zabbix_url = cfg.get("zabbix_api_base") or settings.zabbix_api_base
         host_key = req.hostname or str(req.ip)
         host = self._get_host(host_key, getattr(req, "proxy_id", None))
         host_id = host["hostid"] if host else None
         resolved_hostname = req.hostname or (host.get("host") if host else None)
+        scripts = self._script_set(cfg, install=False)
         log = self._run_steps(
             req.ip,
-            self._linux_uninstall_steps(),
+            scripts.uninstall_steps(),
             rollback_script=None,
             ssh_opts=req,
+            script_id=f"v{scripts.version}/{scripts.digest[:12]}",
             task_id=task_id,
             log_store=log_store,
             hostname=resolved_hostname,
             host_id=host_id,
             zabbix_url=zabbix_url,
             tolerant_steps={"stop_agent"},
+            cancel_token=cancel_token,
         )
         if host:
             self._zbx("host.delete", [host["hostid"]])
         return {"ip": str(req.ip), "status": "uninstalled", "log": log, "host_id": host_id, "hostname": resolved_hostname, "zabbix_url": zabbix_url}
 
-    def register_host(self, req, task_id: str | None = None, log_store=None) -> dict:
+    def register_host(self, req, task_id: str | None = None, log_store=None, cancel_token: CancelToken | None = None) -> dict:
         cfg = self.config_store.get()
         zabbix_url = cfg.get("zabbix_api_base") or settings.zabbix_api_base
         resolved_host = getattr(req, "hostname", None) or str(req.ip)
         req = req.copy(update={"hostname": resolved_host}) if hasattr(req, "copy") else req
         host_id = self._ensure_host(req, task_id=task_id, log_store=log_store, zabbix_url=zabbix_url)
+        if cancel_token:
+            cancel_token.check()
         if getattr(req, "template_ids", None) or getattr(req, "template_id", None) or settings.default_template_id:
             bind_req = TemplateBindRequest(
                 ip=req.ip,
@@ -277,6 +375,8 @@ class ZabbixService:
                     )
                 raise
         for url in self._iter_web_urls(req):
+            if cancel_token:
+                cancel_token.check()
             try:
                 wid = self._ensure_web_monitor(host_id, url)
                 if log_store and task_id:
@@ -471,14 +571,9 @@ class ZabbixService:
         )
         return res[0] if res else None
 
-    def _ensure_host(self, req: InstallRequest, task_id: str | None = None, log_store=None, zabbix_url: str | None = None) -> str:
-        cfg = self.config_store.get()
-        # Agent
+    def _host_params(self, req, cfg: Dict[str, Any]) -> Dict[str, Any]:
+        """host.create/host.update fields of one agent, without the interface list."""
         agent_hostname = req.hostname or str(req.ip)
-
-        existing = self._get_host(agent_hostname, getattr(req, "proxy_id", None))
-        host_value = agent_hostname
-        templates = []
         tmpl_ids = []
         if req.template_ids:
             tmpl_ids.extend(req.template_ids)
@@ -488,7 +583,6 @@ class ZabbixService:
             tmpl_ids.append(cfg.get("default_template_id"))
         templates = [{"templateid": tid} for tid in tmpl_ids]
 
-        groups = []
         grp_ids = []
         if req.group_ids:
             grp_ids.extend(req.group_ids)
@@ -500,8 +594,8 @@ class ZabbixService:
             grp_ids.append("1")
         groups = [{"groupid": gid} for gid in grp_ids]
         base_params = {
-            "host": host_value,
-            "name": req.visible_name or host_value,
+            "host": agent_hostname,
+            "name": req.visible_name or agent_hostname,
             "groups": groups,
             "templates": templates,
         }
@@ -514,6 +608,30 @@ class ZabbixService:
             tags.append({"tag": "web_monitor", "value": str(url)})
         if tags:
             base_params["tags"] = tags
+        return {
+            "host": agent_hostname,
+            "base": base_params,
+            "tmpl_ids": [t["templateid"] for t in templates if t.get("templateid")],
+            "grp_ids": grp_ids,
+            "jmx_port": getattr(req, "jmx_port", None) or 10052,
+        }
+
+    @staticmethod
+    def _jmx_interface(ip, jmx_port, host_id: Optional[str] = None) -> Dict[str, Any]:
+        iface = {"type": 4, "main": 1, "useip": 1, "ip": str(ip), "dns": "", "port": str(jmx_port)}  # JMX
+        if host_id:
+            iface["hostid"] = host_id
+        return iface
+
+    def _ensure_host(self, req: InstallRequest, task_id: str | None = None, log_store=None, zabbix_url: str | None = None) -> str:
+        cfg = self.config_store.get()
+        spec = self._host_params(req, cfg)
+        agent_hostname = spec["host"]
+        existing = self._get_host(agent_hostname, getattr(req, "proxy_id", None))
+        base_params = spec["base"]
+        tmpl_ids = spec["tmpl_ids"]
+        grp_ids = spec["grp_ids"]
+        jmx_port = spec["jmx_port"]
 
         interfaces = [
             {
@@ -525,20 +643,9 @@ class ZabbixService:
                 "port": str(req.port),
             }
         ]
-        jmx_port = getattr(req, "jmx_port", None) or 10052
-        tmpl_ids_all = [t["templateid"] for t in templates if t.get("templateid")]
-        has_jmx = self._has_jmx_template(tmpl_ids_all) if tmpl_ids_all else False
+        has_jmx = self._has_jmx_template(tmpl_ids) if tmpl_ids else False
         if has_jmx:
-            interfaces.append(
-                {
-                    "type": 4,  # JMX
-                    "main": 1,
-                    "useip": 1,
-                    "ip": str(req.ip),
-                    "dns": "",
-                    "port": str(jmx_port),
-                }
-            )
+            interfaces.append(self._jmx_interface(req.ip, jmx_port))
 
         if existing:
             update_params = dict(base_params)
@@ -547,18 +654,7 @@ class ZabbixService:
             if has_jmx:
                 has_jmx_iface = any(int(i.get("type", 0)) == 4 for i in existing.get("interfaces", []))
                 if not has_jmx_iface:
-                    self._zbx(
-                        "hostinterface.create",
-                        {
-                            "hostid": existing["hostid"],
-                            "type": 4,
-                            "main": 1,
-                            "useip": 1,
-                            "ip": str(req.ip),
-                            "dns": "",
-                            "port": str(jmx_port),
-                        },
-                    )
+                    self._zbx("hostinterface.create", self._jmx_interface(req.ip, jmx_port, existing["hostid"]))
             # Avoid touching interfaces on existing hosts to prevent "interface linked to item" errors
             self._zbx("host.update", update_params)
             host_id = existing["hostid"]
@@ -592,6 +688,105 @@ class ZabbixService:
             )
         return host_id
 
+    def register_hosts(self, entries: List[Tuple[Any, Optional[str]]], log_store=None) -> List[Any]:
+        """Register many agents with array-params Zabbix calls.
+
+        entries are (request, task_id) pairs; the result list holds a host id or the exception of
+        each entry, in order. One template.get, one host.get per proxy, and at most one
+        hostinterface.create, host.update and host.create cover the whole batch. If any batched
+        call fails, the batch falls back to per-host _ensure_host() so that only the hosts at
+        fault fail.
+        """
+        if not entries:
+            return []
+        cfg = self.config_store.get()
+        zabbix_url = cfg.get("zabbix_api_base") or settings.zabbix_api_base
+        specs = [self._host_params(req, cfg) for req, _ in entries]
+        try:
+            all_tmpl = sorted({tid for spec in specs for tid in spec["tmpl_ids"]})
+            jmx_tmpl = set()
+            if all_tmpl:
+                res = self._zbx("template.get", {"templateids": all_tmpl, "output": ["templateid", "name"]})
+                jmx_tmpl = {t["templateid"] for t in res or [] if "jmx" in (t.get("name") or "").lower()}
+            by_proxy: Dict[Optional[str], List[str]] = {}
+            for (req, _), spec in zip(entries, specs):
+                by_proxy.setdefault(getattr(req, "proxy_id", None), []).append(spec["host"])
+            existing: Dict[Tuple[Optional[str], str], Dict[str, Any]] = {}
+            for proxy_id, names in by_proxy.items():
+                res = self._zbx(
+                    "host.get",
+                    {
+                        "output": ["hostid", "host", "name"],
+                        "selectInterfaces": ["interfaceid", "ip", "port", "type"],
+                        "filter": {"host": names},
+                        **({"proxyids": [proxy_id]} if proxy_id else {}),
+                    },
+                )
+                for host in res or []:
+                    existing[(proxy_id, host["host"])] = host
+
+            seen = set()
+            creates, create_idx, updates, interfaces = [], [], [], []
+            host_ids: List[Optional[str]] = [None] * len(entries)
+            for i, ((req, _), spec) in enumerate(zip(entries, specs)):
+                key = (getattr(req, "proxy_id", None), spec["host"])
+                if key in seen:
+                    # 同名主机在一个 host.create 里会整体失败，交给逐台注册处理
+                    raise ValueError(f"duplicate host {spec['host']} in registration batch")
+                seen.add(key)
+                has_jmx = any(tid in jmx_tmpl for tid in spec["tmpl_ids"])
+                host = existing.get(key)
+                if host:
+                    host_ids[i] = host["hostid"]
+                    if has_jmx and not any(int(x.get("type", 0)) == 4 for x in host.get("interfaces", [])):
+                        interfaces.append(self._jmx_interface(req.ip, spec["jmx_port"], host["hostid"]))
+                    updates.append({**spec["base"], "hostid": host["hostid"]})
+                else:
+                    ifaces = [{"type": 1, "main": 1, "useip": 1, "ip": str(req.ip), "dns": "", "port": str(req.port)}]
+                    if has_jmx:
+                        ifaces.append(self._jmx_interface(req.ip, spec["jmx_port"]))
+                    creates.append({**spec["base"], "interfaces": ifaces})
+                    create_idx.append(i)
+            # JMX 接口需先于模板绑定存在
+            if interfaces:
+                self._zbx("hostinterface.create", interfaces)
+            if updates:
+                self._zbx("host.update", updates)
+            if creates:
+                created = self._zbx("host.create", creates)["hostids"]
+                for i, hid in zip(create_idx, created):
+                    host_ids[i] = hid
+        except Exception as exc:
+            LOG.warning("batched registration of %d hosts failed, registering one by one: %s", len(entries), exc)
+            results: List[Any] = []
+            for req, task_id in entries:
+                try:
+                    results.append(self._ensure_host(req, task_id=task_id, log_store=log_store, zabbix_url=zabbix_url))
+                except Exception as one_exc:
+                    if log_store and task_id:
+                        log_store.add(task_id, "注册主机", "failed", str(one_exc), ip=str(req.ip), hostname=req.hostname, host_id=None, zabbix_url=zabbix_url)
+                    results.append(one_exc)
+            return results
+
+        if log_store:
+            created_set = set(create_idx)
+            for i, ((req, task_id), spec) in enumerate(zip(entries, specs)):
+                if not task_id:
+                    continue
+                step, verb = ("注册主机", "created") if i in created_set else ("更新注册信息", "ensured")
+                log_store.add(
+                    task_id,
+                    step,
+                    "ok",
+                    f"host {verb} id={host_ids[i]}; groups={spec['grp_ids']}; templates={spec['tmpl_ids']}; "
+                    f"proxy={getattr(req, 'proxy_id', None) or '-'}; batch={len(entries)}",
+                    ip=str(req.ip),
+                    hostname=spec["host"],
+                    host_id=host_ids[i],
+                    zabbix_url=zabbix_url,
+                )
+        return host_ids
+
     # --------------------------- SSH install/uninstall --------------------------- #
     def _run_steps(
         self,
@@ -607,45 +802,105 @@ class ZabbixService:
         host_id: str | None = None,
         zabbix_url: str | None = None,
         tolerant_steps: Optional[set[str]] = None,
+        script_id: str | None = None,
+        cancel_token: CancelToken | None = None,
+        resume_from: str | None = None,
+        verify_script: str | None = None,
+        checkpoint: Optional[Callable[[Optional[str], Optional[str]], None]] = None,
     ) -> str:
-        """Execute steps one by one; on failure, run rollback script."""
+        """Execute steps one by one; on failure, run rollback script.
+
+        cancel_token is checked between steps and closes the in-flight SSH session on cancel;
+        a cancelled install is rolled back once anything beyond the precheck has started.
+        With resume_from + verify_script, steps already completed by an earlier attempt are
+        verified in one SSH round trip and skipped (including the package upload when it is intact).
+        """
         logs: List[str] = []
         last_step = None
+        ran_steps: List[str] = []
+        if script_id:
+            # 记录脚本模板版本与 hash，便于按脚本追溯/复用
+            LOG.info("run scripts %s on %s", script_id, ip)
+            if log_store and task_id:
+                log_store.add(task_id, "脚本模板", "ok", f"script template {script_id}", ip=str(ip), hostname=hostname, host_id=host_id, zabbix_url=zabbix_url)
         # Tolerant steps: do not fail install if these pre-check/cleanup steps error out
         base_tolerant = {"pre_cleanup", "预清理agent相关文件", "precheck", "检查agent是否运行"}
         tolerant = base_tolerant | set(tolerant_steps or set())
+        names = [step["name"] for step in steps]
+        start = 0
+        if resume_from and verify_script and resume_from in names:
+            # 断点续装：校验上次已完成步骤的产物，从第一个未完成（或校验不通过）的步骤开始
+            if cancel_token:
+                cancel_token.check()
+            try:
+                verified = set(ScriptSet.verified_steps(self._run_ssh(ip, verify_script, ssh_opts=ssh_opts, cancel_token=cancel_token)))
+            except Exception as exc:
+                if cancel_token and cancel_token.cancelled:
+                    raise TaskCancelled() from exc
+                LOG.warning("resume verification failed for %s: %s", ip, exc)
+                verified = set()
+            limit = names.index(resume_from) + 1
+            while start < limit and names[start] in verified:
+                start += 1
+            restart_at = names[start] if start < len(names) else "-"
+            msg = f"checkpoint {resume_from}: {start}/{limit} completed steps verified, restart at {restart_at}"
+            logs.append(f"[断点续装] {msg}")
+            if log_store and task_id:
+                log_store.add(task_id, "断点续装", "ok", msg, ip=str(ip), hostname=hostname, host_id=host_id, zabbix_url=zabbix_url)
+            if checkpoint:
+                checkpoint(names[start - 1] if start else None, None)
+        if DOWNLOAD_STEP in names and start > names.index(DOWNLOAD_STEP):
+            # 安装包已在目标机上且校验通过，无需重新上传
+            preupload_local_path = None
         if preupload_local_path:
             try:
-                self._upload_file(ip, preupload_local_path, remote_tmp, ssh_opts=ssh_opts)
+                self._upload_file(ip, preupload_local_path, remote_tmp, ssh_opts=ssh_opts, cancel_token=cancel_token)
                 if log_store and task_id:
                     log_store.add(task_id, "上传agent安装文件", "ok", f"upload {preupload_local_path} -> {remote_tmp}", ip=str(ip), hostname=hostname, host_id=host_id, zabbix_url=zabbix_url)
+            except TaskCancelled:
+                if log_store and task_id:
+                    log_store.add(task_id, "上传agent安装文件", "cancelled", "cancelled", ip=str(ip), hostname=hostname, host_id=host_id, zabbix_url=zabbix_url)
+                raise
             except Exception as exc:
                 logs.append(f"[{last_step}] failed: {exc}")
                 if log_store and task_id:
                     log_store.add(task_id, "上传agent安装文件", "failed",str(exc), ip=str(ip), hostname=hostname, host_id=host_id, zabbix_url=zabbix_url)
         try:
-            for step in steps:
+            for step in steps[start:]:
                 name = step["name"]
                 script = step["script"]
+                if cancel_token:
+                    cancel_token.check()
                 last_step = name
+                ran_steps.append(name)
                 try:
-                    out = self._run_ssh(ip, script, ssh_opts=ssh_opts)
+                    out = self._run_ssh(ip, script, ssh_opts=ssh_opts, cancel_token=cancel_token)
                 except Exception as exc:
+                    if cancel_token and cancel_token.cancelled:
+                        raise TaskCancelled() from exc
                     if name in tolerant:
                         warn_msg = f"{name} ignored: {exc}"
                         logs.append(f"[{name}] {warn_msg}")
                         if log_store and task_id:
                             log_store.add(task_id, name, "warn", warn_msg, ip=str(ip), hostname=hostname, host_id=host_id, zabbix_url=zabbix_url)
+                        if checkpoint:
+                            checkpoint(name, None)
                         continue
                     raise
                 logs.append(f"[{name}] {out.strip()}")
                 if log_store and task_id:
                     log_store.add(task_id, name, "ok", out.strip(), ip=str(ip), hostname=hostname, host_id=host_id, zabbix_url=zabbix_url)
+                if checkpoint:
+                    checkpoint(name, parse_artifact_hash(out))
             return "\n".join(logs)
         except Exception as exc:
-            logs.append(f"[{last_step}] failed: {exc}")
+            cancelled = isinstance(exc, TaskCancelled)
+            logs.append(f"[{last_step}] {'cancelled' if cancelled else 'failed'}: {exc}")
             if log_store and task_id:
-                log_store.add(task_id, last_step or "unknown", "failed", str(exc), ip=str(ip), hostname=hostname, host_id=host_id, zabbix_url=zabbix_url)
+                log_store.add(task_id, last_step or "unknown", "cancelled" if cancelled else "failed", str(exc), ip=str(ip), hostname=hostname, host_id=host_id, zabbix_url=zabbix_url)
+            # 取消时仅在已执行预检查以外的步骤后回滚
+            if cancelled and not any(n not in {"precheck", "检查agent是否运行"} for n in ran_steps):
+                raise
             if rollback_script:
                 try:
                     ro = self._run_ssh(ip, rollback_script, ssh_opts=ssh_opts)
@@ -656,9 +911,11 @@ class ZabbixService:
                     logs.append(f"[rollback failed] {rex}")
                     if log_store and task_id:
                         log_store.add(task_id, "rollback", "failed", str(rex), ip=str(ip), hostname=hostname, host_id=host_id, zabbix_url=zabbix_url)
+            if cancelled:
+                raise
             raise HTTPException(status_code=500, detail="\n".join(logs))
 
-    def _run_ssh(self, ip, script: str, ssh_opts: Optional[Any] = None) -> str:
+    def _run_ssh(self, ip, script: str, ssh_opts: Optional[Any] = None, cancel_token: CancelToken | None = None) -> str:
         user = getattr(ssh_opts, "ssh_user", None) or settings.ssh_user
         password = getattr(ssh_opts, "ssh_password", None) or settings.ssh_password
         key_path = getattr(ssh_opts, "ssh_key_path", None) or settings.ssh_key_path
@@ -681,25 +938,104 @@ class ZabbixService:
             raise HTTPException(status_code=401, detail=f"SSH 认证失败: {exc}") from exc
         except Exception as exc:
             ssh.close()
-            raise HTTPException(status_code=500, detail=f"SSH 认证失败: {exc}") from exc
-        cmd = f"bash -s <<'EOF'\n{script}\nEOF"
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        out = stdout.read().decode()
-        err = stderr.read().decode()
-        exit_code = stdout.channel.recv_exit_status()
-        ssh.close()
+            raise HTTPException(status_code=500, detail=f"SSH 连接失败: {exc}") from exc
+        # 取消时直接关闭连接，打断阻塞中的 read/recv_exit_status
+        handle = cancel_token.register(ssh.close) if cancel_token else 0
+        try:
+            cmd = f"bash -s <<'EOF'\n{script}\nEOF"
+            stdin, stdout, stderr = ssh.exec_command(cmd)
+            out = stdout.read().decode()
+            err = stderr.read().decode()
+            exit_code = stdout.channel.recv_exit_status()
+        finally:
+            if cancel_token:
+                cancel_token.unregister(handle)
+            ssh.close()
+        if cancel_token:
+            cancel_token.check()
         if exit_code != 0:
-            raise RuntimeError(f"SSH command failed ({exit_code}): {err or out}")
+            raise StepFailed(f"SSH command failed ({exit_code}): {err or out}")
         return out + err
 
-    def _probe_hostname(self, req: InstallRequest) -> str:
+    def _probe_hostname(self, req: InstallRequest, cancel_token: CancelToken | None = None) -> str:
         """Try to read hostname from remote server."""
         script = "hostname -s || hostname"
-        out = self._run_ssh(req.ip, script, ssh_opts=req).strip()
+        out = self._run_ssh(req.ip, script, ssh_opts=req, cancel_token=cancel_token).strip()
         if not out:
             raise RuntimeError("hostname command returned empty")
         return out
 
+    def _script_set(self, cfg: Dict[str, Any], install: bool = True) -> ScriptSet:
+        """Batch-level rendered scripts (cached per distinct config, rendered once per batch).
+
+        install=False (uninstall, dry-run plan) skips the package fingerprint, which only the
+        install marker uses.
+        """
+        install_dir = (cfg.get("agent_install_dir") or settings.agent_install_dir or "/opt/zabbix-agent/").rstrip("/")
+        server = cfg.get("zabbix_server_host") or settings.zabbix_server_host
+        tgz_url = cfg.get("agent_tgz_url") or settings.agent_tgz_url or ""
+        return render_scripts(install_dir, server, tgz_url, self._package_fingerprint(cfg) if install else "")
+
+    def _probe_agent_state(self, req: InstallRequest, cfg: Dict[str, Any], cancel_token: CancelToken | None = None) -> Dict[str, str]:
+        """Collect hostname and agent fingerprint (marker, config/binary hash, unit state) in one SSH call."""
+        out = self._run_ssh(req.ip, self._script_set(cfg).fingerprint, ssh_opts=req, cancel_token=cancel_token)
+        state: Dict[str, str] = {}
+        for line in out.splitlines():
+            key, sep, value = line.partition("=")
+            if sep:
+                state[key.strip()] = value.strip()
+        return state
+
+    def _desired_fingerprint(self, req: InstallRequest, cfg: Dict[str, Any]) -> Dict[str, str]:
+        server = cfg.get("zabbix_server_host") or settings.zabbix_server_host
+        install_dir = (cfg.get("agent_install_dir") or settings.agent_install_dir or "/opt/zabbix-agent/").rstrip("/")
+        conf = agent_config_text(server, req.hostname or str(req.ip), install_dir)
+        return {
+            "package": self._package_fingerprint(cfg),
+            "config": hashlib.sha256(conf.encode()).hexdigest(),
+        }
+
+    @staticmethod
+    def _agent_is_current(state: Dict[str, str], desired: Dict[str, str]) -> bool:
+        """True when the remote marker, config, binary and unit state all match the desired install."""
+        if not desired.get("package") or state.get("marker_package") != desired["package"]:
+            return False
+        # URL 安装包：目标主机上 HEAD 得到的 ETag/Last-Modified 与安装时记录的不同，说明包已重新发布。
+        # 任一侧为空（服务器不返回这些头、目标访问不到 URL、升级前的旧 marker）时只按 URL 判断。
+        cur_meta, marker_meta = state.get("cur_package_meta"), state.get("marker_package_meta")
+        if desired["package"].startswith("url:") and cur_meta and marker_meta and cur_meta != marker_meta:
+            return False
+        if not (state.get("marker_config") == state.get("cur_config") == desired.get("config")):
+            return False
+        if not state.get("cur_binary") or state.get("marker_binary") != state.get("cur_binary"):
+            return False
+        return state.get("enabled") == "enabled" and state.get("active") == "active"
+
+    _package_hash_cache: Dict[tuple, str] = {}
+
+    def _package_fingerprint(self, cfg: Dict[str, Any]) -> str:
+        """Identify the agent package: sha256 of local_agent_path (cached by size/mtime) or the download URL.
+
+        A URL package republished under the same URL is told apart on the target itself: the marker
+        keeps the HTTP validators seen at download time and the probe compares them with a fresh
+        HEAD (see _agent_is_current).
+        """
+        local_path = cfg.get("local_agent_path")
+        if local_path and os.path.exists(local_path):
+            st = os.stat(local_path)
+            key = (local_path, st.st_size, st.st_mtime_ns)
+            digest = self._package_hash_cache.get(key)
+            if digest is None:
+                h = hashlib.sha256()
+                with open(local_path, "rb") as fh:
+                    for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                        h.update(chunk)
+                digest = h.hexdigest()
+                self._package_hash_cache[key] = digest
+            return f"sha256:{digest}"
+        tgz_url = cfg.get("agent_tgz_url") or settings.agent_tgz_url
+        return f"url:{tgz_url}" if tgz_url else ""
+
     def _zbx_version(self) -> tuple[int, int]:
         ver_raw = self.config_store.get().get("zabbix_version") or settings.zabbix_version or "6.0"
         try:
@@ -768,7 +1104,7 @@ class ZabbixService:
             return res["httptestids"][0]
         return str(res)
 
-    def _upload_file(self, ip, local_path: str, remote_path: str, ssh_opts: Optional[Any] = None) -> None:
+    def _upload_file(self, ip, local_path: str, remote_path: str, ssh_opts: Optional[Any] = None, cancel_token: CancelToken | None = None) -> None:
         if not os.path.exists(local_path):
             raise HTTPException(status_code=400, detail=f"local_agent_path not found: {local_path}")
         user = getattr(ssh_opts, "ssh_user", None) or settings.ssh_user
@@ -794,6 +1130,7 @@ class ZabbixService:
         except Exception as exc:
             ssh.close()
             raise HTTPException(status_code=500, detail=f"SFTP 服务器认证失败: {exc}") from exc
+        handle = cancel_token.register(ssh.close) if cancel_token else 0
         try:
             sftp = ssh.open_sftp()
             sftp.put(local_path, remote_path)
@@ -801,6 +1138,9 @@ class ZabbixService:
             ssh.close()
             return
         except Exception as sftp_exc:
+            if cancel_token and cancel_token.cancelled:
+                ssh.close()
+                raise TaskCancelled() from sftp_exc
             LOG.warning("SFTP upload failed (%s), fallback to stdin copy", sftp_exc)
             try:
                 chan = ssh.get_transport().open_session()
@@ -813,357 +1153,39 @@ class ZabbixService:
                         chan.sendall(chunk)
                 chan.shutdown_write()
                 exit_status = chan.recv_exit_status()
+                if cancel_token:
+                    cancel_token.check()
                 if exit_status != 0:
                     raise RuntimeError(f"fallback upload failed, exit {exit_status}")
             finally:
                 ssh.close()
-
-    def _linux_install_steps(self, req: InstallRequest) -> (List[Dict[str, str]], str, Optional[str], str):
-        cfg = self.config_store.get()
+        finally:
+            if cancel_token:
+                cancel_token.unregister(handle)
+
+    def _linux_install_steps(
+        self, req: InstallRequest, cfg: Dict[str, Any] | None = None, artifact_hash: str | None = None
+    ) -> (List[Dict[str, str]], str, Optional[str], str, str, str):
+        cfg = cfg if cfg is not None else self.config_store.get()
         if not cfg.get("agent_tgz_url") and not cfg.get("local_agent_path") and not settings.agent_tgz_url:
             raise HTTPException(status_code=400, detail="ZABBIX_AGENT_TGZ_URL or local_agent_path not configured")
-        server = cfg.get("zabbix_server_host") or settings.zabbix_server_host
-        host = req.hostname or str(req.ip)
-        agent_hostname = host
-        install_dir = (cfg.get("agent_install_dir") or settings.agent_install_dir or "/opt/zabbix-agent/").rstrip("/")
-        unit_name = "zabbix-agent.service"
-        tgz_url = cfg.get("agent_tgz_url") or settings.agent_tgz_url
+        scripts = self._script_set(cfg)
         local_path = cfg.get("local_agent_path")
-        remote_tmp = "/tmp/zabbix-agent2.tgz"
         preupload = local_path if local_path else None
+        prelude = host_prelude(
+            hostname=req.hostname or str(req.ip),
+            port=req.port,
+            proxy_id=getattr(req, "proxy_id", None),
+            config_sha=self._desired_fingerprint(req, cfg)["config"],
+        )
+        steps = scripts.install_steps(prelude, precheck=getattr(req, "precheck", True))
+        verify = scripts.verify_script(prelude, artifact_hash)
+        return steps, scripts.rollback, preupload, REMOTE_TMP, f"v{scripts.version}/{scripts.digest[:12]}", verify
 
-        steps: List[Dict[str, str]] = [
-            {
-                "name": "检查agent是否运行",
-                "script": f"""
-set +e
-INSTALL_DIR={install_dir}
-PORT={req.port}
-UNIT=/etc/systemd/system/{unit_name}
-
-echo "[CHECK] systemd unit"
-if command -v systemctl >/dev/null 2>&1; then
-  systemctl list-unit-files | grep -q "^{unit_name}" && systemctl status {unit_name} --no-pager -l || echo "unit not present"
-else
-  echo "systemctl not available"
-fi
-
-echo "[CHECK] running processes"
-ps -ef | grep -E "zabbix_agent(d|2)" | grep -v grep || echo "no running zabbix_agent"
-
-echo "[CHECK] config files"
-for f in "/etc/zabbix/zabbix_agentd.conf" "$INSTALL_DIR/conf/zabbix_agentd.conf" "$INSTALL_DIR/etc/zabbix_agent2.conf"; do
-  [ -f "$f" ] && echo "found conf: $f" || true
-done
-
-echo "[CHECK] port {req.port}"
-if command -v ss >/dev/null 2>&1; then
-  ss -ltnp | grep :$PORT || echo "port {req.port} not in use"
-elif command -v netstat >/dev/null 2>&1; then
-  netstat -ltnp | grep :$PORT || echo "port {req.port} not in use"
-else
-  echo "ss/netstat not available"
-fi
-
-echo "[CHECK] proxy hint"
-if [ -n "{getattr(req, 'proxy_id', '')}" ]; then
-  echo "proxy_id provided: {getattr(req, 'proxy_id', '')}"
-else
-  echo "no proxy_id provided"
-fi
-
-echo "precheck done"
-exit 0
-""",
-            } if getattr(req, "precheck", True) else None,
-            {
-                "name": "预清理agent相关文件",
-                "script": f"""
-set +e
-INSTALL_DIR={install_dir}
-UNIT=/etc/systemd/system/{unit_name}
-PIDFILE=$INSTALL_DIR/zabbix_agent.pid
-UNIT_EXISTS=0
-if command -v systemctl >/dev/null 2>&1; then
-  if systemctl list-unit-files | grep -q "^{unit_name}"; then
-    UNIT_EXISTS=1
-  fi
-fi
-
-if [ "$UNIT_EXISTS" = "1" ]; then
-  echo "found existing service {unit_name}, stopping/disabling..."
-  sudo systemctl stop {unit_name} || true
-  sudo systemctl disable {unit_name} || true
-else
-  echo "no existing systemd unit {unit_name}"
-fi
-
-if [ -f "$PIDFILE" ]; then
-  PID=$(cat "$PIDFILE")
-  if kill -0 "$PID" >/dev/null 2>&1; then
-    echo "killing pid from pidfile: $PID"
-    sudo kill "$PID" || true
-    sleep 1
-  fi
-  sudo rm -f "$PIDFILE"
-fi
-
-PIDS=$(pgrep -f "zabbix_agent" || true)
-if [ -n "$PIDS" ]; then
-  echo "killing existing zabbix_agent processes: $PIDS"
-  sudo kill $PIDS || true
-  sleep 1
-else
-  echo "no running zabbix_agent processes"
-fi
-
-sudo rm -f "$UNIT"
-sudo rm -rf "$INSTALL_DIR"
-if command -v systemctl >/dev/null 2>&1; then
-  sudo systemctl daemon-reload || true
-fi
-echo "pre-clean done (unit removed, dir cleaned)"
-exit 0
-""",
-            },
-            {
-                "name": "下载agent安装文件",
-                "script": f"""
-set -e
-umask 022
-TMP_TGZ={remote_tmp}
-if [ -f "$TMP_TGZ" ]; then
-  echo "use pre-uploaded: $TMP_TGZ"
-elif [ -n "{tgz_url or ''}" ]; then
-  curl -fsSL "{tgz_url or ''}" -o "$TMP_TGZ"
-  echo "download ok: $TMP_TGZ"
-else
-  echo "no agent package available" >&2
-  exit 1
-fi
-""",
-            },
-            {
-                "name": "解压agent配置文件",
-                "script": f"""
-set -e
-TMP_TGZ={remote_tmp}
-INSTALL_DIR={install_dir}
-sudo mkdir -p "$INSTALL_DIR"
-sudo tar -xzf "$TMP_TGZ" -C "$INSTALL_DIR" --strip-components=1
-echo "extract ok -> $INSTALL_DIR"
-""",
-            },
-            {
-                "name": "agent配置文件写入",
-                "script": f"""
-set -e
-INSTALL_DIR={install_dir}
-CONF=$INSTALL_DIR/conf/zabbix_agentd.conf
-LOG_FILE=$INSTALL_DIR/logs/zabbix_agentd.log
-LOG_DIR=$(dirname "$LOG_FILE")
-sudo mkdir -p "$(dirname "$CONF")" "$LOG_DIR"
-sudo touch "$LOG_FILE"
-sudo chmod 755 "$LOG_DIR"
-sudo chmod 644 "$LOG_FILE"
-sudo cat > "$CONF" <<EOFCONF
-Server={server}
-ServerActive={server}
-Hostname={agent_hostname}
-LogFileSize=0
-LogFile=$LOG_FILE
-PidFile=$INSTALL_DIR/zabbix_agent.pid
-AllowRoot=1
-User=root
-EOFCONF
-echo "config ok -> $CONF"
-""",
-            },
-            {
-                "name": "system启动方式注册",
-                "script": rf"""
-set -e
-INSTALL_DIR={install_dir}
-CONF=$INSTALL_DIR/conf/zabbix_agentd.conf
-PIDFILE=$INSTALL_DIR/zabbix_agent.pid
-UNIT=/etc/systemd/system/{unit_name}
-
-if ! command -v systemctl >/dev/null 2>&1; then
-  echo "systemctl not found; system service install required" >&2
-  exit 1
-fi
-
-# stop old process (if any)
-PIDS=$(ps -ef | grep zabbix_agent | grep -v grep | awk '{{print $2}}')
-if [ -n "$PIDS" ]; then
-  echo "killing existing zabbix_agent: $PIDS"
-  sudo kill $PIDS || true
-  sleep 1
-fi
-sudo rm -f "$PIDFILE"
-
-BIN=$INSTALL_DIR/sbin/zabbix_agentd
-ALT_BIN=$INSTALL_DIR/sbin/zabbix_agent2
-if [ ! -x "$BIN" ] && [ -x "$ALT_BIN" ]; then
-  BIN=$ALT_BIN
-fi
-if [ ! -x "$BIN" ]; then
-  BIN=$(find "$INSTALL_DIR" -type f \( -name 'zabbix_agentd' -o -name 'zabbix_agent2' \) | head -n 1)
-fi
-if [ -z "$BIN" ] || [ ! -x "$BIN" ]; then
-  echo "agent binary missing under $INSTALL_DIR" >&2
-  exit 1
-fi
-
-if command -v systemctl >/dev/null 2>&1 && systemctl list-unit-files | grep -q "^{unit_name}"; then
-  sudo systemctl stop {unit_name} || true
-  sudo systemctl disable {unit_name} || true
-fi
-sudo rm -f "$UNIT"
-
-sudo cat > "$UNIT" <<EOFUNIT
-[Unit]
-Description=Zabbix Agent
-After=network.target
-
-[Service]
-Type=simple
-ExecStart=$BIN -c $CONF
-Restart=on-failure
-User=root
-Group=root
-PIDFile=$PIDFILE
-WorkingDirectory=$INSTALL_DIR
-
-[Install]
-WantedBy=multi-user.target
-EOFUNIT
-echo "unit written -> $UNIT (bin=$BIN)"
-""",
-            },
-            {
-                "name": "开启agent服务",
-                "script": f"""
-set -e
-sudo systemctl daemon-reload
-sudo systemctl enable --now {unit_name}
-sudo systemctl status {unit_name} --no-pager -l || true
-echo "service enabled and started: {unit_name}"
-""",
-            },
-        ]
-        steps = [s for s in steps if s]
-        rollback = self._linux_uninstall_script()
-        return steps, rollback, preupload, remote_tmp
+    def _linux_uninstall_script(self, cfg: Dict[str, Any] | None = None) -> str:
+        cfg = cfg if cfg is not None else self.config_store.get()
+        return self._script_set(cfg, install=False).rollback
 
-    def _linux_uninstall_script(self) -> str:
-        cfg = self.config_store.get()
-        install_dir = (cfg.get("agent_install_dir") or settings.agent_install_dir or "/opt/zabbix-agent/").rstrip("/")
-        unit_name = "zabbix-agent.service"
-        unit_path = f"/etc/systemd/system/{unit_name}"
-        pid_file = f"{install_dir}/zabbix_agent.pid"
-        bin_pattern = "zabbix_agent"
-        script = rf"""
-set +e
-echo "[STEP] stop agent"
-UNIT_EXISTS=0
-if command -v systemctl >/dev/null 2>&1; then
-  if systemctl list-unit-files | grep -q "^{unit_name}"; then
-    UNIT_EXISTS=1
-  fi
-fi
-if [ "$UNIT_EXISTS" = "1" ]; then
-  echo "stopping systemd unit {unit_name}"
-  sudo systemctl stop {unit_name} || true
-  sudo systemctl disable {unit_name} || true
-else
-  echo "no systemd unit {unit_name} registered; skip stop"
-fi
-if [ -f "{pid_file}" ]; then
-  PID=$(cat "{pid_file}")
-  if kill -0 "$PID" >/dev/null 2>&1; then
-    echo "killing pid from pidfile: $PID"
-    sudo kill "$PID" || true
-    sleep 1
-  fi
-  sudo rm -f "{pid_file}"
-fi
-PIDS=$(pgrep -f "{bin_pattern}" || true)
-if [ -n "$PIDS" ]; then
-  echo "pkill processes: $PIDS"
-  sudo kill $PIDS || true
-  sleep 1
-else
-  echo "no running {bin_pattern} processes"
-fi
-sudo rm -f "{unit_path}"
-if command -v systemctl >/dev/null 2>&1; then
-  sudo systemctl daemon-reload || true
-fi
-echo "[OK] stop agent"
-echo "[STEP] clean files"
-sudo rm -rf {install_dir}
-echo "[OK] clean files"
-exit 0
-"""
-        return script
-
-    def _linux_uninstall_steps(self) -> List[Dict[str, str]]:
-        cfg = self.config_store.get()
-        install_dir = (cfg.get("agent_install_dir") or settings.agent_install_dir or "/opt/zabbix-agent/").rstrip("/")
-        unit_name = "zabbix-agent.service"
-        unit_path = f"/etc/systemd/system/{unit_name}"
-        pid_file = f"{install_dir}/zabbix_agent.pid"
-        bin_pattern = "zabbix_agent"
-        return [
-            {
-                "name": "stop_agent",
-                "script": rf"""
-set +e
-UNIT_EXISTS=0
-if command -v systemctl >/dev/null 2>&1; then
-  if systemctl list-unit-files | grep -q "^{unit_name}"; then
-    UNIT_EXISTS=1
-  fi
-fi
-if [ "$UNIT_EXISTS" = "1" ]; then
-  echo "stopping systemd unit {unit_name}"
-  sudo systemctl stop {unit_name} || true
-  sudo systemctl disable {unit_name} || true
-else
-  echo "no systemd unit {unit_name} registered; skip stop"
-fi
-if [ -f "{pid_file}" ]; then
-  PID=$(cat "{pid_file}")
-  if kill -0 "$PID" >/dev/null 2>&1; then
-    echo "killing pid from pidfile: $PID"
-    sudo kill "$PID" || true
-    sleep 1
-  fi
-  sudo rm -f "{pid_file}"
-fi
-PIDS=$(pgrep -f "{bin_pattern}" || true)
-if [ -n "$PIDS" ]; then
-  echo "pkill processes: $PIDS"
-  sudo kill $PIDS || true
-  sleep 1
-else
-  echo "no running {bin_pattern} processes"
-fi
-sudo rm -f "{unit_path}"
-if command -v systemctl >/dev/null 2>&1; then
-  sudo systemctl daemon-reload || true
-fi
-echo "agent stopped"
-exit 0
-""",
-            },
-            {
-                "name": "clean_files",
-                "script": rf"""
-set -e
-sudo rm -rf {install_dir}
-echo "files cleaned"
-""",
-            },
-        ]
+    def _linux_uninstall_steps(self, cfg: Dict[str, Any] | None = None) -> List[Dict[str, str]]:
+        cfg = cfg if cfg is not None else self.config_store.get()
+        return self._script_set(cfg, install=False).uninstall_steps()
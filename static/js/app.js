@@ -794,8 +794,8 @@ function renderBatchTable() {
         const checked = State.batchSelection.has(id) ? 'checked' : '';
         const res = State.batchResults[id] || {};
         const statusRaw = (res.status || '').toLowerCase();
-        const statusClass = (['ok','installed','uninstalled','registered'].includes(statusRaw)) ? 'ok'
-                            : (['installing','running','in-progress'].includes(statusRaw) ? 'installing' : 'failed');
+        const statusClass = (['ok','installed','current','uninstalled','registered'].includes(statusRaw)) ? 'ok'
+                            : (['installing','retrying','running','in-progress'].includes(statusRaw) ? 'installing' : 'failed');
         const statusColor = statusClass === 'ok' ? '#10b981'
                             : (statusClass === 'failed' ? '#ef4444'
                             : '#0ea5e9');
@@ -1782,7 +1782,7 @@ async function pollBatchQueue(queueId) {
             // 将安装中的行标记为 failed: cancelled
             Object.keys(State.batchResults).forEach(id => {
                 const r = State.batchResults[id] || {};
-                if (!r.status || r.status === 'installing') {
+                if (!r.status || r.status === 'installing' || r.status === 'retrying') {
                     State.batchResults[id] = { ...r, status: 'failed', error: 'cancelled' };
                 }
             });
@@ -1801,7 +1801,7 @@ async function cancelBatchQueue() {
         // 立即标记状态为取消，等待轮询刷新结果
         Object.keys(State.batchResults).forEach(id => {
             const r = State.batchResults[id] || {};
-            if (r.status === 'installing' || r.status === 'pending' || !r.status) {
+            if (r.status === 'installing' || r.status === 'retrying' || r.status === 'pending' || !r.status) {
                 State.batchResults[id] = { ...r, status: 'failed', error: 'cancelled' };
             }
         });
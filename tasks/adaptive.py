@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import math
+import time
+from typing import List, Optional, Tuple
+
+
+class ConcurrencyController:
+    """Gradient controller for one queue's host parallelism.
+
+    Host completions are collected in windows (at least `level` hosts or `window` seconds).
+    After each window the target is `level * baseline/latency + sqrt(level)`. Here `baseline`
+    is the best per-host latency seen by this queue, so the level grows while hosts finish as fast as they
+    did at low parallelism and shrinks once extra hosts only queue up (SSH, SFTP or Zabbix
+    saturation). Two guards apply: a growth step that lowered goodput (successful hosts/s) is
+    backed off, and a load-error rate (connect/API failures) above `error_threshold` cuts the
+    level multiplicatively. The level always stays within [lo, hi].
+    """
+
+    def __init__(self, start: int, lo: int, hi: int, window: float = 5.0, error_threshold: float = 0.2):
+        self.lo = max(1, lo)
+        self.hi = max(self.lo, hi)
+        self.level = min(self.hi, max(self.lo, start))
+        self.window = window
+        self.error_threshold = error_threshold
+        self._baseline: Optional[float] = None
+        self._prev_rate: Optional[float] = None
+        self._grew = False
+        self._samples: List[Tuple[float, bool, bool]] = []
+        self._window_start = time.monotonic()
+
+    def record(self, duration: float, ok: bool, load_error: bool = False) -> Optional[int]:
+        """Add one host outcome; returns the new level when it changed, else None."""
+        self._samples.append((duration, ok, load_error))
+        elapsed = time.monotonic() - self._window_start
+        if len(self._samples) < max(3, self.level) and elapsed < self.window:
+            return None
+        return self._adjust(max(elapsed, 1e-3))
+
+    def _adjust(self, elapsed: float) -> Optional[int]:
+        samples, self._samples = self._samples, []
+        self._window_start = time.monotonic()
+        rate = sum(1 for _, ok, _ in samples if ok) / elapsed
+        error_rate = sum(1 for _, _, err in samples if err) / len(samples)
+        # 时延只看成功的主机，快速失败（如端口拒绝）不能拉低 baseline
+        ok_durations = [d for d, ok, _ in samples if ok]
+        old = self.level
+        if error_rate >= self.error_threshold:
+            # 连接/接口错误增多：乘性降低
+            target = min(self.level - 1, int(self.level * 0.7))
+            self._prev_rate = None
+        elif not ok_durations:
+            target = self.level
+        else:
+            latency = max(1e-3, sum(ok_durations) / len(ok_durations))
+            # baseline 取本队列观测到的最小时延（控制器随队列创建，生命周期仅一个批次）
+            self._baseline = latency if self._baseline is None else min(latency, self._baseline)
+            gradient = max(0.5, min(1.0, self._baseline / latency))
+            target = int(round(self.level * gradient + math.sqrt(self.level)))
+            if self._grew and self._prev_rate is not None and rate < self._prev_rate * 0.9:
+                # 上次扩容反而降低了吞吐：回退
+                target = min(target, self.level - 1)
+            self._prev_rate = rate
+        self.level = min(self.hi, max(self.lo, target))
+        self._grew = self.level > old
+        return self.level if self.level != old else None
@@ -1,201 +1,879 @@
 from __future__ import annotations
 
-import json
+import heapq
+import ipaddress
+import itertools
+import logging
+import os
+import socket
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Dict, List
+import uuid
+from collections import deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Any, Deque, Dict, List, Optional
 
 from schemas.models import InstallRequest, UninstallRequest, RegisterRequest
 from core.settings import get_settings
+from services.cancel import CancelToken, TaskCancelled
+from tasks.adaptive import ConcurrencyController
+from tasks.recovery import recover_interrupted
+from tasks.retry import RetryPolicy, classify_failure
+
+LOG = logging.getLogger(__name__)
+
+
+class _QueueRun:
+    """In-memory scheduling state of one running batch_queue row."""
+
+    def __init__(self, task: Dict[str, Any], hosts: List[Dict[str, Any]], cap: int, retry: RetryPolicy, leased: bool = False):
+        self.task = task
+        self.qid: str = task["id"]
+        self.batch_id: str = task["batch_id"]
+        self.action: str = task.get("action", "install")
+        self.payload: Dict[str, Any] = task.get("payload") or {}
+        self.priority: int = int(task.get("priority") or 0)
+        self.hosts = hosts
+        self.host_map: Dict[str, Dict[str, Any]] = {str(h.get("item_id")): h for h in hosts}
+        # lease 模式下主机按需从 batch_leases 领取，pending 只保存已领取未启动的主机
+        self.leased = leased
+        self.exhausted = False
+        self.pending: Deque[Dict[str, Any]] = deque() if leased else deque(hosts)
+        self.cap = cap
+        self.inflight = 0
+        self.completed = 0
+        self.failed = 0
+        self.finished = False
+        self.cancelled = False
+        # 在途主机的取消令牌与 future（按 item_id）
+        self.tokens: Dict[str, CancelToken] = {}
+        self.futures: Dict[str, Future] = {}
+        # 断点续装：item_id -> 上次结果中的 last_step / artifact_hash
+        self.checkpoints: Dict[str, Dict[str, Any]] = {}
+        # 自动重试：item_id -> 已重试次数；等待退避到期的主机（不占用线程）
+        self.retry = retry
+        self.attempts: Dict[str, int] = {}
+        self.delayed: Dict[str, Dict[str, Any]] = {}
+        # 自适应并发：为 None 时 cap 固定（payload 指定了 concurrency 或关闭了 BATCH_ADAPTIVE）
+        self.controller: Optional[ConcurrencyController] = None
+        self.started: Dict[str, float] = {}
+        # 流水线：SSH 阶段已完成、正在等待/执行注册或 web 监控阶段的主机数
+        self.staged = 0
+        # 主机所属的限流分组（proxy / CIDR），按 item_id 缓存
+        self.groups: Dict[str, tuple] = {}
+
+    def can_dispatch(self) -> bool:
+        return not self.finished and bool(self.pending) and self.inflight < self.cap
+
+    def drained(self) -> bool:
+        return (
+            not self.pending
+            and self.inflight == 0
+            and self.staged == 0
+            and not self.delayed
+            and (not self.leased or self.exhausted)
+        )
 
 
 class BatchWorker:
-    """Background worker to process queued batch install/uninstall tasks."""
+    """Background worker to process queued batch install/uninstall tasks.
+
+    All running queues share one host-level thread pool (`batch_concurrency`). Each queue is
+    capped (`batch_queue_concurrency` or payload `concurrency`); free slots go to the highest
+    priority queue first, then to the queue with the fewest hosts in flight (fair share), then
+    to the queue with the fewest hosts left so small jobs finish fast.
 
-    def __init__(self, svc, log_store, batch_store):
+    With `batch_adaptive` each queue's cap is tuned between `batch_concurrency_min/max` by a
+    ConcurrencyController fed with host durations and outcomes; the current level is stored on
+    the queue row. Retryable host failures (see tasks.retry) wait in a due-time heap and are put
+    back at the front of their queue by the scheduler once the backoff expires.
+
+    mode="lease" lets several processes on one host share one database: queues are activated
+    atomically, hosts are claimed from `batch_leases` with expiring leases renewed by a
+    heartbeat thread, and hosts of a crashed worker are reclaimed once their lease expires.
+
+    With `batch_pipeline` an install is split into stages with their own threads: the host pool
+    only runs SSH work; finished hosts wait in a bounded registration queue that is drained in
+    batches through svc.register_hosts() (array-params host.create/host.update); hosts with web
+    monitor URLs then go to the web pool. A full downstream queue pauses the stage before it.
+    stage_stats() reports the backlog of every stage.
+
+    Hosts are also capped per group across all queues: per proxy_id (`batch_proxy_concurrency`)
+    and per CIDR (`batch_subnet_groups`). A host whose group is full is skipped in favour of the
+    next pending host of another group, so one remote site cannot take the whole pool.
+    """
+
+    def __init__(self, svc, log_store, batch_store, mode: str | None = None):
         self.svc = svc
         self.log_store = log_store
         self.batch_store = batch_store
         self.settings = get_settings()
+        self.mode = (mode or getattr(self.settings, "batch_worker_mode", "embedded") or "embedded").lower()
+        self._lease = self.mode == "lease"
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._lease_seconds = max(5, getattr(self.settings, "batch_lease_seconds", 60))
+        self._base_concurrency = max(1, getattr(self.settings, "batch_concurrency", 5))
+        self._adaptive = bool(getattr(self.settings, "batch_adaptive", False))
+        self._level_min = max(1, getattr(self.settings, "batch_concurrency_min", 1))
+        self._level_max = max(self._level_min, getattr(self.settings, "batch_concurrency_max", self._base_concurrency))
+        # 自适应时线程池按上限开，线程按需创建
+        self._pool_size = max(self._base_concurrency, self._level_max) if self._adaptive else self._base_concurrency
+        self._pool = ThreadPoolExecutor(max_workers=self._pool_size, thread_name_prefix="batch-host")
+        self._lock = threading.RLock()
+        self._runs: Dict[str, _QueueRun] = {}
+        self._inflight = 0
+        self._delayed: List[tuple] = []
+        self._delay_seq = itertools.count()
+        # 分组限流：proxy / 网段 -> 在途主机数（只计 SSH 阶段）
+        self._proxy_limit = max(0, getattr(self.settings, "batch_proxy_concurrency", 0) or 0)
+        self._subnet_limits = self._parse_subnet_groups(getattr(self.settings, "batch_subnet_groups", "") or "")
+        self._group_inflight: Dict[str, int] = {}
+        # 结果按完成顺序进入缓冲，按条数/时间分组写入 batch_results
+        self._flush_size = max(1, getattr(self.settings, "batch_result_flush_size", 50))
+        self._flush_interval = max(1, getattr(self.settings, "batch_result_flush_ms", 200)) / 1000.0
+        self._results_buf: List[tuple] = []
+        self._results_cv = threading.Condition()
+        self._flush_lock = threading.Lock()
         self._stop = threading.Event()
+        # 流水线阶段：注册（批量 API 调用）与 web 监控各自独立的线程池和有界队列
+        self._pipeline = bool(getattr(self.settings, "batch_pipeline", False))
+        self._stage_limit = max(1, getattr(self.settings, "batch_stage_queue_size", 200))
+        self._register_workers = max(1, getattr(self.settings, "batch_register_workers", 2))
+        self._register_size = max(1, getattr(self.settings, "batch_register_batch_size", 50))
+        self._register_linger = max(0, getattr(self.settings, "batch_register_linger_ms", 300)) / 1000.0
+        self._stage_cv = threading.Condition(self._lock)
+        self._register_q: Deque[tuple] = deque()
+        self._register_active = 0
+        self._register_calls = 0
+        self._register_hosts = 0
+        self._web_queued = 0
+        self._web_active = 0
+        self._register_pool = None
+        self._web_pool = None
+        self._stage_thread = None
+        if self._pipeline:
+            self._register_pool = ThreadPoolExecutor(max_workers=self._register_workers, thread_name_prefix="batch-register")
+            self._web_workers = max(1, getattr(self.settings, "batch_web_workers", 4))
+            self._web_pool = ThreadPoolExecutor(max_workers=self._web_workers, thread_name_prefix="batch-web")
+            self._stage_thread = threading.Thread(target=self._register_loop, daemon=True)
+            self._stage_thread.start()
         self._thread = threading.Thread(target=self._loop, daemon=True)
         self._thread.start()
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+        self._heartbeat = None
+        if self._lease:
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+            self._heartbeat.start()
 
     def stop(self):
         self._stop.set()
+        self.batch_store.notify()
+        with self._results_cv:
+            self._results_cv.notify_all()
+        with self._stage_cv:
+            self._stage_cv.notify_all()
         self._thread.join(timeout=2)
+        self._flusher.join(timeout=2)
+        self._pool.shutdown(wait=False)
+        if self._pipeline:
+            self._stage_thread.join(timeout=2)
+            self._register_pool.shutdown(wait=False)
+            self._web_pool.shutdown(wait=False)
+        self._flush_results()
+        if self._lease:
+            # 已领取但未启动的主机立即还回，其他 worker 无需等待租约过期
+            with self._lock:
+                unstarted = [(r.qid, [str(h.get("item_id")) for h in r.pending]) for r in self._runs.values()]
+            for qid, ids in unstarted:
+                if ids:
+                    self.batch_store.release_hosts(qid, self.worker_id, ids)
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stop.wait(self._lease_seconds / 3):
+            try:
+                self.batch_store.renew_leases(self.worker_id, self._lease_seconds)
+            except Exception as exc:
+                LOG.warning("renew batch leases failed: %s", exc)
 
     def _loop(self):
+        poll_interval = max(1, getattr(self.settings, "batch_poll_interval", 30))
+        if self._lease:
+            # 其他进程的入队/取消无法直接唤醒本进程，缩短轮询间隔
+            poll_interval = max(0.1, getattr(self.settings, "batch_lease_poll_ms", 1000) / 1000.0)
+        else:
+            # 内嵌模式下 running 状态的队列只能属于已退出的上一个进程；lease 模式靠租约过期回收
+            try:
+                recover_interrupted(
+                    self.batch_store,
+                    self.log_store,
+                    policy=getattr(self.settings, "batch_recovery", "requeue"),
+                    max_recoveries=getattr(self.settings, "batch_recovery_max", 3),
+                )
+            except Exception as exc:
+                LOG.exception("batch crash recovery failed: %s", exc)
         while not self._stop.is_set():
+            try:
+                self._start_pending()
+                self._check_cancelled()
+                self._dispatch()
+            except Exception as exc:
+                LOG.exception("batch scheduler iteration failed: %s", exc)
+            # enqueue()/cancel_queue() 会直接唤醒；超时轮询仅用于发现其他进程写入的任务
+            self.batch_store.wait_for_work(self._next_wait(poll_interval))
+
+    # -------------------- queue lifecycle -------------------- #
+    def _start_pending(self) -> None:
+        """Move every pending queue row into the scheduler (lease mode: also adopt running queues)."""
+        while True:
             task = self.batch_store.next_pending()
             if not task:
-                time.sleep(2)
-                continue
+                break
             try:
-                if self.batch_store.is_cancelled(task["id"]):
-                    self.batch_store.finish_queue(task["id"], status="cancelled", error="用户取消")
-                    continue
-                self._process_queue(task)
+                self._start_queue(task)
             except Exception as exc:
-                # Best-effort logging to console/file
-                import logging
+                LOG.exception("batch queue task failed: %s", exc)
+                self.batch_store.finish_queue(task["id"], status="failed", error=str(exc))
+        if self._lease:
+            for task in self.batch_store.claimable_queues():
+                with self._lock:
+                    if task["id"] in self._runs:
+                        continue
+                batch = self.batch_store.get(task.get("batch_id"))
+                if batch:
+                    self._add_run(task, batch, self._select_hosts(task, batch))
 
-                logging.getLogger(__name__).exception("batch queue task failed: %s", exc)
+    @staticmethod
+    def _select_hosts(task: Dict[str, Any], batch: Dict[str, Any]) -> List[Dict[str, Any]]:
+        hosts = batch.get("hosts", [])
+        host_ids = task.get("host_ids") or []
+        if host_ids:
+            host_ids_set = {str(h) for h in host_ids}
+            hosts = [h for h in hosts if str(h.get("item_id")) in host_ids_set]
+        return hosts
 
-    def _process_queue(self, task: Dict[str, Any]):
+    def _start_queue(self, task: Dict[str, Any]) -> None:
         qid = task["id"]
-        self.batch_store.start_queue(qid)
-        payload = task.get("payload", {})
-        action = task.get("action", "install")
-        host_ids = task.get("host_ids") or []
         batch = self.batch_store.get(task.get("batch_id"))
         if not batch:
             self.batch_store.finish_queue(qid, status="failed", error="batch not found")
             return
-        hosts = batch.get("hosts", [])
-        if host_ids:
-            host_ids_set = {str(h) for h in host_ids}
-            hosts = [h for h in hosts if str(h.get("item_id")) in host_ids_set]
+        hosts = self._select_hosts(task, batch)
+        if self._lease:
+            if not self.batch_store.activate_queue(qid, [str(h.get("item_id")) for h in hosts]):
+                return
+        else:
+            if not self.batch_store.start_queue(qid):
+                return
+            self.batch_store.set_queue_total(qid, len(hosts))
+        if not hosts:
+            self.batch_store.finish_queue(qid, status="done")
+            return
+        self._add_run(task, batch, hosts)
+
+    def _add_run(self, task: Dict[str, Any], batch: Dict[str, Any], hosts: List[Dict[str, Any]]) -> None:
+        qid = task["id"]
+        payload = task.get("payload") or {}
+        fixed = payload.get("concurrency")
+        cap = fixed or getattr(self.settings, "batch_queue_concurrency", 0) or self._base_concurrency
+        run = _QueueRun(
+            task,
+            hosts,
+            cap=max(1, int(cap)),
+            retry=RetryPolicy.from_settings(self.settings, payload.get("retry")),
+            leased=self._lease,
+        )
+        if self._adaptive and not fixed:
+            run.controller = ConcurrencyController(
+                run.cap,
+                self._level_min,
+                min(self._level_max, self._pool_size),
+                window=max(100, getattr(self.settings, "batch_adaptive_window_ms", 5000)) / 1000.0,
+            )
+            run.cap = run.controller.level
+        if payload.get("resume"):
+            run.checkpoints = {
+                str(r.get("item_id")): {"last_step": r.get("last_step"), "artifact_hash": r.get("artifact_hash")}
+                for r in batch.get("results", [])
+            }
+        self.batch_store.set_queue_concurrency(qid, run.cap)
+        with self._lock:
+            self._runs[qid] = run
+
+    def _check_cancelled(self) -> None:
+        with self._lock:
+            runs = [r for r in self._runs.values() if not r.finished]
+        for run in runs:
+            if self.batch_store.is_cancelled(run.qid):
+                self._cancel_run(run)
+
+    def _cancel_run(self, run: _QueueRun) -> None:
+        with self._lock:
+            if run.finished:
+                return
+            run.cancelled = True
+            run.finished = True
+            # 取消后不再领取主机，否则 lease 模式下 drained() 永远为假、run 无法移出 _runs
+            run.exhausted = True
+            skipped = list(run.pending) + list(run.delayed.values())
+            run.pending.clear()
+            run.delayed.clear()
+            tokens = list(run.tokens.values())
+            futures = list(run.futures.values())
+            done = run.drained() and self._runs.pop(run.qid, None) is not None
+        # 未启动的 future 直接取消；执行中的主机通过令牌中断 SSH 并按需回滚
+        for fut in futures:
+            fut.cancel()
+        for token in tokens:
+            token.cancel()
+        # 未开始的主机标记为 failed: cancelled；执行中的主机结果到达后照常写入
+        for h in skipped:
+            self._buffer_result(run, {
+                "item_id": h.get("item_id"),
+                "ip": str(h.get("ip")),
+                "host_id": None,
+                "task_id": None,
+                "status": "failed",
+                "error": "cancelled",
+                "zabbix_url": getattr(self.settings, "zabbix_api_base", None),
+            }, final=True)
+        self._flush_results()
+        self.batch_store.finish_queue(run.qid, status="cancelled", error="用户取消")
+        if done:
+            self._finish_run(run)
+
+    def _finish_run(self, run: _QueueRun) -> None:
+        try:
+            self._flush_results()
+            if run.cancelled:
+                return
+            if run.leased:
+                # 其他 worker 可能仍有在途主机，由最后一个完成的 worker 收尾
+                self.batch_store.finish_queue_if_complete(run.qid)
+            else:
+                self.batch_store.finish_queue(run.qid, status="done")
+        except Exception as exc:
+            self.batch_store.finish_queue(run.qid, status="failed", error=str(exc))
+
+    # -------------------- incremental result persistence -------------------- #
+    def _buffer_result(self, run: _QueueRun, result: Dict[str, Any], final: bool) -> None:
+        with self._results_cv:
+            self._results_buf.append((run, result, final))
+            if len(self._results_buf) >= self._flush_size:
+                self._results_cv.notify()
+
+    def _flush_loop(self) -> None:
+        while not self._stop.is_set():
+            with self._results_cv:
+                if len(self._results_buf) < self._flush_size:
+                    self._results_cv.wait(self._flush_interval)
+            try:
+                self._flush_results()
+            except Exception as exc:
+                LOG.exception("flush batch results failed: %s", exc)
+                time.sleep(self._flush_interval)
+
+    def _flush_results(self) -> None:
+        """Write buffered results grouped per queue, one transaction per group."""
+        with self._flush_lock:
+            with self._results_cv:
+                buf, self._results_buf = self._results_buf, []
+            if not buf:
+                return
+            groups: Dict[str, tuple] = {}
+            for run, result, final in buf:
+                entry = groups.setdefault(run.qid, (run, [], [0, 0], []))
+                entry[1].append(result)
+                if final:
+                    entry[2][1 if result.get("status") == "failed" else 0] += 1
+                    entry[3].append(str(result.get("item_id")))
+            for run, rows, (completed, failed), done_items in groups.values():
+                self.batch_store.save_results(
+                    run.batch_id,
+                    rows,
+                    queue_id=run.qid,
+                    completed=completed,
+                    failed=failed,
+                    done_items=done_items if run.leased else None,
+                )
+
+    # -------------------- scheduling -------------------- #
+    @staticmethod
+    def _parse_subnet_groups(spec: str) -> List[tuple]:
+        """Parse "cidr=limit,..." into (network, limit) pairs, most specific network first."""
+        groups = []
+        for part in spec.replace(";", ",").split(","):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                cidr, limit = part.split("=", 1)
+                groups.append((ipaddress.ip_network(cidr.strip(), strict=False), max(1, int(limit))))
+            except ValueError:
+                LOG.warning("ignoring invalid BATCH_SUBNET_GROUPS entry: %s", part)
+        return sorted(groups, key=lambda g: -g[0].prefixlen)
+
+    def _host_groups(self, run: _QueueRun, host: Dict[str, Any]) -> tuple:
+        """(group key, limit) pairs that cap this host; empty when no group limits apply."""
+        key = str(host.get("item_id"))
+        groups = run.groups.get(key)
+        if groups is None:
+            found = []
+            proxy_id = run.payload.get("proxy_id") or host.get("proxy_id")
+            if self._proxy_limit and proxy_id:
+                found.append((f"proxy:{proxy_id}", self._proxy_limit))
+            if self._subnet_limits:
+                try:
+                    ip = ipaddress.ip_address(str(host.get("ip")).strip())
+                except ValueError:
+                    ip = None
+                for net, limit in self._subnet_limits:
+                    if ip is not None and ip.version == net.version and ip in net:
+                        found.append((f"net:{net}", limit))
+                        break
+            groups = run.groups[key] = tuple(found)
+        return groups
+
+    def _take_host(self, run: _QueueRun) -> Optional[Dict[str, Any]]:
+        """Pop the first pending host whose groups still have room (looks ahead a bounded window)."""
+        if not self._proxy_limit and not self._subnet_limits:
+            return run.pending.popleft()
+        for i, host in enumerate(itertools.islice(run.pending, 512)):
+            if all(self._group_inflight.get(g, 0) < limit for g, limit in self._host_groups(run, host)):
+                del run.pending[i]
+                return host
+        return None
+
+    def _pick_host(self) -> Optional[tuple]:
+        candidates = [r for r in self._runs.values() if r.can_dispatch()]
+        candidates.sort(key=lambda r: (-r.priority, r.inflight, len(r.pending), r.task.get("created") or 0))
+        # 队首主机所在分组已满时，让给下一个队列/下一台主机，保持线程池满载
+        for run in candidates:
+            host = self._take_host(run)
+            if host is not None:
+                return run, host
+        return None
+
+    def _release_groups(self, run: _QueueRun, host: Dict[str, Any]) -> None:
+        for g, _ in run.groups.get(str(host.get("item_id")), ()):
+            left = self._group_inflight.get(g, 0) - 1
+            if left > 0:
+                self._group_inflight[g] = left
+            else:
+                self._group_inflight.pop(g, None)
+
+    def _next_wait(self, poll_interval: float) -> float:
+        with self._lock:
+            if not self._delayed:
+                return poll_interval
+            return min(poll_interval, max(0.01, self._delayed[0][0] - time.time()))
+
+    def _schedule_retry(self, run: _QueueRun, host: Dict[str, Any], delay: float) -> None:
+        run.delayed[str(host.get("item_id"))] = host
+        heapq.heappush(self._delayed, (time.time() + delay, next(self._delay_seq), run, host))
+
+    def _release_due(self) -> None:
+        """Move hosts whose retry backoff has expired back to the front of their queue."""
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, run, host = heapq.heappop(self._delayed)
+            if run.finished or run.delayed.pop(str(host.get("item_id")), None) is None:
+                continue
+            run.pending.appendleft(host)
+
+    def _claim_hosts(self) -> None:
+        """Lease mode: claim just enough hosts from the database to fill the free slots."""
+        free = self._pool_size - self._inflight
+        for run in sorted(self._runs.values(), key=lambda r: (-r.priority, r.task.get("created") or 0)):
+            if free <= 0:
+                return
+            if run.finished:
+                continue
+            want = min(free, run.cap - run.inflight - len(run.pending))
+            if want <= 0:
+                continue
+            ids = self.batch_store.claim_hosts(run.qid, self.worker_id, want, self._lease_seconds)
+            run.pending.extend(run.host_map[i] for i in ids if i in run.host_map)
+            run.exhausted = len(ids) < want
+            free -= len(ids)
+
+    def _dispatch(self) -> None:
+        """Fill free pool slots with hosts from the active queues."""
+        with self._lock:
+            self._release_due()
+            if self._lease:
+                self._claim_hosts()
+            # lease 模式：本进程领完且无在途主机的队列；已结束（取消）的队列在途/流水线主机归零后也一并移除
+            drained = [
+                r for r in self._runs.values()
+                if (r.leased and r.drained()) or (r.finished and r.inflight == 0 and r.staged == 0)
+            ]
+            for run in drained:
+                self._runs.pop(run.qid, None)
+        for run in drained:
+            self._finish_run(run)
+        with self._lock:
+            while self._inflight < self._pool_size and not self._stop.is_set():
+                if self._pipeline and len(self._register_q) >= self._stage_limit:
+                    # 注册阶段积压已满：SSH 阶段暂停，注册阶段取走一批后再继续
+                    return
+                picked = self._pick_host()
+                if not picked:
+                    return
+                run, host = picked
+                for g, _ in self._host_groups(run, host):
+                    self._group_inflight[g] = self._group_inflight.get(g, 0) + 1
+                run.inflight += 1
+                self._inflight += 1
+                key = str(host.get("item_id"))
+                token = CancelToken()
+                run.tokens[key] = token
+                run.started[key] = time.monotonic()
+                fut = self._pool.submit(self._run_host, run, host, token)
+                run.futures[key] = fut
+                fut.add_done_callback(lambda f, r=run, h=host: self._on_host_done(r, h, f))
+
+    def _on_host_done(self, run: _QueueRun, host: Dict[str, Any], fut) -> None:
+        """Host pool callback: finish the host, or hand it to the registration stage."""
+        try:
+            result = fut.result()
+        except CancelledError:
+            result = {"item_id": host.get("item_id"), "ip": str(host.get("ip")), "status": "failed", "error": "cancelled"}
+        except Exception as exc:
+            result = {"item_id": host.get("item_id"), "ip": str(host.get("ip")), "status": "failed", "error": str(exc)}
+        failure_class = result.pop("failure_class", None)
+        staged = result.pop("staged", None)
+        key = str(host.get("item_id"))
+        new_level = None
+        with self._lock:
+            run.futures.pop(key, None)
+            run.inflight -= 1
+            self._inflight -= 1
+            self._release_groups(run, host)
+            # 自适应并发只调节主机线程池，按 SSH 阶段的耗时与结果反馈
+            duration = time.monotonic() - run.started.pop(key, time.monotonic())
+            if run.controller and not run.finished:
+                new_level = run.controller.record(
+                    duration,
+                    ok=result.get("status") != "failed",
+                    load_error=failure_class in ("connect", "api"),
+                )
+                if new_level:
+                    run.cap = new_level
+            # 是否进入注册阶段只在锁内判定一次；释放锁后再读 run.finished 可能与取消竞争，导致重复完成
+            enqueued = staged is not None and not run.finished
+            if enqueued:
+                run.staged += 1
+                self._register_q.append((run, host, staged, result, time.monotonic()))
+                self._stage_cv.notify_all()
+        if new_level:
+            LOG.info("batch queue %s concurrency -> %s", run.qid, new_level)
+            self.batch_store.set_queue_concurrency(run.qid, new_level)
+        if enqueued:
+            self._dispatch()
+            return
+        if staged is not None:
+            result = {**result, "status": "failed", "error": "cancelled"}
+        self._complete_host(run, host, result, failure_class)
+
+    def _complete_host(self, run: _QueueRun, host: Dict[str, Any], result: Dict[str, Any], failure_class: Optional[str], staged: bool = False) -> None:
+        """Record the final outcome of one host attempt (or schedule its retry)."""
+        key = str(host.get("item_id"))
+        retry_in = None
+        with self._lock:
+            run.tokens.pop(key, None)
+            if staged:
+                run.staged -= 1
+            attempt = run.attempts.get(key, 0) + 1
+            if result.get("status") == "failed" and not run.finished and run.retry.allows(failure_class, attempt):
+                # 按失败分类退避重试；安装步骤失败时下次从 checkpoint 续装
+                run.attempts[key] = attempt
+                run.checkpoints[key] = {"last_step": result.get("last_step"), "artifact_hash": result.get("artifact_hash")}
+                retry_in = run.retry.delay(attempt)
+                self._schedule_retry(run, host, retry_in)
+            elif result.get("status") == "failed":
+                run.failed += 1
+            else:
+                run.completed += 1
+            done = run.drained() and self._runs.pop(run.qid, None) is not None
+        if retry_in is not None:
+            limit = run.retry.retries.get(failure_class, 0)
+            self._buffer_result(run, {
+                **result,
+                "status": "retrying",
+                "error": f"[{failure_class}] retry {attempt}/{limit} in {retry_in:.1f}s: {result.get('error')}",
+            }, final=False)
+            # 唤醒调度线程，按最近的到期时间重新计算等待
+            self.batch_store.notify()
+        else:
+            self._buffer_result(run, result, final=True)
+        if done:
+            self._finish_run(run)
+        self._dispatch()
+
+    # -------------------- pipeline stages -------------------- #
+    def _take_register_batch(self) -> Optional[List[tuple]]:
+        """Pop the next registration batch once it is full, has lingered long enough, or the SSH stage is idle."""
+        if not self._register_q or self._register_active >= self._register_workers:
+            return None
+        if self._web_queued >= self._stage_limit:
+            return None
+        waited = time.monotonic() - self._register_q[0][4]
+        if len(self._register_q) < self._register_size and waited < self._register_linger and self._inflight > 0:
+            return None
+        batch = [self._register_q.popleft() for _ in range(min(self._register_size, len(self._register_q)))]
+        self._register_active += 1
+        return batch
+
+    def _register_loop(self) -> None:
+        while not self._stop.is_set():
+            with self._stage_cv:
+                batch = self._take_register_batch()
+                if batch is None:
+                    self._stage_cv.wait(max(0.02, self._register_linger / 2))
+                    continue
+            try:
+                self._register_pool.submit(self._run_register, batch)
+            except RuntimeError:
+                # 线程池已关闭（stop 中）
+                return
+            # 注册队列腾出空间，恢复 SSH 阶段派发
+            self._dispatch()
+
+    def _run_register(self, batch: List[tuple]) -> None:
+        live = []
+        for item in batch:
+            run, host, staged, result, _ = item
+            if run.cancelled:
+                self._complete_host(run, host, {**result, "status": "failed", "error": "cancelled"}, None, staged=True)
+            else:
+                live.append(item)
+        try:
+            outcomes = self.svc.register_hosts([(staged["req"], result.get("task_id")) for _, _, staged, result, _ in live], log_store=self.log_store)
+        except Exception as exc:
+            LOG.exception("batch registration failed: %s", exc)
+            outcomes = [exc] * len(live)
+        with self._stage_cv:
+            self._register_calls += 1 if live else 0
+            self._register_hosts += len(live)
+        for (run, host, staged, result, _), out in zip(live, outcomes):
+            if isinstance(out, Exception):
+                self._complete_host(run, host, {**result, "status": "failed", "error": str(out)}, classify_failure(out), staged=True)
+                continue
+            result = {**result, "host_id": out}
+            if not staged["urls"]:
+                self._complete_host(run, host, result, None, staged=True)
+                continue
+            with self._stage_cv:
+                self._web_queued += 1
+            try:
+                self._web_pool.submit(self._run_web, run, host, staged, result)
+            except RuntimeError:
+                with self._stage_cv:
+                    self._web_queued -= 1
+                self._complete_host(run, host, {**result, "status": "failed", "error": "worker stopped"}, None, staged=True)
+        with self._stage_cv:
+            self._register_active -= 1
+            self._stage_cv.notify_all()
 
+    def _run_web(self, run: _QueueRun, host: Dict[str, Any], staged: Dict[str, Any], result: Dict[str, Any]) -> None:
+        with self._stage_cv:
+            self._web_queued -= 1
+            self._web_active += 1
+            self._stage_cv.notify_all()
+            token = run.tokens.get(str(host.get("item_id")))
+        failure_class = None
+        try:
+            if run.cancelled:
+                raise TaskCancelled()
+            self.svc.ensure_web_monitors(staged["req"], result["host_id"], task_id=result.get("task_id"), log_store=self.log_store, cancel_token=token)
+        except TaskCancelled:
+            result = {**result, "status": "failed", "error": "cancelled"}
+        except Exception as exc:
+            result = {**result, "status": "failed", "error": str(exc)}
+            failure_class = classify_failure(exc)
+        finally:
+            with self._stage_cv:
+                self._web_active -= 1
+                self._stage_cv.notify_all()
+        self._complete_host(run, host, result, failure_class, staged=True)
+
+    def stage_stats(self) -> Dict[str, Any]:
+        """Backlog and activity of each pipeline stage in this process."""
+        with self._lock:
+            pending = sum(len(r.pending) for r in self._runs.values())
+            delayed = sum(len(r.delayed) for r in self._runs.values())
+            stats: Dict[str, Any] = {
+                "pipeline": self._pipeline,
+                "worker_id": self.worker_id,
+                "ssh": {
+                    "workers": self._pool_size,
+                    "active": self._inflight,
+                    "backlog": pending,
+                    "retry_wait": delayed,
+                    "groups": dict(self._group_inflight),
+                },
+            }
+            if self._pipeline:
+                stats["register"] = {
+                    "workers": self._register_workers,
+                    "active": self._register_active,
+                    "backlog": len(self._register_q),
+                    "limit": self._stage_limit,
+                    "calls": self._register_calls,
+                    "avg_batch": round(self._register_hosts / self._register_calls, 1) if self._register_calls else 0,
+                }
+                stats["web"] = {
+                    "workers": self._web_workers,
+                    "active": self._web_active,
+                    "backlog": self._web_queued,
+                    "limit": self._stage_limit,
+                }
+            return stats
+
+    # -------------------- per-host execution -------------------- #
+    def _run_host(self, run: _QueueRun, h: Dict[str, Any], token: CancelToken) -> Dict[str, Any]:
+        payload = run.payload
+        action = run.action
         template_ids = payload.get("template_ids") or []
         group_ids = payload.get("group_ids") or []
         proxy_id = payload.get("proxy_id")
         register_server = payload.get("register_server", True)
         register_only = payload.get("register_only", False)
         precheck = payload.get("precheck", False)
+        reinstall = payload.get("reinstall", False)
         web_monitor_urls = payload.get("web_monitor_urls") or []
         web_monitor_url = payload.get("web_monitor_url")
         jmx_port = payload.get("jmx_port")
 
-        max_workers = max(1, getattr(self.settings, "batch_concurrency", 5))
-        executor = ThreadPoolExecutor(max_workers=max_workers)
+        task_id = uuid.uuid4().hex
+        # 每台主机的步骤 checkpoint，随结果一起落库；续装时沿用上次的记录
+        ckpt = dict(run.checkpoints.get(str(h.get("item_id"))) or {"last_step": None, "artifact_hash": None})
+        resume_from = ckpt.get("last_step") if payload.get("resume") or run.attempts.get(str(h.get("item_id"))) else None
 
-        def run_host(h: Dict[str, Any]) -> Dict[str, Any]:
-            import uuid
+        def _checkpoint(step: Optional[str], artifact: Optional[str]) -> None:
+            ckpt["last_step"] = step
+            if artifact:
+                ckpt["artifact_hash"] = artifact
 
-            task_id = uuid.uuid4().hex
-            # 先写入 installing 状态，便于前端刷新可见
-            try:
-                self.batch_store.save_results(task["batch_id"], [{
-                    "item_id": h.get("item_id"),
-                    "ip": str(h.get("ip")),
-                    "host_id": None,
-                    "task_id": task_id,
-                    "status": "installing",
-                    "error": None,
-                    "zabbix_url": getattr(self.settings, "zabbix_api_base", None),
-                }])
-            except Exception:
-                pass
+        # 先写入 installing 状态，便于前端刷新可见（随结果缓冲分组写入）
+        self._buffer_result(run, {
+            "item_id": h.get("item_id"),
+            "ip": str(h.get("ip")),
+            "host_id": None,
+            "task_id": task_id,
+            "status": "installing",
+            "error": None,
+            "zabbix_url": getattr(self.settings, "zabbix_api_base", None),
+            **ckpt,
+        }, final=False)
 
-            try:
-                if action == "uninstall":
-                    req = UninstallRequest(
+        # 流水线模式下 SSH 阶段完成后交给注册阶段的请求与 web 监控 URL
+        staged: Optional[Dict[str, Any]] = None
+        try:
+            if action == "uninstall":
+                req = UninstallRequest(
+                    ip=h["ip"],
+                    hostname=h.get("hostname"),
+                    ssh_user=h.get("ssh_user"),
+                    ssh_password=h.get("ssh_password"),
+                    ssh_port=h.get("ssh_port"),
+                    proxy_id=proxy_id or h.get("proxy_id"),
+                )
+                res = self.svc.uninstall_agent(req, task_id=task_id, log_store=self.log_store, cancel_token=token)
+                res["task_id"] = task_id
+            else:
+                def _normalize_urls(val):
+                    if not val:
+                        return []
+                    if isinstance(val, str):
+                        parts = val.replace("\n", ";").replace(",", ";").split(";")
+                        return [p.strip() for p in parts if p.strip()]
+                    urls = []
+                    for x in val if isinstance(val, (list, tuple, set)) else [val]:
+                        if isinstance(x, str):
+                            urls.extend([p.strip() for p in x.replace("\n", ";").replace(",", ";").split(";") if p.strip()])
+                        else:
+                            urls.append(str(x))
+                    return urls
+
+                host_urls = h.get("web_monitor_urls") or h.get("web_monitor_url")
+                urls = _normalize_urls(host_urls) or _normalize_urls(web_monitor_urls) or _normalize_urls(web_monitor_url)
+                if register_only:
+                    req = RegisterRequest(
+                        hostname=h.get("hostname"),
+                        visible_name=h.get("visible_name"),
                         ip=h["ip"],
+                        port=h.get("port") or 10050,
+                        template_ids=template_ids or h.get("template_ids") or ([h.get("template_id")] if h.get("template_id") else None),
+                        group_ids=group_ids or h.get("group_ids") or ([h.get("group_id")] if h.get("group_id") else None),
+                        proxy_id=proxy_id or h.get("proxy_id"),
+                        web_monitor_urls=urls,
+                        web_monitor_url=urls[0] if urls else None,
+                        jmx_port=jmx_port or h.get("jmx_port"),
+                    )
+                    if self._pipeline:
+                        # 无 SSH 工作，直接进入注册阶段
+                        req = req.copy(update={"hostname": req.hostname or str(req.ip)})
+                        staged = {"req": req, "urls": urls}
+                        res = {"ip": str(req.ip), "status": "registered", "hostname": req.hostname}
+                    else:
+                        res = self.svc.register_host(req, task_id=task_id, log_store=self.log_store, cancel_token=token)
+                    res["task_id"] = task_id
+                else:
+                    req = InstallRequest(
                         hostname=h.get("hostname"),
+                        ip=h["ip"],
+                        os_type=h.get("os_type") or "linux",
+                        env=h.get("env"),
+                        port=h.get("port") or 10050,
                         ssh_user=h.get("ssh_user"),
                         ssh_password=h.get("ssh_password"),
                         ssh_port=h.get("ssh_port"),
+                        visible_name=h.get("visible_name"),
+                        template_ids=template_ids or h.get("template_ids") or ([h.get("template_id")] if h.get("template_id") else None),
+                        group_ids=group_ids or h.get("group_ids") or ([h.get("group_id")] if h.get("group_id") else None),
                         proxy_id=proxy_id or h.get("proxy_id"),
+                        register_server=register_server,
+                        precheck=precheck,
+                        reinstall=reinstall,
+                        web_monitor_urls=urls,
+                        web_monitor_url=urls[0] if urls else None,
+                        jmx_port=jmx_port or h.get("jmx_port"),
+                    )
+                    res = self.svc.install_agent(
+                        req,
+                        task_id=task_id,
+                        log_store=self.log_store,
+                        cancel_token=token,
+                        resume_from=resume_from,
+                        artifact_hash=ckpt.get("artifact_hash") if resume_from else None,
+                        checkpoint=_checkpoint,
+                        register=not (self._pipeline and register_server),
                     )
-                    res = self.svc.uninstall_agent(req, task_id=task_id, log_store=self.log_store)
                     res["task_id"] = task_id
-                else:
-                    def _normalize_urls(val):
-                        if not val:
-                            return []
-                        if isinstance(val, str):
-                            parts = val.replace("\n", ";").replace(",", ";").split(";")
-                            return [p.strip() for p in parts if p.strip()]
-                        urls = []
-                        for x in val if isinstance(val, (list, tuple, set)) else [val]:
-                            if isinstance(x, str):
-                                urls.extend([p.strip() for p in x.replace("\n", ";").replace(",", ";").split(";") if p.strip()])
-                            else:
-                                urls.append(str(x))
-                        return urls
-
-                    host_urls = h.get("web_monitor_urls") or h.get("web_monitor_url")
-                    urls = _normalize_urls(host_urls) or _normalize_urls(web_monitor_urls) or _normalize_urls(web_monitor_url)
-                    if register_only:
-                        req = RegisterRequest(
-                            hostname=h.get("hostname"),
-                            visible_name=h.get("visible_name"),
-                            ip=h["ip"],
-                            port=h.get("port") or 10050,
-                            template_ids=template_ids or h.get("template_ids") or ([h.get("template_id")] if h.get("template_id") else None),
-                            group_ids=group_ids or h.get("group_ids") or ([h.get("group_id")] if h.get("group_id") else None),
-                            proxy_id=proxy_id or h.get("proxy_id"),
-                            web_monitor_urls=urls,
-                            web_monitor_url=urls[0] if urls else None,
-                            jmx_port=jmx_port or h.get("jmx_port"),
-                        )
-                        res = self.svc.register_host(req, task_id=task_id, log_store=self.log_store)
-                        res["task_id"] = task_id
-                    else:
-                        req = InstallRequest(
-                            hostname=h.get("hostname"),
-                            ip=h["ip"],
-                            os_type=h.get("os_type") or "linux",
-                            env=h.get("env"),
-                            port=h.get("port") or 10050,
-                            ssh_user=h.get("ssh_user"),
-                            ssh_password=h.get("ssh_password"),
-                            ssh_port=h.get("ssh_port"),
-                            visible_name=h.get("visible_name"),
-                            template_ids=template_ids or h.get("template_ids") or ([h.get("template_id")] if h.get("template_id") else None),
-                            group_ids=group_ids or h.get("group_ids") or ([h.get("group_id")] if h.get("group_id") else None),
-                            proxy_id=proxy_id or h.get("proxy_id"),
-                            register_server=register_server,
-                            precheck=precheck,
-                            web_monitor_urls=urls,
-                            web_monitor_url=urls[0] if urls else None,
-                            jmx_port=jmx_port or h.get("jmx_port"),
-                        )
-                        res = self.svc.install_agent(req, task_id=task_id, log_store=self.log_store)
-                        res["task_id"] = task_id
-                host_id = res.get("host_id")
-                return {
-                    "item_id": h.get("item_id"),
-                    "ip": str(h.get("ip")),
-                    "status": "ok",
-                    **res,
-                    **({"host_id": host_id} if host_id else {}),
-                }
-            except Exception as exc:
-                return {"item_id": h.get("item_id"), "ip": str(h.get("ip")), "status": "failed", "error": str(exc), "task_id": task_id}
-
-        futures = [executor.submit(run_host, h) for h in hosts]
-        results: List[Dict[str, Any]] = []
-        for f in futures:
-            if self.batch_store.is_cancelled(qid):
-                break
-            results.append(f.result())
-        executor.shutdown(wait=False)
-        try:
-            self.batch_store.save_results(task["batch_id"], results)
-            if self.batch_store.is_cancelled(qid):
-                # 将未完成的主机标记为 failed: cancelled
-                pending_hosts = [h for h in hosts if not any(str(r.get("item_id")) == str(h.get("item_id")) for r in results)]
-                if pending_hosts:
-                    # 尝试复用已有 task_id（之前写入的 installing 记录）
-                    existing_latest = {str(r.get("item_id")): r.get("task_id") for r in self.batch_store.get_results(task["batch_id"], host_ids=[h.get("item_id") for h in pending_hosts])}
-                    cancel_rows = []
-                    for h in pending_hosts:
-                        item_id = str(h.get("item_id"))
-                        cancel_rows.append({
-                            "item_id": item_id,
-                            "ip": str(h.get("ip")),
-                            "host_id": None,
-                            "task_id": existing_latest.get(item_id),
-                            "status": "failed",
-                            "error": "cancelled",
-                            "zabbix_url": getattr(self.settings, "zabbix_api_base", None),
-                        })
-                    self.batch_store.save_results(task["batch_id"], cancel_rows)
-                self.batch_store.finish_queue(qid, status="cancelled", error="用户取消")
-            else:
-                self.batch_store.finish_queue(qid, status="done")
+                    if self._pipeline and register_server:
+                        req = req.copy(update={"hostname": res.get("hostname"), "visible_name": res.get("visible_name")})
+                        staged = {"req": req, "urls": urls}
+            host_id = res.get("host_id")
+            return {
+                "item_id": h.get("item_id"),
+                "ip": str(h.get("ip")),
+                "status": "ok",
+                **res,
+                **({"host_id": host_id} if host_id else {}),
+                **ckpt,
+                **({"staged": staged} if staged else {}),
+            }
+        except TaskCancelled:
+            return {"item_id": h.get("item_id"), "ip": str(h.get("ip")), "status": "failed", "error": "cancelled", "task_id": task_id, **ckpt}
         except Exception as exc:
-            self.batch_store.finish_queue(qid, status="failed", error=str(exc))
+            return {
+                "item_id": h.get("item_id"),
+                "ip": str(h.get("ip")),
+                "status": "failed",
+                "error": str(exc),
+                "task_id": task_id,
+                "failure_class": classify_failure(exc),
+                **ckpt,
+            }
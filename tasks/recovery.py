@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import logging
+from typing import Any, Dict, List, Optional
+
+from services.scripts import DOWNLOAD_STEP, INSTALL_STEPS, parse_artifact_hash
+
+LOG = logging.getLogger(__name__)
+
+# 仍在执行中的中间状态；其余状态视为主机已有最终结果
+_IN_PROGRESS = {"installing", "retrying", "pending"}
+_INSTALL_STEP_NAMES = {name for name, _ in INSTALL_STEPS}
+
+
+def reconcile_host(logs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Derive the checkpoint of an interrupted host from its install_logs rows (in id order)."""
+    last_step: Optional[str] = None
+    artifact: Optional[str] = None
+    for entry in logs:
+        if entry.get("step") in _INSTALL_STEP_NAMES and entry.get("status") in ("ok", "warn"):
+            last_step = entry["step"]
+            if entry["step"] == DOWNLOAD_STEP:
+                artifact = parse_artifact_hash(entry.get("message") or "") or artifact
+    where = f"{logs[-1].get('step')}/{logs[-1].get('status')}" if logs else "before first step"
+    return {"last_step": last_step, "artifact_hash": artifact, "where": where}
+
+
+def recover_interrupted(batch_store, log_store, policy: str = "requeue", max_recoveries: int = 3) -> List[Dict[str, Any]]:
+    """Reconcile queues left 'running' by a dead embedded worker.
+
+    Hosts with a final result are kept. Hosts stuck in 'installing'/'retrying' get a failed row
+    whose last_step/artifact_hash are rebuilt from install_logs. Hosts that never started get a
+    failed row as well. With policy 'requeue' the unfinished hosts are enqueued again as a resume
+    run (at most `max_recoveries` times per original queue); with 'fail' they stay failed.
+    """
+    report = []
+    for q in batch_store.list_orphaned():
+        batch = batch_store.get(q["batch_id"])
+        payload = dict(q.get("payload") or {})
+        recoveries = int(payload.get("recoveries") or 0)
+        requeue = policy == "requeue" and recoveries < max_recoveries
+        if not batch:
+            batch_store.interrupt_queue(q["id"], "进程重启中断：批次不存在")
+            continue
+        hosts = batch.get("hosts", [])
+        if q["host_ids"]:
+            wanted = {str(i) for i in q["host_ids"]}
+            hosts = [h for h in hosts if str(h.get("item_id")) in wanted]
+        latest = {str(r.get("item_id")): r for r in batch.get("results", [])}
+        rows: List[Dict[str, Any]] = []
+        for h in hosts:
+            key = str(h.get("item_id"))
+            r = latest.get(key)
+            if r and (r.get("ts") or 0) >= q["started"] and r.get("status") not in _IN_PROGRESS:
+                continue
+            if r and (r.get("ts") or 0) >= q["started"]:
+                ck = reconcile_host(log_store.get(r["task_id"]) if r.get("task_id") else [])
+                rows.append({
+                    "item_id": h.get("item_id"),
+                    "ip": str(h.get("ip")),
+                    "host_id": r.get("host_id"),
+                    "task_id": r.get("task_id"),
+                    "status": "failed",
+                    "error": f"interrupted: process restarted at {ck['where']}",
+                    "zabbix_url": r.get("zabbix_url"),
+                    "last_step": ck["last_step"] or r.get("last_step"),
+                    "artifact_hash": ck["artifact_hash"] or r.get("artifact_hash"),
+                })
+            else:
+                rows.append({
+                    "item_id": h.get("item_id"),
+                    "ip": str(h.get("ip")),
+                    "status": "failed",
+                    "error": "interrupted: not started before process restart",
+                    # 保留之前的 checkpoint，续装时仍可利用
+                    "last_step": r.get("last_step") if r else None,
+                    "artifact_hash": r.get("artifact_hash") if r else None,
+                })
+        note = f"进程重启中断：{len(rows)} 台主机未完成"
+        if not batch_store.interrupt_queue(q["id"], note + ("，已重新入队" if requeue and rows else "")):
+            continue
+        batch_store.save_results(q["batch_id"], rows, queue_id=q["id"], failed=len(rows))
+        new_qid = None
+        if requeue and rows:
+            payload.update({"resume": True, "recoveries": recoveries + 1})
+            try:
+                new_qid = batch_store.enqueue(
+                    q["batch_id"], [str(r["item_id"]) for r in rows], q["action"], payload, priority=q["priority"]
+                )
+            except ValueError as exc:
+                LOG.warning("requeue of interrupted batch queue %s skipped: %s", q["id"], exc)
+        LOG.warning("recovered interrupted batch queue %s: %d unfinished hosts, requeued as %s", q["id"], len(rows), new_qid)
+        report.append({"queue_id": q["id"], "unfinished": len(rows), "requeued_as": new_qid})
+    return report
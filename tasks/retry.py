@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import errno
+import random
+import socket
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+import httpx
+import paramiko
+from fastapi import HTTPException
+
+from services.cancel import StepFailed, TaskCancelled
+
+# 失败分类：connect=SSH 连接/断开，auth=SSH 或 Zabbix 认证，step=安装步骤脚本失败，api=Zabbix API 网络/网关错误
+FAILURE_CLASSES = ("connect", "auth", "step", "api")
+
+# 主机不可达类的 socket 错误（connect() 直接抛出的 OSError，不属于 ConnectionError 子类）
+_NET_ERRNOS = {errno.EHOSTUNREACH, errno.ENETUNREACH, errno.ENETDOWN, errno.EHOSTDOWN}
+
+
+def classify_failure(exc: BaseException) -> Optional[str]:
+    """Map a per-host exception to a retryable failure class; None means do not retry.
+
+    The exception chain is walked outermost first, so a step that failed because the SSH
+    connection dropped counts as `connect` rather than `step`. Only socket-level errors are
+    `connect` (local file errors are not retried) and only StepFailed is `step`.
+    """
+    chain = []
+    cur: Optional[BaseException] = exc
+    while cur is not None and len(chain) < 10:
+        chain.append(cur)
+        cur = cur.__cause__ or cur.__context__
+    if any(isinstance(e, TaskCancelled) for e in chain):
+        return None
+    for e in chain:
+        if isinstance(e, paramiko.AuthenticationException) or (isinstance(e, HTTPException) and e.status_code == 401):
+            return "auth"
+        if isinstance(e, (paramiko.SSHException, paramiko.ssh_exception.NoValidConnectionsError, socket.gaierror, socket.timeout, ConnectionError, EOFError)):
+            return "connect"
+        if isinstance(e, OSError) and e.errno in _NET_ERRNOS:
+            return "connect"
+        if isinstance(e, httpx.HTTPError) or (isinstance(e, HTTPException) and e.status_code == 502):
+            return "api"
+        if isinstance(e, StepFailed):
+            return "step"
+    return None
+
+
+@dataclass
+class RetryPolicy:
+    """Retries allowed per failure class plus exponential backoff with jitter."""
+
+    retries: Dict[str, int] = field(default_factory=dict)
+    base_delay: float = 2.0
+    max_delay: float = 60.0
+
+    @classmethod
+    def from_settings(cls, settings: Any, overrides: Optional[Dict[str, Any]] = None) -> "RetryPolicy":
+        """Defaults come from BATCH_RETRY_*; a /batch/run payload `retry` dict overrides per class."""
+        retries = {name: int(getattr(settings, f"batch_retry_{name}", 0) or 0) for name in FAILURE_CLASSES}
+        for name, val in (overrides or {}).items():
+            if name in retries:
+                retries[name] = max(0, int(val or 0))
+        return cls(
+            retries=retries,
+            base_delay=max(0, getattr(settings, "batch_retry_backoff_ms", 2000)) / 1000.0,
+            max_delay=max(0, getattr(settings, "batch_retry_backoff_max_ms", 60000)) / 1000.0,
+        )
+
+    def allows(self, failure_class: Optional[str], attempt: int) -> bool:
+        """attempt is the 1-based retry number about to be scheduled."""
+        return bool(failure_class) and attempt <= self.retries.get(failure_class, 0)
+
+    def delay(self, attempt: int) -> float:
+        """Equal jitter: half the exponential delay fixed, half random, so hosts do not retry in lockstep."""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** max(0, attempt - 1)))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
@@ -0,0 +1,93 @@
+"""Standalone batch worker processes sharing the batch database through host leases.
+
+Usage:
+    python -m tasks.worker                      # one worker process per CPU core
+    python -m tasks.worker --processes 4 --db /srv/zabbix_tool/data.db
+
+Run the API with BATCH_WORKER_MODE=off (enqueue only) or =lease (it also takes a share of
+the hosts). All processes must run on the same host as data.db: SQLite WAL needs shared
+memory and POSIX locks, which NFS/SMB mounts do not provide, so do not share the file
+between machines.
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+from pathlib import Path
+from typing import List
+
+LOG = logging.getLogger(__name__)
+
+
+def _default_db() -> Path:
+    bundle_dir = getattr(sys, "_MEIPASS", None)
+    base = Path(bundle_dir) if bundle_dir else Path(__file__).resolve().parent.parent
+    return base / "data.db"
+
+
+def run_worker(db_path: str) -> None:
+    """Run one lease-mode BatchWorker until SIGTERM/SIGINT."""
+    from core.batch_store import BatchStore
+    from core.db_config import ConfigStore
+    from core.log_store import LogStore
+    from core.settings import get_settings
+    from services.service import ZabbixService
+    from tasks.batch_worker import BatchWorker
+
+    path = Path(db_path)
+    settings = get_settings()
+    log_store = LogStore(path)
+    worker = BatchWorker(
+        ZabbixService(config_store=ConfigStore(path, defaults=settings)),
+        log_store,
+        BatchStore(path),
+        mode="lease",
+    )
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    LOG.info("batch worker %s started on %s", worker.worker_id, path)
+    stop.wait()
+    worker.stop()
+    # multiprocessing 子进程以 os._exit 结束，不会执行 atexit
+    log_store.close()
+    LOG.info("batch worker %s stopped", worker.worker_id)
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Lease-based batch worker processes")
+    parser.add_argument("--db", default=str(_default_db()), help="shared SQLite database (default: project data.db)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="worker processes to start")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(processName)s %(name)s: %(message)s")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+
+    if args.processes <= 1:
+        run_worker(args.db)
+        return
+    procs = [
+        multiprocessing.Process(target=run_worker, args=(args.db,), name=f"batch-worker-{i}")
+        for i in range(args.processes)
+    ]
+    for p in procs:
+        p.start()
+
+    def _forward(signum, _frame):
+        for p in procs:
+            if p.is_alive():
+                os.kill(p.pid, signum)
+
+    signal.signal(signal.SIGTERM, _forward)
+    signal.signal(signal.SIGINT, _forward)
+    for p in procs:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()
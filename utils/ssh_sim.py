@@ -0,0 +1,480 @@
+"""
+In-process SSH server stand-in for end-to-end install benchmarks.
+
+Simulates a fleet of linux targets (one listening port or loopback alias per host) that accept
+exec and SFTP sessions the same way `ZabbixService._run_ssh` / `_upload_file` use them, and
+fakes the install scripts rendered from `services/scripts.py`.
+
+    python -m utils.ssh_sim serve --hosts 50
+    python -m utils.ssh_sim bench --hosts 1000 --concurrency 50 --latency 0.05 --fail-rate 0.01
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import logging
+import random
+import re
+import selectors
+import shutil
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+import paramiko
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclass
+class SimRule:
+    """Override behaviour for commands whose text matches `pattern` (e.g. a step's echo marker)."""
+
+    pattern: str
+    latency: Optional[float] = None
+    output_bytes: Optional[int] = None
+    fail_rate: Optional[float] = None
+    timeout_rate: Optional[float] = None
+
+    def __post_init__(self):
+        self._regex = re.compile(self.pattern)
+
+    def matches(self, command: str) -> bool:
+        return bool(self._regex.search(command))
+
+
+@dataclass
+class SimBehavior:
+    latency: float = 0.0
+    jitter: float = 0.0
+    output_bytes: int = 0
+    fail_rate: float = 0.0
+    timeout_rate: float = 0.0
+    timeout_seconds: float = 30.0
+    auth_fail_rate: float = 0.0
+    upload_bytes_per_sec: float = 0.0
+    rules: List[SimRule] = field(default_factory=list)
+
+    def resolve(self, command: str) -> Dict[str, float]:
+        res = {
+            "latency": self.latency,
+            "output_bytes": self.output_bytes,
+            "fail_rate": self.fail_rate,
+            "timeout_rate": self.timeout_rate,
+        }
+        for rule in self.rules:
+            if rule.matches(command):
+                for key in res:
+                    val = getattr(rule, key)
+                    if val is not None:
+                        res[key] = val
+        return res
+
+
+@dataclass
+class SimHost:
+    """Fake remote state for one target."""
+
+    name: str
+    address: str
+    port: int
+    marker: Optional[Dict[str, str]] = None
+    files: Dict[str, int] = field(default_factory=dict)
+    commands: List[str] = field(default_factory=list)
+    failures: int = 0
+    timeouts: int = 0
+    rollbacks: int = 0
+
+    def __post_init__(self):
+        self.lock = threading.Lock()
+
+
+def _prelude_value(command: str, name: str) -> str:
+    m = re.search(rf"^{name}=(\S*)$", command, re.M)
+    return m.group(1).strip("'") if m else ""
+
+
+class _SimSFTPHandle(paramiko.SFTPHandle):
+    def __init__(self, host: SimHost, path: str, behavior: SimBehavior):
+        super().__init__()
+        self.host = host
+        self.path = path
+        self.behavior = behavior
+        self.size = 0
+
+    def write(self, offset, data):
+        self.size = max(self.size, offset + len(data))
+        if self.behavior.upload_bytes_per_sec:
+            time.sleep(len(data) / self.behavior.upload_bytes_per_sec)
+        return paramiko.SFTP_OK
+
+    def stat(self):
+        attr = paramiko.SFTPAttributes()
+        attr.st_size = self.size
+        return attr
+
+    def close(self):
+        with self.host.lock:
+            self.host.files[self.path] = self.size
+        return super().close()
+
+
+class _SimSFTPServer(paramiko.SFTPServerInterface):
+    def __init__(self, server: "_SimServer", *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.host = server.host
+        self.behavior = server.behavior
+
+    def open(self, path, flags, attr):
+        return _SimSFTPHandle(self.host, path, self.behavior)
+
+    def stat(self, path):
+        with self.host.lock:
+            size = self.host.files.get(path)
+        if size is None:
+            return paramiko.SFTP_NO_SUCH_FILE
+        attr = paramiko.SFTPAttributes()
+        attr.st_size = size
+        return attr
+
+    lstat = stat
+
+    def remove(self, path):
+        with self.host.lock:
+            self.host.files.pop(path, None)
+        return paramiko.SFTP_OK
+
+
+class _SimServer(paramiko.ServerInterface):
+    def __init__(self, host: SimHost, behavior: SimBehavior):
+        self.host = host
+        self.behavior = behavior
+
+    def get_allowed_auths(self, username):
+        return "password,publickey"
+
+    def check_auth_password(self, username, password):
+        if random.random() < self.behavior.auth_fail_rate:
+            return paramiko.AUTH_FAILED
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return self.check_auth_password(username, None)
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        text = command.decode("utf-8", "replace") if isinstance(command, bytes) else command
+        threading.Thread(target=self._exec, args=(channel, text), daemon=True).start()
+        return True
+
+    # ---------------- command simulation ---------------- #
+    def _exec(self, channel: paramiko.Channel, command: str) -> None:
+        with self.host.lock:
+            self.host.commands.append(command)
+        # exec 请求的应答由 transport 在本方法返回后发送；先让出一下，避免通道在应答前就被关闭
+        time.sleep(0.005)
+        try:
+            if command.startswith("cat > "):
+                self._recv_upload(channel, command[len("cat > "):].strip())
+                return
+            plan = self.behavior.resolve(command)
+            delay = plan["latency"] + random.uniform(0, self.behavior.jitter)
+            if delay:
+                time.sleep(delay)
+            if random.random() < plan["timeout_rate"]:
+                with self.host.lock:
+                    self.host.timeouts += 1
+                # 模拟卡死：不返回退出码，直到超时或客户端关闭通道
+                deadline = time.time() + self.behavior.timeout_seconds
+                while time.time() < deadline and not channel.closed:
+                    time.sleep(0.05)
+                return
+            if random.random() < plan["fail_rate"]:
+                with self.host.lock:
+                    self.host.failures += 1
+                channel.sendall_stderr(b"simulated failure\n")
+                channel.send_exit_status(1)
+                return
+            out = self._simulate_script(command)
+            if plan["output_bytes"]:
+                out += ("x" * 79 + "\n") * (int(plan["output_bytes"]) // 80)
+            channel.sendall(out.encode())
+            channel.send_exit_status(0)
+        except Exception as exc:
+            LOG.debug("sim exec failed on %s: %s", self.host.name, exc)
+        finally:
+            try:
+                channel.close()
+            except Exception:
+                pass
+
+    def _recv_upload(self, channel: paramiko.Channel, path: str) -> None:
+        size = 0
+        while True:
+            chunk = channel.recv(65536)
+            if not chunk:
+                break
+            size += len(chunk)
+        with self.host.lock:
+            self.host.files[path] = size
+        channel.send_exit_status(0)
+
+    def _simulate_script(self, command: str) -> str:
+        host = self.host
+        with host.lock:
+            if ".agent_fingerprint\" ] && sed" in command:
+                lines = [f"hostname={host.name}"]
+                if host.marker:
+                    lines += [f"marker_{k}={v}" for k, v in host.marker.items()]
+                    lines += [
+                        f"cur_config={host.marker.get('config', '')}",
+                        f"cur_binary={host.marker.get('binary', '')}",
+                        "version=zabbix_agentd (simulated)",
+                        "enabled=enabled",
+                        "active=active",
+                    ]
+                return "\n".join(lines) + "\n"
+            if "hostname -s" in command:
+                return f"{host.name}\n"
+            if "[STEP] clean files" in command:
+                host.rollbacks += 1
+                host.marker = None
+                return "[OK] stop agent\n[OK] clean files\n"
+            if "pre-clean done" in command or "files cleaned" in command:
+                host.marker = None
+                return "pre-clean done (simulated)\n"
+            if 'echo "verified=0"' in command:
+                # 断点续装校验：安装包已上传则下载步骤通过，存在 marker 则其余步骤均通过
+                done = [0, 1]
+                if any(path in command for path in host.files):
+                    done.append(2)
+                    if host.marker:
+                        done += [3, 4, 5, 6]
+                return "".join(f"verified={i}\n" for i in done)
+            if "artifact_sha256=" in command:
+                tgz = next((path for path in host.files if path in command), None)
+                digest = hashlib.sha256(str(host.files.get(tgz, 0)).encode()).hexdigest()
+                return f"use pre-uploaded: {tgz}\nartifact_sha256={digest}\n"
+            if "service enabled and started" in command:
+                pkg = re.search(r"^package=(.*)$", command, re.M)
+                host.marker = {
+                    "package": pkg.group(1) if pkg else "",
+                    "config": _prelude_value(command, "CONFIG_SHA"),
+                    "binary": "0" * 64,
+                }
+                return "service enabled and started (simulated)\n"
+        echoes = re.findall(r'^echo "([^"$]*)"\s*$', command, re.M)
+        return (echoes[-1] if echoes else "ok (simulated)") + "\n"
+
+
+class SimulatedSSHFleet:
+    """A set of simulated SSH targets served from one accept loop.
+
+    mode="ports": every host listens on 127.0.0.1 with its own port (base_port + i, or ephemeral if 0).
+    mode="aliases": every host gets its own loopback address 127.x.y.z on the same port (linux only).
+    """
+
+    def __init__(
+        self,
+        hosts: int = 10,
+        behavior: SimBehavior | None = None,
+        mode: str = "ports",
+        base_port: int = 0,
+        alias_port: int = 2222,
+    ):
+        self.behavior = behavior or SimBehavior()
+        self.mode = mode
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.hosts: List[SimHost] = []
+        self._sel = selectors.DefaultSelector()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._transports: List[paramiko.Transport] = []
+        for i in range(hosts):
+            if mode == "aliases":
+                n = i + 2
+                address, port = f"127.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}", alias_port
+            else:
+                address, port = "127.0.0.1", (base_port + i if base_port else 0)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((address, port))
+            sock.listen(128)
+            sock.setblocking(False)
+            host = SimHost(name=f"sim-{i + 1:05d}", address=address, port=sock.getsockname()[1])
+            self.hosts.append(host)
+            self._sel.register(sock, selectors.EVENT_READ, host)
+
+    def start(self) -> "SimulatedSSHFleet":
+        self._thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+        for key in list(self._sel.get_map().values()):
+            key.fileobj.close()
+        self._sel.close()
+        for t in self._transports:
+            try:
+                t.close()
+            except Exception:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _accept_loop(self) -> None:
+        while not self._stop.is_set():
+            for key, _ in self._sel.select(timeout=0.2):
+                try:
+                    conn, _ = key.fileobj.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(True)
+                try:
+                    t = paramiko.Transport(conn)
+                    t.add_server_key(self.host_key)
+                    t.set_subsystem_handler("sftp", paramiko.SFTPServer, _SimSFTPServer)
+                    t.start_server(server=_SimServer(key.data, self.behavior))
+                    self._transports.append(t)
+                except Exception as exc:
+                    LOG.debug("sim transport failed: %s", exc)
+                    conn.close()
+
+    def targets(self, user: str = "root", password: str = "sim") -> List[Tuple[str, SimpleNamespace]]:
+        """(ip, ssh_opts) pairs accepted by ZabbixService._run_ssh / _upload_file."""
+        return [
+            (h.address, SimpleNamespace(ssh_user=user, ssh_password=password, ssh_key_path=None, ssh_port=h.port, hostname=h.name))
+            for h in self.hosts
+        ]
+
+
+def _percentile(values: List[float], pct: int) -> float:
+    """Inclusive percentile of sorted values (statistics.quantiles needs at least two points)."""
+    if len(values) < 2:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[pct - 1]
+
+
+def run_benchmark(
+    fleet: SimulatedSSHFleet,
+    concurrency: int = 20,
+    upload_bytes: int = 0,
+    svc: Any = None,
+) -> Dict[str, Any]:
+    """Drive the real `_run_steps` install path against every simulated host and report throughput."""
+    from core.db_config import ConfigStore
+    from services.service import ZabbixService
+    from services.scripts import host_prelude
+
+    tmpdir = Path(tempfile.mkdtemp(prefix="ssh-sim-"))
+    try:
+        if svc is None:
+            store = ConfigStore(tmpdir / "bench.db")
+            cfg = {"agent_tgz_url": "http://sim.invalid/zabbix-agent.tgz", "zabbix_server_host": "127.0.0.1"}
+            if upload_bytes:
+                pkg = tmpdir / "agent.tgz"
+                pkg.write_bytes(b"\0" * upload_bytes)
+                cfg["local_agent_path"] = str(pkg)
+            store.set(cfg)
+            svc = ZabbixService(config_store=store)
+        cfg = svc.config_store.get()
+        scripts = svc._script_set(cfg)
+        preupload = cfg.get("local_agent_path")
+
+        def one(target) -> Tuple[float, bool]:
+            ip, opts = target
+            steps = scripts.install_steps(host_prelude(opts.hostname, 10050, None, "0" * 64))
+            t0 = time.perf_counter()
+            try:
+                svc._run_steps(ip, steps, rollback_script=scripts.rollback, ssh_opts=opts, preupload_local_path=preupload)
+                return time.perf_counter() - t0, True
+            except Exception:
+                return time.perf_counter() - t0, False
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(one, fleet.targets()))
+        elapsed = time.perf_counter() - started
+        durations = sorted(d for d, _ in outcomes)
+        ok = sum(1 for _, success in outcomes if success)
+        return {
+            "hosts": len(outcomes),
+            "ok": ok,
+            "failed": len(outcomes) - ok,
+            "rollbacks": sum(h.rollbacks for h in fleet.hosts),
+            "injected_failures": sum(h.failures for h in fleet.hosts),
+            "injected_timeouts": sum(h.timeouts for h in fleet.hosts),
+            "commands": sum(len(h.commands) for h in fleet.hosts),
+            "elapsed_s": round(elapsed, 3),
+            "hosts_per_s": round(len(outcomes) / elapsed, 2) if elapsed else None,
+            "p50_s": round(statistics.median(durations), 3) if durations else None,
+            "p95_s": round(_percentile(durations, 95), 3) if durations else None,
+        }
+    finally:
+        # 基准用的临时配置库与模拟安装包用完即删
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Simulated SSH fleet for install benchmarks")
+    parser.add_argument("command", choices=["serve", "bench"])
+    parser.add_argument("--hosts", type=int, default=10)
+    parser.add_argument("--mode", choices=["ports", "aliases"], default="ports")
+    parser.add_argument("--base-port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per command")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--output-bytes", type=int, default=0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-seconds", type=float, default=30.0)
+    parser.add_argument("--auth-fail-rate", type=float, default=0.0)
+    parser.add_argument("--fail-step", action="append", default=[], help="regex of script text that always fails")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--upload-bytes", type=int, default=0)
+    args = parser.parse_args(argv)
+    # 客户端断开时 paramiko 会打印 "Socket exception"，基准输出中屏蔽
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+    behavior = SimBehavior(
+        latency=args.latency,
+        jitter=args.jitter,
+        output_bytes=args.output_bytes,
+        fail_rate=args.fail_rate,
+        timeout_rate=args.timeout_rate,
+        timeout_seconds=args.timeout_seconds,
+        auth_fail_rate=args.auth_fail_rate,
+        rules=[SimRule(pattern=p, fail_rate=1.0) for p in args.fail_step],
+    )
+    with SimulatedSSHFleet(args.hosts, behavior, mode=args.mode, base_port=args.base_port) as fleet:
+        if args.command == "bench":
+            print(run_benchmark(fleet, concurrency=args.concurrency, upload_bytes=args.upload_bytes))
+            return
+        for h in fleet.hosts:
+            print(f"{h.name} {h.address}:{h.port}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()